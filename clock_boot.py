@@ -0,0 +1,88 @@
+#####################################
+### Warm boot cache and timing    ###
+#####################################
+#
+# After a reset the RTC still has the time and the e-ink still shows the
+# last frame.  BootCache keeps what it takes to carry on from there in
+# microcontroller.nvm: the access point's channel and BSSID (so WiFi can
+# join without a scan) and the SleepState of the last frame drawn (texts,
+# theme and the clock discipline, see clock_sleep.py).  nvm is flash, so save() only writes
+# when the contents changed and code.py only calls it every so often.
+#
+# BootTimer records how long each boot phase took.
+
+import struct
+import time
+
+_MAGIC = b"MTB1"
+_HEADER = "<4sB6sH"  # magic, channel, bssid, length of the SleepState that follows
+_HEADER_SIZE = struct.calcsize(_HEADER)
+_STATE_MAX = 512  # bytes kept for the SleepState
+
+
+class BootCache:
+    # state is the SleepState shared with deep sleep, draw_frame keeps its texts
+    def __init__(self, memory, state):
+        self._memory = memory
+        self.state = state
+        self.channel = 0  # 0 = unknown, scan as usual
+        self.bssid = b""
+        self.writes = 0  # nvm writes, to keep an eye on flash wear
+
+    # False if nvm holds nothing of ours.  state=False only loads the AP,
+    # e.g. when sleep memory already gave a newer state.
+    def load(self, state=True):
+        header = bytes(self._memory[0:_HEADER_SIZE])
+        if header[0:4] != _MAGIC:
+            return False
+        _, self.channel, bssid, length = struct.unpack(_HEADER, header)
+        if length > _STATE_MAX:
+            return False
+        self.bssid = bssid if bssid != b"\x00" * 6 else b""
+        if not state:
+            return True
+        return self.state.load(bytes(self._memory[_HEADER_SIZE : _HEADER_SIZE + length]))
+
+    # Write to nvm if anything changed, returns True if it wrote
+    def save(self):
+        state = bytearray(_STATE_MAX)
+        length = self.state.save(state)
+        data = struct.pack(_HEADER, _MAGIC, self.channel, (self.bssid + b"\x00" * 6)[:6], length) + bytes(state[:length])
+        if bytes(self._memory[0 : len(data)]) == data:
+            return False
+        self._memory[0 : len(data)] = data
+        self.writes += 1
+        return True
+
+    def invalidate(self):
+        self._memory[0:4] = b"\x00\x00\x00\x00"
+
+
+# The RTC survives resets but not a power cut, when it starts at 2000 again
+def rtc_valid(year=2022):
+    return time.localtime().tm_year >= year
+
+
+class BootTimer:
+    def __init__(self, start=None, monotonic=time.monotonic):
+        self._monotonic = monotonic
+        self.start = monotonic() if start is None else start
+        self.phases = []  # (name, seconds since the previous mark)
+        self._last = self.start
+        self.first_paint = None  # seconds from start to the first frame on screen
+
+    def mark(self, name):
+        now = self._monotonic()
+        self.phases.append((name, now - self._last))
+        self._last = now
+
+    def painted(self):
+        if self.first_paint is None:
+            self.first_paint = self._monotonic() - self.start
+
+    def report(self):
+        text = " ".join("%s %.2fs" % phase for phase in self.phases)
+        text += " total %.2fs" % (self._last - self.start)
+        if self.first_paint is not None:
+            text += " first paint %.2fs" % self.first_paint
+        return text
@@ -0,0 +1,146 @@
+###########################
+### UDP command registry ###
+###########################
+#
+# Named command handlers for the UDP control port instead of exec() on
+# every datagram.  Several commands fit in one datagram and every one of
+# them gets an ack with its result:
+#
+#   request:  [seq|]command [args];command [args]...     e.g. 17|bright 0.5;refresh
+#   reply:    seq|ok [result];err message...              e.g. 17|ok 0.5;ok
+#
+# From a script:  echo -n "1|stats" | nc -u -w1 <clock ip> 808
+#
+# The old free-form python is still possible with "exec <code>", but only
+# for whitelisted snippets (or everything if allow_any), and each snippet
+# is compiled once and cached.
+
+import errno
+
+from clock_log import default
+
+try:
+    from watchdog import WatchDogTimeout  # Let it through to code.py's crash dump
+except ImportError:
+    WatchDogTimeout = ()  # off the board, nothing to let through
+
+
+class CommandError(Exception):
+    pass
+
+
+# An error message can't carry the reply's separators, it would split the reply
+def _error(message):
+    return "err " + message.replace(";", ",").replace("|", "/")
+
+
+class CommandRegistry:
+    def __init__(self, exec_allow=(), allow_any=False, exec_globals=None, cache_size=8, log=None):
+        self.log = log if log is not None else default()
+        self._handlers = {}
+        self._help = {}
+        self._exec_allow = exec_allow
+        self._allow_any = allow_any
+        self._exec_globals = exec_globals if exec_globals is not None else {}
+        self._cache = {}  # source -> compiled code
+        self._cache_size = cache_size
+        self._pending = None  # (size, address) of a datagram receive() took
+        self.requests = 0
+        self.commands = 0
+        self.errors = 0
+        self.cache_hits = 0
+        self.register("help", self._help_command, "list commands")
+        self.register("exec", self._exec_command, "run a whitelisted python snippet")
+
+    # handler(args) gets the text after the command name and returns a result (or None)
+    def register(self, name, handler, help_text=""):
+        self._handlers[name] = handler
+        self._help[name] = help_text
+
+    def _help_command(self, args):
+        if args:
+            return self._help.get(args, "unknown")
+        return " ".join(sorted(self._handlers))
+
+    def _exec_command(self, source):
+        if not self._allow_any and source not in self._exec_allow:
+            raise CommandError("not whitelisted")
+        code = self._cache.get(source)
+        if code is None:
+            if len(self._cache) >= self._cache_size:
+                self._cache.clear()
+            code = compile(source, "udp", "exec")
+            self._cache[source] = code
+        else:
+            self.cache_hits += 1
+        exec(code, self._exec_globals)
+
+    # Run one "command args" string, returns the reply part for it
+    def run(self, text):
+        self.commands += 1
+        name, _, args = text.strip().partition(" ")
+        handler = self._handlers.get(name)
+        if handler is None:
+            self.errors += 1
+            return _error("unknown " + name)
+        try:
+            result = handler(args.strip())
+        except WatchDogTimeout:
+            raise
+        except Exception as e:  # report anything back rather than dying
+            self.errors += 1
+            return _error(str(e))
+        if result is None:
+            return "ok"
+        return "ok " + str(result)
+
+    # Handle a whole datagram, returns the reply bytes
+    def handle(self, data):
+        self.requests += 1
+        try:
+            text = str(data, "utf-8").strip()
+        except UnicodeError:  # not text, answer it like any other bad command
+            self.errors += 1
+            return b"|err not utf-8"
+        seq, bar, body = text.partition("|")
+        if not bar:
+            seq, body = "", text
+        replies = [self.run(part) for part in body.split(";") if part.strip()]
+        return (seq + "|" + ";".join(replies)).encode("utf-8")
+
+    # Take one datagram off a non-blocking socket into buffer, True if one
+    # was waiting.  It stays there for poll(), so an idle wait can look for
+    # commands without serving them.
+    def receive(self, sock, buffer):
+        if self._pending is not None:
+            return True
+        try:
+            self._pending = sock.recvfrom_into(buffer)
+        except OSError as e:
+            if e.args[0] != errno.EAGAIN:
+                self.log.warning("UDP error: %s", e)
+            return False
+        return True
+
+    # Serve every waiting datagram on a non-blocking socket, received(data)
+    # sees each one first (the trace recorder)
+    def poll(self, sock, buffer, received=None):
+        while self.receive(sock, buffer):
+            size, addr = self._pending
+            self._pending = None
+            if received is not None:
+                received(buffer[:size])
+            reply = self.handle(buffer[:size])
+            self.log.debug("UDP %s %s", addr, reply)
+            try:
+                sock.sendto(reply, addr)
+            except OSError as e:
+                self.log.warning("UDP reply failed: %s", e)
+
+    def stats(self):
+        return "requests %d commands %d errors %d cache hits %d" % (
+            self.requests,
+            self.commands,
+            self.errors,
+            self.cache_hits,
+        )
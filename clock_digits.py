@@ -0,0 +1,139 @@
+#####################################
+### Digit atlas display           ###
+#####################################
+#
+# The time and date only ever show digits and a separator.  Each glyph is
+# rasterised once into a shared atlas bitmap (one cell per character) and
+# TileGrids show the text by tile index, so a new minute only rewrites the
+# tile indices of the cells that changed: no glyph lookups, no new
+# bitmaps, nothing allocated.  The colour is the palette, so inverting the
+# screen does not touch the tiles either.
+#
+# The layout is fixed by a template such as "00:00" or "00.00.00".  Digits
+# and separators get their own cell widths (the font's advance), so the
+# text sits where a Label with the same font would put it.
+
+import displayio
+
+try:
+    import bitmaptools  # copies the glyphs in C where the firmware has it
+except ImportError:
+    bitmaptools = None
+
+DIGITS = "0123456789"
+
+_atlases = {}  # (font, chars) -> (bitmap, cell width, cell height), shared
+
+
+def _blit(atlas, glyph, x, y):
+    if bitmaptools is not None:
+        bitmaptools.blit(atlas, glyph.bitmap, x, y, skip_source_index=0)
+        return
+    bitmap = glyph.bitmap
+    for gy in range(glyph.height):
+        for gx in range(glyph.width):
+            if bitmap[gx, gy]:
+                atlas[x + gx, y + gy] = 1
+
+
+# Rasterise chars plus a blank cell (the last tile) into one bitmap.
+# All atlases of a font share its bounding box, so their baselines line up.
+def build_atlas(font, chars):
+    key = (id(font), chars)
+    if key in _atlases:
+        return _atlases[key]
+    font.load_glyphs(chars)
+    glyphs = [font.get_glyph(ord(c)) for c in chars]
+    _, cell_h, _, box_y = font.get_bounding_box()
+    ascent = cell_h + box_y
+    cell_w = max(g.shift_x for g in glyphs if g)
+    atlas = displayio.Bitmap(cell_w * (len(chars) + 1), cell_h, 2)
+    for i, glyph in enumerate(glyphs):
+        if glyph is None:
+            continue
+        x = min(max(i * cell_w + glyph.dx, 0), atlas.width - glyph.width)
+        y = min(max(ascent - glyph.height - glyph.dy, 0), cell_h - glyph.height)
+        _blit(atlas, glyph, x, y)
+    _atlases[key] = (atlas, cell_w, cell_h)
+    return _atlases[key]
+
+
+class DigitDisplay(displayio.Group):
+    # position and anchor work like MagTag.add_text's text_position / text_anchor_point
+    # palette can be shared with other displays (e.g. a Theme's), 0 must be transparent
+    def __init__(self, font, template, position, anchor=(0, 0), color=0x000000, palette=None):
+        super().__init__()
+        if palette is None:
+            palette = displayio.Palette(2)
+            palette.make_transparent(0)
+            palette[1] = color
+        self._palette = palette
+        separators = "".join(sorted(set(c for c in template if c not in DIGITS)))
+        self._slots = []  # (grid, cell, chars) for each character of the template
+        x = 0
+        run = 0
+        while run < len(template):
+            digit = template[run] in DIGITS
+            end = run
+            while end < len(template) and (template[end] in DIGITS) == digit:
+                end += 1
+            chars = DIGITS if digit else separators
+            atlas, cell_w, self.height = build_atlas(font, chars)
+            grid = displayio.TileGrid(
+                atlas,
+                pixel_shader=self._palette,
+                width=end - run,
+                height=1,
+                tile_width=cell_w,
+                tile_height=self.height,
+                default_tile=len(chars),
+                x=x,
+            )
+            self.append(grid)
+            for cell in range(end - run):
+                self._slots.append((grid, cell, chars))
+            x += (end - run) * cell_w
+            run = end
+        self.width = x
+        self.x = position[0] - int(anchor[0] * self.width)
+        self.y = position[1] - int(anchor[1] * self.height)
+        self.text = ""
+        self.writes = 0  # tile indices written, to see the saving
+        self.dirty = None  # (x, y, width, height) changed since clean(), in screen pixels
+
+    # Show text in the template's cells, returns the number of cells changed.
+    # Characters the atlas does not have, and cells past the text, are blank.
+    def set_text(self, text):
+        changed = 0
+        for i, (grid, cell, chars) in enumerate(self._slots):
+            tile = chars.find(text[i]) if i < len(text) else -1
+            if tile < 0:
+                tile = len(chars)
+            if grid[cell] != tile:
+                grid[cell] = tile
+                changed += 1
+                self._mark(grid.x + cell * grid.tile_width, grid.tile_width)
+        self.text = text
+        self.writes += changed
+        return changed
+
+    @property
+    def color(self):
+        return self._palette[1]
+
+    def set_color(self, color):
+        if color == self._palette[1]:
+            return
+        self._palette[1] = color
+        self._mark(0, self.width)
+
+    def _mark(self, x, width):
+        x += self.x
+        right = x + width
+        if self.dirty is not None:
+            x = min(x, self.dirty[0])
+            right = max(right, self.dirty[0] + self.dirty[2])
+        self.dirty = (x, self.y, right - x, self.height)
+
+    def clean(self):
+        self.dirty = None
@@ -0,0 +1,144 @@
+#######################################
+### Change-tracking label renderer  ###
+#######################################
+#
+# Sits over MagTag.set_text / set_text_color.  Remembers what each label
+# last showed, only rebuilds labels whose text or colour changed, and
+# coalesces everything into one e-ink refresh per frame (or none at all).
+# A label can be handed to another drawable with attach(), e.g. the digit
+# atlas in clock_digits.py, and is tracked the same way.
+#
+# With bounds(index) giving a label's box on screen (and attached drawables
+# keeping their own dirty box), the areas changed since the last refresh
+# are tracked too, old and new place of every changed label, and handed to
+# a RefreshScheduler (clock_refresh.py) that can update just those.
+
+from clock_refresh import merge
+
+
+class LabelRenderer:
+    def __init__(self, magtag, count, bounds=None, scheduler=None):
+        self._magtag = magtag
+        self._text = [None] * count
+        self._color = [None] * count
+        self._background = None
+        self._targets = [None] * count  # attached drawables, None = MagTag label
+        self._dirty = False
+        self._bounds = bounds
+        self._scheduler = scheduler
+        self._boxes = [None] * count  # where each MagTag label was last drawn
+        self.areas = []  # (x, y, width, height) boxes changed since the last refresh
+        self._whole = bounds is None  # the whole screen changed, or nobody knows what did
+        # counters so the saving can be seen
+        self.rebuilds = 0
+        self.skipped = 0
+        self.refreshes = 0
+        self.skipped_refreshes = 0
+
+    # Draw label index with target.set_text / set_color instead of MagTag
+    def attach(self, index, target):
+        self._targets[index] = target
+        self._text[index] = None
+        self._color[index] = None
+
+    def set_text(self, index, text):
+        if text == self._text[index]:
+            self.skipped += 1
+            return False
+        if self._targets[index] is not None:
+            self._targets[index].set_text(text)
+        else:
+            self._magtag.set_text(text, index=index, auto_refresh=False)
+            self._moved(index)
+        self._text[index] = text
+        self.rebuilds += 1
+        self._dirty = True
+        return True
+
+    def set_color(self, index, color):
+        if color == self._color[index]:
+            self.skipped += 1
+            return False
+        if self._targets[index] is not None:
+            self._targets[index].set_color(color)
+        else:
+            self._magtag.set_text_color(color, index=index)
+            self._moved(index)
+        self._color[index] = color
+        self.rebuilds += 1
+        self._dirty = True
+        return True
+
+    def set_background(self, color):
+        if color == self._background:
+            self.skipped += 1
+            return False
+        self._magtag.graphics.set_background(color)
+        self._background = color
+        self.rebuilds += 1
+        self._dirty = True
+        self._whole = True
+        return True
+
+    def text(self, index):
+        return self._text[index]
+
+    # Something else on screen changed (e.g. a palette), refresh next time
+    def touch(self):
+        self._dirty = True
+        self._whole = True
+
+    # Add label index's old and new box to the changed area
+    def _moved(self, index):
+        if self._bounds is None:
+            return
+        box = self._bounds(index)
+        merge(self.areas, self._boxes[index])
+        merge(self.areas, box)
+        self._boxes[index] = box
+
+    # The panel already shows the labels as set (e.g. the e-ink kept the
+    # frame over a reset), nothing to refresh
+    def shown(self):
+        self._dirty = False
+        self._clean()
+
+    @property
+    def dirty(self):
+        return self._dirty
+
+    # One refresh for everything changed since the last call, force
+    # redraws the whole screen
+    def refresh(self, force=False):
+        if not self._dirty and not force:
+            self.skipped_refreshes += 1
+            return False
+        if self._scheduler is None:
+            self._magtag.refresh()
+        else:
+            for target in self._targets:
+                if target is not None:
+                    merge(self.areas, target.dirty)
+            if not self._scheduler.refresh(None if force or self._whole else self.areas):
+                self.shown()  # nothing on screen moved, e.g. set back to what it showed
+                self.skipped_refreshes += 1
+                return False
+        self._dirty = False
+        self._clean()
+        self.refreshes += 1
+        return True
+
+    def _clean(self):
+        self.areas = []
+        self._whole = self._bounds is None
+        for target in self._targets:
+            if target is not None:
+                target.clean()
+
+    def stats(self):
+        return "rebuilt %d skipped %d refreshes %d skipped %d" % (
+            self.rebuilds,
+            self.skipped,
+            self.refreshes,
+            self.skipped_refreshes,
+        )
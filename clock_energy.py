@@ -0,0 +1,178 @@
+#####################################
+### Energy accounting             ###
+#####################################
+#
+# Where does the battery go?  The meter records how long each activity
+# runs and how often, and a current model turns that into charge:
+#
+#   MODEL = {activity: (mA while it runs, mAs each time it runs)}
+#
+# Activities are timed three ways:
+#   wrap(name, fn)   fn runs in the foreground (MQTT waits, WiFi joins,
+#                    NTP, starting an e-ink refresh), nested calls are not
+#                    counted twice
+#   start/stop(name) something left on in the background (NeoPixels, the
+#                    speaker, the board asleep)
+#   add(name, ...)   anything measured elsewhere
+# "cpu" is whatever is left: awake, but not in a foreground activity.
+#
+# Charge per category divided by the time accounted gives mAh per hour
+# (the average mA).  Battery voltage samples every sample_period seconds
+# give a trend, and the runtime left is projected from both the trend and
+# the model.  Nothing here touches hardware, feed it a synthetic trace
+# with monotonic= to check a model on the host.
+
+import time
+from array import array
+
+# Rough MagTag figures, change them for your board.  e-ink refreshes run in
+# the background after display.refresh() returns, so they are charged per
+# refresh: about 2s at 8mA.
+MODEL = {
+    "cpu": (25, 0),  # awake outside the activities below
+    "sleep": (18, 0),  # time.sleep, WiFi associated in modem sleep
+    "light_sleep": (1, 0),
+    "mqtt": (70, 0),  # radio listening while MQTT waits for messages
+    "wifi": (90, 0),  # joining the AP, opening the MQTT session
+    "ntp": (70, 1),
+    "eink": (0, 16),
+    "eink_partial": (0, 3),  # about 0.4s at 8mA, where the driver has one
+    "neopixel": (6, 0),
+    "speaker": (25, 0),
+}
+
+
+class EnergyMeter:
+    def __init__(self, model=MODEL, capacity=420, empty=3.71, samples=36, sample_period=600, monotonic=time.monotonic):
+        self._model = model
+        self._monotonic = monotonic
+        self.capacity = capacity  # mAh when full
+        self.empty = empty  # volts where the runtime runs out
+        self.sample_period = sample_period  # seconds between battery samples
+        self.since = monotonic()  # start of the accounting
+        self.seconds = {name: 0.0 for name in model}
+        self.counts = {name: 0 for name in model}
+        self._on = {}  # activity: monotonic it was started
+        self._inner = 0.0  # foreground time of nested wraps, see wrap()
+        self.busy = 0.0  # seconds in foreground activities
+        self._times = array("f", [0.0] * samples)
+        self._volts = array("f", [0.0] * samples)
+        self._size = samples
+        self._pos = 0
+        self._count = 0
+        self._last_sample = None
+
+    def add(self, name, seconds=0.0, count=1):
+        self.seconds[name] = self.seconds.get(name, 0.0) + seconds
+        self.counts[name] = self.counts.get(name, 0) + count
+
+    def start(self, name):
+        if name not in self._on:
+            self._on[name] = self._monotonic()
+
+    def stop(self, name):
+        since = self._on.pop(name, None)
+        if since is not None:
+            self.add(name, self._monotonic() - since)
+
+    # Wrap fn so every call counts as activity name
+    def wrap(self, name, fn):
+        def measured(*args):
+            outer = self._inner
+            self._inner = 0.0
+            start = self._monotonic()
+            try:
+                return fn(*args)
+            finally:
+                spent = self._monotonic() - start
+                self.add(name, spent - self._inner)
+                self.busy += spent - self._inner
+                self._inner = outer + spent
+
+        return measured
+
+    # Seconds in an activity, counting one still running
+    def _seconds(self, name, now):
+        seconds = self.seconds.get(name, 0.0)
+        if name in self._on:
+            seconds += now - self._on[name]
+        return seconds
+
+    # mAs used by each activity so far
+    def charge(self):
+        now = self._monotonic()
+        asleep = self._seconds("sleep", now) + self._seconds("light_sleep", now)
+        charge = {}
+        for name, (current, each) in self._model.items():
+            if name == "cpu":
+                seconds = max(0.0, now - self.since - asleep - self.busy)
+            else:
+                seconds = self._seconds(name, now)
+            charge[name] = current * seconds + each * self.counts.get(name, 0)
+        return charge
+
+    # Average mA (mAh per hour) for each activity
+    def per_hour(self):
+        hours = max(self._monotonic() - self.since, 1.0) / 3600
+        return {name: mas / 3600 / hours for name, mas in self.charge().items()}
+
+    # Keep a battery sample every sample_period, the trend restarts on the charger
+    def battery(self, volts, charging=False):
+        now = self._monotonic()
+        if charging:
+            self._count = 0
+            self._last_sample = None
+            return False
+        if self._last_sample is not None and now - self._last_sample < self.sample_period:
+            return False
+        self._last_sample = now
+        self._times[self._pos] = now - self.since
+        self._volts[self._pos] = volts
+        self._pos = (self._pos + 1) % self._size
+        if self._count < self._size:
+            self._count += 1
+        return True
+
+    # Volts per hour from a least squares fit, None until it spans an hour
+    def trend(self):
+        if self._count < 3:
+            return None
+        points = [((self._pos - self._count + i) % self._size) for i in range(self._count)]
+        times = [self._times[i] for i in points]
+        if times[-1] - times[0] < 3600:
+            return None
+        volts = [self._volts[i] for i in points]
+        mean_t = sum(times) / self._count
+        mean_v = sum(volts) / self._count
+        spread = sum((t - mean_t) ** 2 for t in times)
+        slope = sum((t - mean_t) * (v - mean_v) for t, v in zip(times, volts)) / spread
+        return slope * 3600
+
+    # Hours left from the voltage trend and from the model, None if unknown
+    def runtime(self, batt_pc):
+        trend = self.trend()
+        by_trend = None
+        if trend is not None and trend < 0 and self._count:
+            by_trend = max(0.0, (self._volts[(self._pos - 1) % self._size] - self.empty) / -trend)
+        by_model = None
+        used = sum(self.per_hour().values())
+        if used > 0 and self._monotonic() - self.since >= self.sample_period:  # too noisy before
+            by_model = self.capacity * min(max(batt_pc, 0), 100) / 100 / used
+        return by_trend, by_model
+
+    # Hours left for a label, the trend if there is one, else the model
+    def hours_left(self, batt_pc):
+        by_trend, by_model = self.runtime(batt_pc)
+        return by_trend if by_trend is not None else by_model
+
+    def report(self, batt_pc=None):
+        rates = self.per_hour()
+        text = " ".join("%s %.2f" % (name, rates[name]) for name in self._model)
+        text += " total %.1fmA" % sum(rates.values())
+        if batt_pc is not None:
+            by_trend, by_model = self.runtime(batt_pc)
+            text += " runtime trend %s model %s" % (
+                "-" if by_trend is None else "%.0fh" % by_trend,
+                "-" if by_model is None else "%.0fh" % by_model,
+            )
+        return text
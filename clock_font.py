@@ -0,0 +1,92 @@
+#####################################
+### Compiled glyph-subset fonts   ###
+#####################################
+#
+# Loads the .mtf fonts written by tools/font_compiler.py.  Only the small
+# glyph index is kept in RAM; bitmaps are read from flash with a seek the
+# first time a glyph is drawn and cached after that.  Behaves like an
+# adafruit_bitmap_font BDF font so Label and MagTag.add_text can use it.
+
+import struct
+import displayio
+from fontio import Glyph
+
+_MAGIC = b"MTF1"
+_HEADER = "<4sHhhhhhh"
+_INDEX = "<HIBBbbb"
+_INDEX_SIZE = struct.calcsize(_INDEX)
+
+
+class CompiledFont:
+    def __init__(self, path):
+        self._file = open(path, "rb")
+        header = self._file.read(struct.calcsize(_HEADER))
+        magic, self._count, w, h, x, y, self.ascent, self.descent = struct.unpack(_HEADER, header)
+        if magic != _MAGIC:
+            raise ValueError("Not a compiled font: %s" % path)
+        self._bbox = (w, h, x, y)
+        self._index = self._file.read(self._count * _INDEX_SIZE)
+        self._glyphs = {}
+
+    def get_bounding_box(self):
+        return self._bbox
+
+    # binary search of the sorted index, returns the entry number or -1
+    def _find(self, code_point):
+        lo = 0
+        hi = self._count - 1
+        while lo <= hi:
+            mid = (lo + hi) // 2
+            found = struct.unpack_from("<H", self._index, mid * _INDEX_SIZE)[0]
+            if found == code_point:
+                return mid
+            if found < code_point:
+                lo = mid + 1
+            else:
+                hi = mid - 1
+        return -1
+
+    def _load_glyph(self, code_point):
+        entry = self._find(code_point)
+        if entry < 0:
+            return None
+        _, offset, width, height, dx, dy, shift_x = struct.unpack_from(
+            _INDEX, self._index, entry * _INDEX_SIZE
+        )
+        stride = (width + 7) // 8
+        self._file.seek(offset)
+        rows = self._file.read(stride * height)
+        bitmap = displayio.Bitmap(width, height, 2)
+        for y in range(height):
+            row = y * stride
+            for x in range(width):
+                if rows[row + x // 8] & (0x80 >> (x % 8)):
+                    bitmap[x, y] = 1
+        return Glyph(bitmap, 0, width, height, dx, dy, shift_x, 0)
+
+    def load_glyphs(self, code_points):
+        if isinstance(code_points, int):
+            code_points = (code_points,)
+        for code_point in code_points:
+            if isinstance(code_point, str):
+                code_point = ord(code_point)
+            if code_point not in self._glyphs:
+                self._glyphs[code_point] = self._load_glyph(code_point)
+
+    def get_glyph(self, code_point):
+        if code_point not in self._glyphs:
+            self._glyphs[code_point] = self._load_glyph(code_point)
+        return self._glyphs[code_point]
+
+
+# Register the compiled version of a BDF font with MagTag's font cache.
+# Returns the path to pass as add_text(text_font=...), which is the BDF
+# path again if no compiled font has been copied to the board.
+def register(magtag, bdf_path):
+    mtf_path = bdf_path[: bdf_path.rfind(".")] + ".mtf"
+    try:
+        magtag._fonts[mtf_path] = CompiledFont(mtf_path)
+    except OSError:
+        print("No compiled font, using", bdf_path)
+        return bdf_path
+    return mtf_path
@@ -0,0 +1,262 @@
+#####################################
+### Leveled ring-buffer logger    ###
+#####################################
+#
+# Instead of print() on every pass through the loop.  A record below the
+# logger's level returns after one comparison: the message is a % format
+# and its arguments, and nothing is formatted unless a sink wants it.  For
+# arguments that are expensive to build, check enabled(level) first.
+#
+# Records at or above keep go into a ring of size preallocated slots
+# (time, level, format, arguments), newest overwriting oldest, so the
+# last few events are there for "log tail" and for dump(), which writes
+# them as text into microcontroller.nvm before a reset.  recover() reads
+# that back at the next boot.
+#
+# Sinks get the formatted line for records at or above their own level:
+#   SerialSink  print(), what the clock always did
+#   UDPSink     lines packed into one datagram, sent when full or on flush()
+#   MQTTSink    lines packed into one message, published on flush()
+#
+# The other modules take a log= argument, code.py passes its logger.
+# Without one they share default(), which prints info and above.
+
+import struct
+import time
+from array import array
+
+try:
+    from watchdog import WatchDogTimeout  # Let it through to code.py's crash dump
+except ImportError:
+    WatchDogTimeout = ()  # off the board, nothing to let through
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+LEVELS = {"debug": DEBUG, "info": INFO, "warning": WARNING, "error": ERROR}
+NAMES = {DEBUG: "D", INFO: "I", WARNING: "W", ERROR: "E"}
+
+_MAGIC = b"MTL1"
+_HEADER = "<4sH"  # magic, length of the text that follows
+_HEADER_SIZE = struct.calcsize(_HEADER)
+
+
+_default = None
+
+
+# Logger for modules given none (host tools, tests), printing like they used to
+def default():
+    global _default
+    if _default is None:
+        _default = Logger(INFO, keep=ERROR + 1, size=1)
+        _default.add(SerialSink())
+    return _default
+
+
+def level_name(level):
+    for name, value in LEVELS.items():
+        if value == level:
+            return name
+    return str(level)
+
+
+class Logger:
+    def __init__(self, level=INFO, keep=INFO, size=32, monotonic=time.monotonic):
+        self._monotonic = monotonic
+        self.sinks = []
+        self._times = array("f", [0.0] * size)
+        self._levels = bytearray(size)
+        self._messages = [None] * size
+        self._args = [None] * size
+        self._size = size
+        self._pos = 0
+        self._count = 0
+        self.records = 0  # records logged (sent or kept)
+        self.dumps = 0
+        self.set_level(level, keep)
+
+    # Change what is sent to the sinks and what the ring keeps, at runtime
+    def set_level(self, level=None, keep=None):
+        if level is not None:
+            self.level = level
+        if keep is not None:
+            self.keep = keep
+
+    def add(self, sink):
+        self.sinks.append(sink)
+        return sink
+
+    def enabled(self, level):
+        return level >= self.level or level >= self.keep
+
+    def log(self, level, message, args=()):
+        if level < self.level and level < self.keep:
+            return
+        self.records += 1
+        now = self._monotonic()
+        if level >= self.keep:
+            pos = self._pos
+            self._times[pos] = now
+            self._levels[pos] = level
+            self._messages[pos] = message
+            self._args[pos] = args
+            self._pos = (pos + 1) % self._size
+            if self._count < self._size:
+                self._count += 1
+        if level < self.level:
+            return
+        text = None
+        for sink in self.sinks:
+            if level >= sink.level:
+                if text is None:
+                    text = message % args if args else message
+                sink.write(now, level, text)
+
+    def debug(self, message, *args):
+        if DEBUG >= self.level or DEBUG >= self.keep:
+            self.log(DEBUG, message, args)
+
+    def info(self, message, *args):
+        if INFO >= self.level or INFO >= self.keep:
+            self.log(INFO, message, args)
+
+    def warning(self, message, *args):
+        self.log(WARNING, message, args)
+
+    def error(self, message, *args):
+        self.log(ERROR, message, args)
+
+    def flush(self):
+        for sink in self.sinks:
+            sink.flush()
+
+    # The newest count records in the ring, oldest first, as text lines
+    def tail(self, count=None):
+        count = self._count if count is None else min(count, self._count)
+        lines = []
+        for i in range(self._count - count, self._count):
+            pos = (self._pos - self._count + i) % self._size
+            args = self._args[pos]
+            message = self._messages[pos]
+            try:
+                text = message % args if args else message
+            except (TypeError, ValueError):
+                text = message
+            lines.append("%.1f %s %s" % (self._times[pos], NAMES.get(self._levels[pos], "?"), text))
+        return lines
+
+    # Write the ring as text to memory (nvm) at offset, cut to size bytes
+    # from the newest end.  Only writes if it changed, nvm is flash.
+    def dump(self, memory, offset=4096, size=2048):
+        text = "\n".join(self.tail()).encode("utf-8")[-(size - _HEADER_SIZE) :]
+        data = struct.pack(_HEADER, _MAGIC, len(text)) + text
+        if bytes(memory[offset : offset + len(data)]) != data:
+            memory[offset : offset + len(data)] = data
+        self.dumps += 1
+        return len(data)
+
+    def stats(self):
+        return "level %s keep %s records %d kept %d dumps %d" % (
+            level_name(self.level),
+            level_name(self.keep),
+            self.records,
+            self._count,
+            self.dumps,
+        )
+
+
+# The text dump() left at offset, or None.  Clears it so it shows once.
+def recover(memory, offset=4096, size=2048):
+    header = bytes(memory[offset : offset + _HEADER_SIZE])
+    if header[0:4] != _MAGIC:
+        return None
+    length = struct.unpack(_HEADER, header)[1]
+    if length > size - _HEADER_SIZE:
+        return None
+    text = str(bytes(memory[offset + _HEADER_SIZE : offset + _HEADER_SIZE + length]), "utf-8")
+    memory[offset : offset + 4] = b"\x00\x00\x00\x00"
+    return text
+
+
+class SerialSink:
+    def __init__(self, level=DEBUG):
+        self.level = level
+
+    def write(self, now, level, text):
+        if level >= WARNING:
+            print(NAMES[level], text)
+        else:
+            print(text)
+
+    def flush(self):
+        pass
+
+
+# Lines packed into a preallocated buffer, sent as one datagram
+class UDPSink:
+    def __init__(self, sock, address, size=512, level=INFO):
+        self.level = level
+        self._sock = sock
+        self._address = address
+        self._buffer = bytearray(size)
+        self._used = 0
+        self.sent = 0  # datagrams
+        self.dropped = 0  # batches lost to send errors, or lines too long for the buffer
+
+    def write(self, now, level, text):
+        line = ("%.1f %s %s\n" % (now, NAMES[level], text)).encode("utf-8")
+        if len(line) > len(self._buffer):
+            self.dropped += 1
+            return
+        if self._used + len(line) > len(self._buffer):
+            self.flush()
+        self._buffer[self._used : self._used + len(line)] = line
+        self._used += len(line)
+
+    def flush(self):
+        if not self._used:
+            return
+        try:
+            self._sock.sendto(memoryview(self._buffer)[: self._used], self._address)
+            self.sent += 1
+        except OSError:
+            self.dropped += 1
+        self._used = 0
+
+
+# Lines collected between flushes and published as one message.  connected()
+# says whether the client can publish, lines wait (up to size bytes) if not.
+class MQTTSink:
+    def __init__(self, client, topic, connected, size=512, level=WARNING):
+        self.level = level
+        self._client = client
+        self._topic = topic
+        self._connected = connected
+        self._lines = []
+        self._bytes = 0
+        self._size = size
+        self.published = 0
+        self.dropped = 0
+
+    def write(self, now, level, text):
+        line = "%.1f %s %s" % (now, NAMES[level], text)
+        self._lines.append(line)
+        self._bytes += len(line) + 1
+        while self._bytes > self._size and len(self._lines) > 1:
+            self._bytes -= len(self._lines.pop(0)) + 1
+            self.dropped += 1
+
+    def flush(self):
+        if not self._lines or not self._connected():
+            return
+        try:
+            self._client.publish(self._topic, "\n".join(self._lines))
+        except WatchDogTimeout:
+            raise
+        except Exception as e:  # whatever the client raises, the lines wait for the next flush
+            print("Log publish failed:", e)  # Not through the logger, it would come straight back here
+            return
+        self.published += 1
+        self._lines = []
+        self._bytes = 0
@@ -0,0 +1,109 @@
+##################################
+### MQTT time topic dispatcher ###
+##################################
+#
+# One wildcard subscription (time/#) or one packed topic (time/state)
+# instead of eight subscriptions.  Incoming topics are looked up in a
+# handler table, parsed to the right type and staged; commit() applies
+# everything staged at once so a half updated date is never drawn.
+# minimqtt's loop() hands over one message per call, so code.py calls it
+# until nothing is left before committing.
+#
+# Packed payload on time/state is date +%y%m%d%H%M%w, e.g. "2610181234" + "0"
+#   yy mm dd HH MM w(0 = Sunday)
+
+from clock_log import default
+from clock_time import DAYS, MONTHS
+
+TOPIC_ALL = "time/#"
+TOPIC_STATE = "time/state"
+
+
+def _text(field):
+    def parse(pending, payload):
+        pending[field] = payload
+
+    return parse
+
+
+def _hour(pending, payload):
+    pending["hour"] = int(payload)
+
+
+def _state(pending, payload):
+    if len(payload) < 11:
+        raise ValueError("short time/state payload")
+    yy = payload[0:2]
+    mm = payload[2:4]
+    dd = payload[4:6]
+    hh = payload[6:8]
+    month = int(mm)
+    if not 1 <= month <= 12:
+        raise ValueError("month %s in time/state" % mm)  # MONTHS[-1] would make 00 December
+    pending["time"] = hh + ":" + payload[8:10]
+    pending["hour"] = int(hh)
+    pending["day"] = dd
+    pending["month"] = mm
+    pending["year2"] = yy
+    pending["date"] = dd + "." + mm + "." + yy
+    pending["dowa"] = DAYS[int(payload[10])]
+    pending["moya"] = MONTHS[month - 1]
+
+
+# topic -> parser, anything else under time/# is ignored
+HANDLERS = {
+    "time/time": _text("time"),
+    "time/date2": _text("date"),
+    "time/dowa": _text("dowa"),
+    "time/day": _text("day"),
+    "time/moya": _text("moya"),
+    "time/year2": _text("year2"),
+    "time/month": _text("month"),
+    "time/hour": _hour,
+    TOPIC_STATE: _state,
+}
+
+
+class TopicDispatcher:
+    def __init__(self, fields, atomic=True, log=None):
+        self.log = log if log is not None else default()
+        self.fields = fields
+        self.atomic = atomic  # stage until commit() instead of applying at once
+        self._pending = {}
+        self.last = ()  # fields staged in the last commit, changed or not
+        self.received = 0
+        self.ignored = 0
+        self.errors = 0
+
+    # Subscribe with one call, packed topic only or the whole time/ tree
+    def subscribe(self, mqtt_client, packed=False, qos=1):
+        mqtt_client.subscribe(TOPIC_STATE if packed else TOPIC_ALL, qos)
+
+    # mqtt_client.on_message callback
+    def message(self, client, topic, message):
+        handler = HANDLERS.get(topic)
+        if handler is None:
+            self.ignored += 1
+            return
+        try:
+            handler(self._pending, message)
+        except (ValueError, IndexError) as e:
+            self.errors += 1
+            self.log.warning("Bad payload on %s: %s", topic, e)
+            return
+        self.received += 1
+        if not self.atomic:
+            self.commit()
+
+    # Apply staged fields together, returns True if anything changed
+    def commit(self):
+        if not self._pending:
+            return False
+        self.last = tuple(self._pending)
+        changed = False
+        for name, value in self._pending.items():
+            if getattr(self.fields, name) != value:
+                setattr(self.fields, name, value)
+                changed = True
+        self._pending.clear()
+        return changed
@@ -0,0 +1,235 @@
+#####################################
+### WiFi / MQTT connection manager ###
+#####################################
+#
+# Keeps the WiFi link and the MQTT session up without blocking the loop
+# for long.  step() runs as a scheduler task and does at most one
+# connection attempt per call (join WiFi, open the MQTT session or
+# subscribe), so the watchdog is fed between attempts.  Failed attempts
+# back off exponentially with jitter instead of resetting the radio in a
+# tight loop.
+#
+# The MQTT session is persistent (clean_session False with a fixed client
+# id), so after a reconnect the broker still has our subscriptions and
+# does not resend every retained message.  If nothing arrives for
+# resubscribe_after seconds the broker probably lost the session (e.g.
+# restarted without persistence) and we subscribe again.
+
+import random
+import time
+
+from clock_log import default
+
+try:
+    from watchdog import WatchDogTimeout  # Let it through to code.py's crash dump
+except ImportError:
+    WatchDogTimeout = ()  # off the board, nothing to let through
+
+DOWN = 0
+CONNECTING = 1
+UP = 2
+STATES = ("down", "connecting", "up")
+
+
+class ConnectionManager:
+    def __init__(
+        self,
+        radio,
+        ssid,
+        password,
+        min_backoff=1,
+        max_backoff=300,
+        resubscribe_after=180,
+        idle=60,
+        monotonic=time.monotonic,
+        log=None,
+    ):
+        self.log = log if log is not None else default()
+        self._radio = radio
+        self._ssid = ssid
+        self._password = password
+        self._mqtt = None  # link only until use_mqtt()
+        self._subscribe = None
+        self._channel = 0  # AP to join without a scan, see prefer()
+        self._bssid = b""
+        self._monotonic = monotonic
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.resubscribe_after = resubscribe_after
+        self.idle = idle  # seconds between checks while everything is up
+        self.link = UP if radio.ipv4_address else DOWN
+        self.session = DOWN
+        self._subscribed = False  # the broker has our subscriptions
+        self._failures = 0
+        self._next_try = 0
+        self._last_heard = monotonic()
+        self._down_since = monotonic()
+        # counters
+        self.reconnects = 0  # sessions opened after the first one
+        self.link_drops = 0
+        self.session_drops = 0
+        self.failures = 0  # failed attempts, link and session
+        self.subscribes = 0
+        self.downtime = 0.0  # seconds without a session, not counting the current outage
+        self.last_error = None
+
+    # Manage an MQTT session over the link, subscribe(mqtt_client) subscribes to everything
+    def use_mqtt(self, mqtt_client, subscribe):
+        self._mqtt = mqtt_client
+        self._subscribe = subscribe
+
+    # Join this AP's channel and BSSID directly next time (skips the scan).
+    # Forgotten after a failed join, the AP may have moved.
+    def prefer(self, channel, bssid=b""):
+        self._channel = channel
+        self._bssid = bssid
+
+    @property
+    def connected(self):
+        return self.session == UP
+
+    # Everything up: the link, and the session with our subscriptions if there is one
+    @property
+    def ready(self):
+        if self._mqtt is None:
+            return self.link == UP
+        return self.session == UP and self._subscribed
+
+    # MQTT message arrived, the session is alive
+    def heard(self):
+        self._last_heard = self._monotonic()
+
+    # The MQTT loop failed, called with the exception
+    def lost(self, error):
+        self.last_error = error
+        if self.session == UP:
+            self.session_drops += 1
+            self._down_since = self._monotonic()
+        self.session = DOWN
+        if not self._radio.ipv4_address:
+            if self.link == UP:
+                self.link_drops += 1
+            self.link = DOWN
+        self._next_try = 0  # first retry straight away, backoff after that
+        try:
+            self._mqtt.disconnect()  # close the old socket if there is one
+        except WatchDogTimeout:
+            raise
+        except Exception:
+            pass
+
+    def _backoff(self, error):
+        self.last_error = error
+        self.failures += 1
+        self._failures += 1
+        delay = min(self.max_backoff, self.min_backoff * 2 ** min(self._failures - 1, 16))
+        delay *= 0.5 + random.random() / 2  # jitter so many clocks don't retry together
+        self._next_try = self._monotonic() + delay
+        return delay
+
+    # One step towards being connected, returns seconds until the next call
+    def step(self):
+        now = self._monotonic()
+        if self.link == UP and self._mqtt is None:
+            return self.idle
+        if self.link == UP and self.session == UP:
+            if self._subscribed and now - self._last_heard > self.resubscribe_after:
+                self.log.info("MQTT quiet for %ds, subscribing again", now - self._last_heard)
+                self._subscribed = False
+            if not self._subscribed:
+                return self._resubscribe()
+            return self.idle
+        if now < self._next_try:
+            return self._next_try - now
+        if self.link != UP:
+            return self._join()
+        return self._open()
+
+    def _join(self):
+        self.link = CONNECTING
+        try:
+            if self._channel:
+                self._radio.connect(self._ssid, self._password, channel=self._channel, bssid=self._bssid, timeout=10)
+            else:
+                self._radio.connect(self._ssid, self._password, timeout=10)
+        except (ConnectionError, OSError, RuntimeError) as e:
+            self.link = DOWN
+            self.log.warning("WiFi connect failed: %s", e)
+            self._channel = 0
+            return self._backoff(e)
+        self.link = UP
+        self._failures = 0
+        self.log.info("WiFi connected to %s", self._ssid)
+        return 0
+
+    def _open(self):
+        self.session = CONNECTING
+        try:
+            self._mqtt.connect(clean_session=False)
+        except WatchDogTimeout:
+            raise
+        except Exception as e:  # MMQTTException, OSError, RuntimeError...
+            self.session = DOWN
+            if not self._radio.ipv4_address:
+                self.link = DOWN
+            self.log.warning("MQTT connect failed: %s", e)
+            return self._backoff(e)
+        self.session = UP
+        self._failures = 0
+        now = self._monotonic()
+        self.downtime += now - self._down_since
+        if self._subscribed:
+            self.reconnects += 1
+        self._last_heard = now
+        return 0 if not self._subscribed else self.idle
+
+    def _resubscribe(self):
+        try:
+            self._subscribe(self._mqtt)
+        except WatchDogTimeout:
+            raise
+        except Exception as e:
+            self.lost(e)
+            return self._backoff(e)
+        self.subscribes += 1
+        self._subscribed = True
+        self._last_heard = self._monotonic()
+        return self.idle
+
+    # Connect at boot, giving up after timeout seconds (None = never),
+    # feeding the watchdog with feed() before every attempt and at least
+    # every feed_every seconds of a backoff, which can run to max_backoff
+    def connect(self, timeout=None, feed=None, sleep=time.sleep, feed_every=5):
+        end = None if timeout is None else self._monotonic() + timeout
+        while not self.ready:
+            if feed is not None:
+                feed()  # a join can take its whole 10 s timeout
+            delay = self.step()
+            if self.ready:
+                break  # don't sleep out the delay once connected
+            if end is not None:
+                if self._monotonic() >= end:
+                    break
+                delay = min(delay, end - self._monotonic())
+            while delay > 0:
+                if feed is not None:
+                    feed()
+                pause = min(delay, feed_every)
+                sleep(pause)
+                delay -= pause
+        return self.ready
+
+    def stats(self):
+        downtime = self.downtime
+        if self.session != UP:
+            downtime += self._monotonic() - self._down_since
+        return "link %s session %s reconnects %d drops %d/%d failures %d subscribes %d downtime %ds" % (
+            STATES[self.link],
+            STATES[self.session],
+            self.reconnects,
+            self.link_drops,
+            self.session_drops,
+            self.failures,
+            self.subscribes,
+            downtime,
+        )
@@ -0,0 +1,223 @@
+###########################
+### Non-blocking SNTP   ###
+###########################
+#
+# SNTP client run as a scheduler task.  Every poll it sends a burst of
+# samples on one non-blocking UDP socket, waits a bounded time for each
+# reply, works out offset and delay from all four timestamps and keeps the
+# sample with the smallest delay.  Small offsets are slewed into the
+# LocalClock a second at a time, big ones are stepped.  The poll interval
+# doubles while the clock stays within tolerance (64 s up to hours) and
+# drops back to the minimum when it does not or a burst fails.
+#
+#   offset = ((t2 - t1) + (t3 - t4)) / 2
+#   delay  = (t4 - t1) - (t3 - t2)
+
+import struct
+import time
+
+from clock_log import default
+
+NTP_EPOCH = 2_208_988_800  # 1900-01-01 to 1970-01-01 in seconds
+
+_IDLE = 0
+_WAIT = 1  # request sent, waiting for the reply
+
+
+def to_ntp(seconds):
+    whole = int(seconds)
+    return whole + NTP_EPOCH, int((seconds - whole) * 4294967296) & 0xFFFFFFFF
+
+
+def from_ntp(packet, offset):
+    whole, fraction = struct.unpack_from("!II", packet, offset)
+    return whole - NTP_EPOCH + fraction / 4294967296
+
+
+class SNTPClient:
+    def __init__(
+        self,
+        pool,
+        server,
+        clock,
+        port=123,
+        samples=4,
+        timeout=1.0,
+        min_poll=64,
+        max_poll=16384,
+        tolerance=1.0,
+        step_limit=2,
+        slew_interval=15,
+        set_rtc=None,
+        monotonic=time.monotonic,
+        log=None,
+    ):
+        self.log = log if log is not None else default()
+        self._pool = pool
+        self._address = (server, port)
+        self._clock = clock  # LocalClock, corrected in place
+        self.samples = samples  # per burst, the one with least delay wins
+        self.timeout = timeout  # seconds to wait for each reply
+        self.min_poll = min_poll
+        self.max_poll = max_poll
+        self.tolerance = tolerance  # offsets below this count as stable (the RTC ticks in whole seconds)
+        self.step_limit = step_limit  # offsets above this are stepped, not slewed
+        self.slew_interval = slew_interval  # seconds per 1 s of slew
+        self._set_rtc = set_rtc  # called with UTC seconds when stepping
+        self._monotonic = monotonic
+        self._packet = bytearray(48)
+        self._sock = None
+        self._state = _IDLE
+        self._burst = []  # (delay, offset) of this burst
+        self._attempts = 0
+        self._base_mono = 0.0
+        self._base_utc = 0
+        self._sent_at = 0.0  # monotonic when the request went out
+        self._t1 = 0.0  # clock time when the request went out
+        self._next_poll = monotonic()
+        self._next_slew = 0.0
+        self.slew = 0  # whole seconds still to slew
+        self.poll = min_poll
+        self.offset = None  # last applied offset and its delay
+        self.delay = None
+        self.synced = False
+        self.sent = 0
+        self.received = 0
+        self.lost = 0
+
+    def _socket(self):
+        if self._sock is None:
+            self._sock = self._pool.socket(self._pool.AF_INET, self._pool.SOCK_DGRAM)
+            self._sock.setblocking(False)
+        return self._sock
+
+    def close(self):
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+
+    # Clock time with sub-second resolution from monotonic
+    def _now(self, mono):
+        return self._base_utc + (mono - self._base_mono)
+
+    def _send(self):
+        packet = self._packet
+        for i in range(48):
+            packet[i] = 0
+        packet[0] = 0b00100011  # no leap warning, version 4, client
+        self._sent_at = self._monotonic()
+        self._t1 = self._now(self._sent_at)
+        struct.pack_into("!II", packet, 40, *to_ntp(self._t1))
+        try:
+            self._socket().sendto(packet, self._address)
+        except OSError as e:
+            self.log.warning("NTP send failed: %s", e)
+            self.close()
+            self._burst_done()
+            return
+        self.sent += 1
+        self._state = _WAIT
+
+    def _receive(self):
+        try:
+            size = self._sock.recv_into(self._packet)
+        except OSError:  # EAGAIN, nothing yet
+            return False
+        mono = self._monotonic()
+        packet = self._packet
+        # must be a server reply to the request we just sent
+        if size < 48 or packet[0] & 0x07 != 4 or struct.unpack_from("!II", packet, 24) != to_ntp(self._t1):
+            return False
+        t2 = from_ntp(packet, 32)
+        t3 = from_ntp(packet, 40)
+        t4 = self._t1 + (mono - self._sent_at)
+        self._burst.append(((t4 - self._t1) - (t3 - t2), ((t2 - self._t1) + (t3 - t4)) / 2))
+        self.received += 1
+        return True
+
+    def _start_burst(self):
+        self._burst = []
+        self._attempts = 1
+        # one clock reading per burst, monotonic supplies the fraction
+        self._base_mono = self._monotonic()
+        self._base_utc = self._clock.utc()
+        self._send()
+
+    def _burst_done(self):
+        self._state = _IDLE
+        if not self._burst:
+            self.poll = self.min_poll
+        else:
+            self.delay, self.offset = min(self._burst)
+            self._apply(self.offset)
+        self._next_poll = self._monotonic() + self.poll
+
+    def _apply(self, offset):
+        if not self.synced or abs(offset) >= self.step_limit:
+            utc = self._clock.utc() + int(round(offset))
+            self.log.info("NTP step %s s", self._clock.discipline(utc))
+            if self._set_rtc is not None:
+                self._set_rtc(utc)
+                self._clock.correction = 0
+            self.slew = 0
+        else:
+            self.slew = int(offset)  # whole seconds, the fraction is below RTC resolution
+        self.synced = True
+        if abs(offset) < self.tolerance:
+            self.poll = min(self.poll * 2, self.max_poll)
+        else:
+            self.poll = self.min_poll
+
+    # Advance the exchange, returns seconds until it wants to run again
+    def step(self):
+        now = self._monotonic()
+        if self._state == _WAIT:
+            if not self._receive():
+                if now - self._sent_at < self.timeout:
+                    return 0.05
+                self.lost += 1
+            if self._attempts < self.samples:
+                self._attempts += 1
+                self._send()
+                return 0.05
+            self._burst_done()
+            now = self._monotonic()
+        if self.slew and now >= self._next_slew:
+            one = 1 if self.slew > 0 else -1
+            self._clock.correction += one
+            self.slew -= one
+            self._next_slew = now + self.slew_interval
+        if now >= self._next_poll:
+            self._start_burst()
+            return 0.05
+        wait = self._next_poll - now
+        if self.slew:
+            wait = min(wait, max(0, self._next_slew - now))
+        return wait
+
+    # Poll on the next step instead of waiting out the interval
+    def resync(self):
+        self._next_poll = self._monotonic()
+
+    # Blocking but bounded sync for boot, True once a burst got a reply
+    def sync(self, limit=5):
+        deadline = self._monotonic() + limit
+        self._next_poll = self._monotonic()
+        self.step()
+        while self._state == _WAIT and self._monotonic() < deadline:
+            time.sleep(0.05)
+            self.step()
+        if self._state == _WAIT:
+            self.lost += 1
+            self._burst_done()
+        return self.synced
+
+    def stats(self):
+        return "offset %s delay %s poll %ds sent %d received %d lost %d" % (
+            self.offset,
+            self.delay,
+            self.poll,
+            self.sent,
+            self.received,
+            self.lost,
+        )
@@ -0,0 +1,118 @@
+#####################################
+### Adaptive update policy        ###
+#####################################
+#
+# Picks how hard the clock works from what it can see.  A tap means
+# someone is looking, so everything runs at full speed for a while.  A
+# dark room means nobody is reading the minutes closely: redraw every few
+# minutes and poll the network and sensors less.  A battery running low
+# off the charger means stretching what is left.
+#
+# Each policy is a row of task periods.  code.py applies the row to its
+# scheduler whenever the policy changes, and every change is printed and
+# kept in a short history for the stats.
+#
+# Precedence is active, low, dark, normal.  Light and battery have some
+# hysteresis so a reading near a threshold does not flap between two.
+
+import time
+
+from clock_log import default
+
+ACTIVE = "active"
+NORMAL = "normal"
+DARK = "dark"
+LOW = "low"
+
+# Periods in seconds for each task, display in minutes between redraws.
+# None (or a missing entry) keeps the preference from code.py, so normal
+# is the clock as configured.
+POLICIES = {
+    ACTIVE: {"display": 1},
+    NORMAL: {"display": 1},
+    DARK: {"display": 5, "mqtt": 5, "udp": 2, "tap": 0.5, "sensors": 60, "housekeeping": 30},
+    LOW: {"display": 5, "mqtt": 30, "udp": 5, "tap": 1, "sensors": 120, "housekeeping": 60},
+}
+
+HISTORY = 8  # policy changes kept for stats
+
+
+class Policy:
+    # defaults are code.py's periods, e.g. {"display": 1, "mqtt": mqtt_poll, ...}
+    def __init__(
+        self,
+        defaults,
+        table=POLICIES,
+        dark=3,
+        low_battery=3.8,
+        active_for=120,
+        light_margin=2,
+        battery_margin=0.05,
+        monotonic=time.monotonic,
+        log=None,
+    ):
+        self.log = log if log is not None else default()
+        self._defaults = defaults
+        self._table = table
+        self.dark = dark  # light percent at or below which the room is dark
+        self.low_battery = low_battery  # volts below which the battery is low
+        self.active_for = active_for  # seconds of full speed after a tap
+        self.light_margin = light_margin  # percent above dark before it is light again
+        self.battery_margin = battery_margin  # volts above low_battery before it is fine again
+        self._monotonic = monotonic
+        self.name = NORMAL
+        self.settings = self.resolve(NORMAL)
+        self.since = monotonic()
+        self.last_tap = None
+        self.changes = 0
+        self.time_in = {}  # seconds in each policy, up to the last change
+        self.history = []  # (monotonic, old, new, reason) of the last HISTORY changes
+
+    # The periods for a policy, with the defaults filled in
+    def resolve(self, name):
+        settings = dict(self._defaults)
+        for key, value in self._table.get(name, {}).items():
+            if value is not None:
+                settings[key] = value
+        return settings
+
+    def tapped(self):
+        self.last_tap = self._monotonic()
+
+    # The policy for these readings and why, without changing anything
+    def choose(self, light_pc, battery, charging):
+        if self.last_tap is not None and self._monotonic() - self.last_tap < self.active_for:
+            return ACTIVE, "tap"
+        low = self.low_battery + (self.battery_margin if self.name == LOW else 0)
+        if not charging and battery < low:
+            return LOW, "battery %.2fv" % battery
+        dark = self.dark + (self.light_margin if self.name == DARK else 0)
+        if light_pc <= dark:
+            return DARK, "light %d%%" % light_pc
+        return NORMAL, "light %d%% battery %.2fv" % (light_pc, battery)
+
+    # Switch if the readings call for another policy, returns the new
+    # settings or None if nothing changed
+    def update(self, light_pc, battery, charging):
+        name, reason = self.choose(light_pc, battery, charging)
+        if name == self.name:
+            return None
+        now = self._monotonic()
+        self.time_in[self.name] = self.time_in.get(self.name, 0) + now - self.since
+        self.log.info("Policy %s -> %s (%s)", self.name, name, reason)
+        self.history.append((now, self.name, name, reason))
+        if len(self.history) > HISTORY:
+            self.history.pop(0)
+        self.name = name
+        self.settings = self.resolve(name)
+        self.since = now
+        self.changes += 1
+        return self.settings
+
+    def stats(self):
+        now = self._monotonic()
+        spent = " ".join(
+            "%s %dm" % (name, (self.time_in.get(name, 0) + (now - self.since if name == self.name else 0)) // 60)
+            for name in (ACTIVE, NORMAL, DARK, LOW)
+        )
+        return "%s changes %d %s" % (self.name, self.changes, spent)
@@ -0,0 +1,108 @@
+#################################
+### Per-phase loop profiler   ###
+#################################
+#
+# Times each phase of the loop (MQTT, UDP, NTP, display, chime, tap, gc)
+# and tracks how much heap it allocates, all in fixed-size arrays so the
+# profiler itself does not grow or fragment the heap.  Phases are
+# inclusive: the gc the UDP stats command forces counts in udp and gc.
+# chime is the tone task stepping through notes (chime, tap and boot
+# sounds alike), display and tap only queue them and return.
+#
+# snapshot() is one compact line for the clock/<mac>/stats topic:
+#   up=3600 free=81920 minfree=80128 peak=121344 cur=- refresh=61 ...
+#   |mqtt=3596,412,3,18432,512|udp=7192,...
+# with runs, total ms, max ms, bytes allocated and max bytes per phase.
+
+import gc
+import time
+from array import array
+
+PHASES = ("mqtt", "udp", "ntp", "display", "chime", "tap", "sensors", "gc")
+
+
+class Profiler:
+    def __init__(self, phases=PHASES, monotonic_ns=time.monotonic_ns):
+        self.phases = phases
+        self._monotonic_ns = monotonic_ns
+        count = len(phases)
+        self.runs = array("L", [0] * count)
+        self.total_ms = array("L", [0] * count)
+        self.max_ms = array("L", [0] * count)
+        self.alloc = array("L", [0] * count)  # bytes allocated, summed
+        self.max_alloc = array("L", [0] * count)
+        self.current = -1  # phase running now, -1 for none
+        self.start = monotonic_ns()
+        self.peak = 0  # heap high-water mark seen at phase ends
+        self.min_free = gc.mem_free()
+
+    # Wrap fn so every call is measured as phase name
+    def wrap(self, name, fn):
+        index = self.phases.index(name)
+
+        def measured(*args):
+            outer = self.current
+            self.current = index
+            alloc = gc.mem_alloc()
+            start = self._monotonic_ns()
+            try:
+                return fn(*args)
+            finally:
+                self._record(index, self._monotonic_ns() - start, gc.mem_alloc() - alloc)
+                self.current = outer
+
+        return measured
+
+    # totals wrap at 32 bits like a hardware counter instead of overflowing
+    def _record(self, index, ns, allocated):
+        ms = ns // 1_000_000
+        self.runs[index] = (self.runs[index] + 1) & 0xFFFFFFFF
+        self.total_ms[index] = (self.total_ms[index] + ms) & 0xFFFFFFFF
+        if ms > self.max_ms[index]:
+            self.max_ms[index] = ms
+        # a collection inside the phase makes the delta negative, count it as 0
+        if allocated > 0:
+            self.alloc[index] = (self.alloc[index] + allocated) & 0xFFFFFFFF
+            if allocated > self.max_alloc[index]:
+                self.max_alloc[index] = allocated
+        used = gc.mem_alloc()
+        if used > self.peak:
+            self.peak = used
+        free = gc.mem_free()
+        if free < self.min_free:
+            self.min_free = free
+
+    def uptime(self):
+        return (self._monotonic_ns() - self.start) // 1_000_000_000
+
+    # Compact line for MQTT, extra is appended to the header (e.g. refresh counts)
+    def snapshot(self, extra=""):
+        parts = [
+            "up=%d free=%d minfree=%d peak=%d cur=%s"
+            % (
+                self.uptime(),
+                gc.mem_free(),
+                self.min_free,
+                self.peak,
+                self.phases[self.current] if self.current >= 0 else "-",
+            )
+        ]
+        if extra:
+            parts[0] += " " + extra
+        for i, name in enumerate(self.phases):
+            parts.append(
+                "%s=%d,%d,%d,%d,%d"
+                % (name, self.runs[i], self.total_ms[i], self.max_ms[i], self.alloc[i], self.max_alloc[i])
+            )
+        return "|".join(parts)
+
+    # Readable version for the serial console and the UDP stats command
+    def stats(self):
+        lines = ["up %ds free %d min %d peak %d" % (self.uptime(), gc.mem_free(), self.min_free, self.peak)]
+        for i, name in enumerate(self.phases):
+            if self.runs[i]:
+                lines.append(
+                    "%s: runs %d %dms max %dms alloc %d max %d"
+                    % (name, self.runs[i], self.total_ms[i], self.max_ms[i], self.alloc[i], self.max_alloc[i])
+                )
+        return "\n    ".join(lines)
@@ -0,0 +1,122 @@
+#####################################
+### Partial refresh scheduler     ###
+#####################################
+#
+# Chooses between a fast partial update of just the changed areas and a
+# full refresh of the panel.  A minute usually changes a digit of the time
+# and a sensor reading or two, so most frames can take the fast path, but
+# partial updates leave ghosting behind, so after full_every of them (or
+# at a quiet time like the day/night switch, see clean()) the next one is
+# a full refresh.  Areas adding up to more than max_area of the screen, or
+# of unknown size, get a full refresh too.
+#
+# Areas are (x, y, width, height) boxes.  Changes far apart are kept as
+# separate boxes (merge()), one box around the time and the battery label
+# would be most of the screen.
+#
+# full() and partial(areas) do the drawing, partial is one fast update
+# for all the boxes.  The e-ink driver that ships with the MagTag
+# (displayio's EPaperDisplay) only runs the full waveform: it already
+# sends just the dirty area over SPI but redraws the whole panel, so
+# without a driver that has a fast windowed update partial is None and
+# every frame is full.  The changed areas are still counted so the stats
+# show what a partial mode would cover.
+
+
+# Smallest box holding both, either can be None
+def union(a, b):
+    if a is None:
+        return b
+    if b is None:
+        return a
+    x = min(a[0], b[0])
+    y = min(a[1], b[1])
+    return (x, y, max(a[0] + a[2], b[0] + b[2]) - x, max(a[1] + a[3], b[1] + b[3]) - y)
+
+
+def overlap(a, b):
+    return a[0] < b[0] + b[2] and b[0] < a[0] + a[2] and a[1] < b[1] + b[3] and b[1] < a[1] + a[3]
+
+
+# Add box to a list of boxes, joined with any it overlaps
+def merge(areas, box):
+    if box is None or not box[2] or not box[3]:
+        return areas
+    i = 0
+    while i < len(areas):
+        if overlap(areas[i], box):
+            box = union(box, areas.pop(i))
+            i = 0  # the bigger box can reach boxes already passed
+        else:
+            i += 1
+    areas.append(box)
+    return areas
+
+
+class RefreshScheduler:
+    def __init__(self, width, height, full, partial=None, full_every=10, max_area=0.5):
+        self.width = width
+        self.height = height
+        self._full = full
+        self._partial = partial
+        self.full_every = full_every  # partial updates between full refreshes
+        self.max_area = max_area  # share of the screen above which a full refresh is better
+        self.since_full = 0  # partial updates since the last full refresh
+        self._clean = False
+        # counters
+        self.fulls = 0
+        self.partials = 0
+        self.cleans = 0  # full refreshes to clear ghosting
+        self.pixels = 0  # pixels in the changed areas, all frames
+        self.last = None  # areas of the last frame, None for a full one
+
+    # A full refresh with the next frame, e.g. at invert_start / invert_stop
+    def clean(self):
+        if self.since_full:
+            self._clean = True
+
+    # Draw a frame that changed areas, None = everything
+    def refresh(self, areas=None):
+        if areas is not None:
+            areas = [box for box in (self._clip(box) for box in areas) if box[2] and box[3]]
+        pixels = self.width * self.height if areas is None else sum(box[2] * box[3] for box in areas)
+        self.pixels += pixels
+        if areas is not None and not areas:
+            return False  # nothing moved, e.g. a label set to what it showed
+        if (
+            self._partial is None
+            or areas is None
+            or self._clean
+            or self.since_full >= self.full_every
+            or pixels > self.max_area * self.width * self.height
+        ):
+            if self._clean or self.since_full >= self.full_every:
+                self.cleans += 1
+            self._full()
+            self.fulls += 1
+            self.since_full = 0
+            self._clean = False
+            self.last = None
+            return True
+        self._partial(areas)
+        self.partials += 1
+        self.since_full += 1
+        self.last = areas
+        return True
+
+    def _clip(self, box):
+        x = max(0, box[0])
+        y = max(0, box[1])
+        right = min(self.width, box[0] + box[2])
+        bottom = min(self.height, box[1] + box[3])
+        return (x, y, max(0, right - x), max(0, bottom - y))
+
+    def stats(self):
+        frames = self.fulls + self.partials
+        return "full %d partial %d cleans %d since full %d mean area %d px" % (
+            self.fulls,
+            self.partials,
+            self.cleans,
+            self.since_full,
+            self.pixels // frames if frames else 0,
+        )
@@ -0,0 +1,63 @@
+#################################
+### Cached, smoothed sensors  ###
+#################################
+#
+# Reads the light sensor and battery voltage once per sample into small
+# array-backed ring buffers and keeps one snapshot (smoothed values,
+# percentages and the charging flag) that every reader in a frame shares.
+
+import time
+from array import array
+
+LIGHT_MIN = 556  # My Light sensor range 556-52487
+LIGHT_MAX = 52487
+BATT_EMPTY = 3.71  # volts shown as 0%
+BATT_FULL = 4.175  # volts shown as 100%, above this it is on the charger
+
+
+class SensorSampler:
+    def __init__(self, peripherals, size=8, period=10, monotonic=time.monotonic):
+        self._peripherals = peripherals
+        self._monotonic = monotonic
+        self.period = period  # seconds between readings
+        self._light = array("H", [0] * size)
+        self._battery = array("f", [0.0] * size)
+        self._size = size
+        self._pos = 0
+        self._count = 0
+        self._last = None
+        self.samples = 0
+        # the shared snapshot
+        self.light = 0
+        self.battery = 0.0
+        self.light_pc = 0
+        self.batt_pc = 0
+        self.charging = False
+        self.raw_light = 0  # the last reading, unsmoothed
+        self.raw_battery = 0.0
+
+    # Take a reading if period has passed (or force), returns True if it did
+    def sample(self, force=False):
+        now = self._monotonic()
+        if not force and self._last is not None and now - self._last < self.period:
+            return False
+        self._last = now
+        self.raw_light = self._peripherals.light
+        self.raw_battery = self._peripherals.battery
+        self._light[self._pos] = self.raw_light
+        self._battery[self._pos] = self.raw_battery
+        self._pos = (self._pos + 1) % self._size
+        if self._count < self._size:
+            self._count += 1
+        self.samples += 1
+        light = 0
+        battery = 0.0
+        for i in range(self._count):
+            light += self._light[i]
+            battery += self._battery[i]
+        self.light = light // self._count
+        self.battery = battery / self._count
+        self.light_pc = int(round(100 * (self.light - LIGHT_MIN) / (LIGHT_MAX - LIGHT_MIN), 0))
+        self.batt_pc = int(round(100 * (self.battery - BATT_EMPTY) / (BATT_FULL - BATT_EMPTY), 0))
+        self.charging = self.batt_pc > 100
+        return True
@@ -0,0 +1,107 @@
+##########################################
+### Deep sleep duty cycle state        ###
+##########################################
+#
+# Between minutes the board deep sleeps with a time alarm.  The little state
+# that has to survive (what is on the screen, chime/tap state and the clock
+# discipline) is packed into alarm.sleep_memory and restored on wake so the
+# screen can be redrawn without touching the network.
+#
+# Every resync wakes the normal networked boot runs instead, to fetch NTP.
+
+import struct
+
+_MAGIC = b"MTC1"
+# magic, minute shown, hour shown, tap counter, inverted, wakes, correction, last sync, drift
+_HEADER = "<4sIbBBHiIf"
+_HEADER_SIZE = struct.calcsize(_HEADER)
+
+# plan() results
+DRAW = 0  # a new minute, draw it
+WAIT = 1  # woke before the minute turned, sleep again
+RESYNC = 2  # time for a networked boot
+
+
+class SleepState:
+    def __init__(self, labels):
+        self.minute = 0  # local minute number (local seconds // 60) last drawn
+        self.hour = 25  # hour last drawn, for the chime
+        self.tap_counter = 0
+        self.inverted = 0
+        self.wakes = 0  # warm wakes since the last networked boot
+        self.correction = 0  # LocalClock state
+        self.last_sync = 0
+        self.drift = 0.0
+        self.texts = [""] * labels
+
+    # Pack into sleep memory, returns the bytes used
+    def save(self, memory):
+        data = bytearray(
+            struct.pack(
+                _HEADER,
+                _MAGIC,
+                self.minute,
+                self.hour,
+                self.tap_counter,
+                self.inverted,
+                self.wakes,
+                self.correction,
+                self.last_sync,
+                self.drift,
+            )
+        )
+        for text in self.texts:
+            encoded = text.encode("utf-8")[:255]
+            data.append(len(encoded))
+            data.extend(encoded)
+        memory[0 : len(data)] = data
+        return len(data)
+
+    # Unpack from sleep memory, False if it holds nothing of ours
+    def load(self, memory):
+        if bytes(memory[0:4]) != _MAGIC:
+            return False
+        (
+            _,
+            self.minute,
+            self.hour,
+            self.tap_counter,
+            self.inverted,
+            self.wakes,
+            self.correction,
+            self.last_sync,
+            self.drift,
+        ) = struct.unpack(_HEADER, bytes(memory[0:_HEADER_SIZE]))
+        offset = _HEADER_SIZE
+        for i in range(len(self.texts)):
+            length = memory[offset]
+            self.texts[i] = str(bytes(memory[offset + 1 : offset + 1 + length]), "utf-8")
+            offset += 1 + length
+        return True
+
+    def invalidate(self, memory):
+        memory[0:4] = b"\x00\x00\x00\x00"
+
+    # What to do on a wake at local time (seconds)
+    def plan(self, local, resync):
+        if local // 60 == self.minute:
+            return WAIT
+        if resync and self.wakes >= resync:
+            return RESYNC
+        return DRAW
+
+    def capture_clock(self, clock):
+        self.correction = clock.correction
+        self.last_sync = clock.last_sync or 0
+        self.drift = clock.drift
+
+    def restore_clock(self, clock):
+        clock.correction = self.correction
+        clock.last_sync = self.last_sync or None
+        clock.drift = self.drift
+
+
+# Seconds to sleep from local time (seconds) to the next minute boundary.
+# local is whole seconds (rounded down) so this never lands early.
+def seconds_to_boundary(local):
+    return 60 - local % 60
@@ -0,0 +1,87 @@
+######################################
+### Interrupt driven tap detection ###
+######################################
+#
+# The LIS3DH can route its click interrupt to INT1, which the MagTag wires
+# to board.ACCELEROMETER_INTERRUPT, and latch it there until CLICK_SRC is
+# read.  Instead of reading CLICK_SRC over I2C on every check, look at the
+# pin (a GPIO read) and only read CLICK_SRC, which clears the latch, once
+# it is high.  Because the latch holds the pin high, a PinAlarm on it wakes
+# the board from light or deep sleep as soon as it is tapped, and a tap
+# that came in while the board was busy is not lost.
+
+import digitalio
+
+try:
+    import alarm
+except ImportError:
+    alarm = None
+
+CTRL_REG3 = 0x22
+CLICK_SRC = 0x39
+CLICK_THS = 0x3A
+I1_CLICK = 0x80  # CTRL_REG3: click interrupt on INT1
+LIR_CLICK = 0x80  # CLICK_THS: keep INT1 high until CLICK_SRC is read
+CLICK_IA = 0x40  # CLICK_SRC: a click happened
+
+
+class TapInterrupt:
+    # lis is an adafruit_lis3dh driver with taps already set up by set_tap()
+    def __init__(self, lis, pin):
+        self._lis = lis
+        self._pin = pin
+        self._input = None  # DigitalInOut, released while a PinAlarm has the pin
+        self.checks = 0  # pin reads
+        self.reads = 0  # CLICK_SRC reads over I2C
+        self.taps = 0
+        self.wakes = 0  # sleeps ended by a tap
+        self.latch()
+
+    # Route clicks to INT1 and latch them, then clear anything left over
+    def latch(self):
+        self._write_bits(CTRL_REG3, I1_CLICK)
+        self._write_bits(CLICK_THS, LIR_CLICK)
+        self.clear()
+
+    def _write_bits(self, register, bits):
+        value = self._lis._read_register_byte(register)
+        if value & bits != bits:
+            self._lis._write_register_byte(register, value | bits)
+
+    # True while INT1 is latched high
+    @property
+    def pending(self):
+        if self._input is None:
+            self._input = digitalio.DigitalInOut(self._pin)
+            self._input.direction = digitalio.Direction.INPUT
+        self.checks += 1
+        return self._input.value
+
+    # Read CLICK_SRC, which releases INT1, returns True if it was a tap
+    def clear(self):
+        self.reads += 1
+        return self._lis._read_register_byte(CLICK_SRC) & CLICK_IA > 0
+
+    # True once per tap, only touches I2C if the pin is high
+    def poll(self):
+        if not self.pending or not self.clear():
+            return False
+        self.taps += 1
+        return True
+
+    # A PinAlarm that fires while INT1 is high, for light or deep sleep
+    def alarm(self):
+        if self._input is not None:
+            self._input.deinit()  # a PinAlarm needs the pin to itself
+            self._input = None
+        return alarm.pin.PinAlarm(pin=self._pin, value=True, pull=False)
+
+    # True if the alarm that ended a sleep was ours
+    def woke(self, wake_alarm):
+        if wake_alarm is None or alarm is None or not isinstance(wake_alarm, alarm.pin.PinAlarm):
+            return False
+        self.wakes += 1
+        return True
+
+    def stats(self):
+        return "checks %d reads %d taps %d wakes %d" % (self.checks, self.reads, self.taps, self.wakes)
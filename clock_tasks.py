@@ -0,0 +1,121 @@
+#####################################
+### Cooperative deadline scheduler ###
+#####################################
+#
+# One task per subsystem, each with its own deadline instead of counting
+# loop iterations.  Between deadlines the scheduler hands the remaining
+# time to an idle function, which sleeps or waits on I/O (e.g. the MQTT
+# socket) and may return early.  Keeps run counts and run time per task.
+#
+# A task function can return a number of seconds to override when it runs
+# next.  One-shot tasks (no period) are dropped after running unless they
+# return a delay.
+
+import time
+
+
+class Task:
+    def __init__(self, name, fn, period, deadline):
+        self.name = name
+        self.fn = fn
+        self.period = period
+        self.deadline = deadline
+        self.runs = 0
+        self.run_time = 0.0  # seconds spent in fn
+        self.max_time = 0.0
+
+
+class Scheduler:
+    def __init__(self, idle=time.sleep, monotonic=time.monotonic, max_idle=5):
+        self._idle = idle
+        self._monotonic = monotonic
+        self.max_idle = max_idle  # upper bound on one idle call, e.g. for the watchdog
+        self.tasks = []
+        self.wakes = 0
+        self.idle_time = 0.0
+
+    # Run fn every period seconds, the first time after delay
+    def every(self, name, period, fn, delay=0):
+        task = Task(name, fn, period, self._monotonic() + delay)
+        self.tasks.append(task)
+        return task
+
+    # Run fn once after delay seconds, replacing a pending task of that name
+    def call_later(self, name, delay, fn):
+        task = self.find(name)
+        if task is None:
+            task = Task(name, fn, None, 0)
+            self.tasks.append(task)
+        task.fn = fn
+        task.deadline = self._monotonic() + delay
+        return task
+
+    def find(self, name):
+        for task in self.tasks:
+            if task.name == name:
+                return task
+        return None
+
+    # Make a task due now
+    def wake(self, name):
+        task = self.find(name)
+        if task is not None:
+            task.deadline = self._monotonic()
+        return task is not None
+
+    # Change a task's period, a shorter one takes effect straight away
+    def set_period(self, name, period):
+        task = self.find(name)
+        if task is not None:
+            task.period = period
+            task.deadline = min(task.deadline, self._monotonic() + period)
+        return task is not None
+
+    def cancel(self, name):
+        task = self.find(name)
+        if task is not None:
+            self.tasks.remove(task)
+        return task is not None
+
+    # Run everything that is due, returns seconds until the next deadline
+    def run_due(self):
+        now = self._monotonic()
+        for task in self.tasks[:]:
+            if task.deadline > now:
+                continue
+            start = self._monotonic()
+            delay = task.fn()
+            end = self._monotonic()
+            task.runs += 1
+            task.run_time += end - start
+            task.max_time = max(task.max_time, end - start)
+            if delay is not None:
+                task.deadline = end + delay
+            elif task.period is not None:
+                # keep to the period's grid, skipping deadlines already missed
+                task.deadline += task.period
+                if task.deadline <= end:
+                    task.deadline = end + task.period
+            elif task in self.tasks:
+                self.tasks.remove(task)
+            now = end
+        if not self.tasks:
+            return self.max_idle
+        return max(0, min(task.deadline for task in self.tasks) - self._monotonic())
+
+    def run(self):
+        while True:
+            wait = min(self.run_due(), self.max_idle)
+            start = self._monotonic()
+            self._idle(wait)
+            self.idle_time += self._monotonic() - start
+            self.wakes += 1
+
+    def stats(self):
+        lines = ["wakes %d idle %.1fs" % (self.wakes, self.idle_time)]
+        for task in self.tasks:
+            lines.append(
+                "%s: runs %d time %.3fs max %.3fs"
+                % (task.name, task.runs, task.run_time, task.max_time)
+            )
+        return "\n    ".join(lines)
@@ -0,0 +1,153 @@
+#####################################
+### Batched telemetry             ###
+#####################################
+#
+# Light, battery, taps and uptime for fleet monitoring in as little
+# airtime as possible.  sample() appends a record to a preallocated batch
+# buffer with only the metrics that moved by more than their deadband
+# since the last value recorded, and no record at all if none did.  The
+# first record of a batch has them all, so every batch decodes on its own.
+# close() seals the batch into a bounded backlog and publish() sends the
+# backlog oldest first, one MQTT message per batch.  A batch only leaves
+# the backlog once the client's on_publish callback confirms it
+# (confirm()), so batches wait out a short broker outage.  Past backlog
+# batches the oldest is dropped.
+#
+# Payload, little-endian:
+#   header  <BIIB  version, UTC of the first record, uptime then, records
+#   record  <HB    seconds after the first record, bitmask of metrics sent
+#           <H     each metric sent, in METRICS order, scaled
+#
+# decode() turns a payload back into full rows, on the host too.
+
+import struct
+
+VERSION = 1
+
+# (name, scale to a 16 bit integer, deadband in scaled units)
+METRICS = (
+    ("light", 1, 500),  # raw reading
+    ("battery", 1000, 20),  # mV
+    ("taps", 1, 0),  # since boot
+)
+
+_HEADER = "<BIIB"
+_HEADER_SIZE = struct.calcsize(_HEADER)
+_RECORD = "<HB"
+_RECORD_SIZE = struct.calcsize(_RECORD)
+
+
+class Telemetry:
+    def __init__(self, metrics=METRICS, size=256, backlog=16):
+        self._metrics = metrics
+        self._buffer = bytearray(size)
+        self._used = 0
+        self._records = 0
+        self._base = 0  # UTC of the batch's first record
+        self._uptime = 0
+        self._last = [0] * len(metrics)  # scaled values last recorded
+        self._max_backlog = backlog
+        self._sending = None  # the payload given to the client, until on_publish
+        self.backlog = []  # sealed payloads, oldest first
+        # counters
+        self.samples = 0
+        self.suppressed = 0  # values inside their deadband, not sent
+        self.batches = 0
+        self.published = 0
+        self.dropped = 0  # batches lost off the end of the backlog
+        self.bytes = 0  # payload bytes published
+
+    # Record one sample, values in METRICS order and units
+    def sample(self, utc, uptime, values):
+        scaled = [min(max(int(round(value * metric[1])), 0), 0xFFFF) for value, metric in zip(values, self._metrics)]
+        size = _RECORD_SIZE + 2 * len(scaled)  # room for a full record
+        # A clock stepped back or too far on can't be an offset, a new batch starts there
+        if self._records and (utc < self._base or utc - self._base > 0xFFFF or self._records == 255 or self._used + size > len(self._buffer)):
+            self.close()
+        if not self._records:
+            self._base = utc
+            self._uptime = int(uptime)
+            self._used = _HEADER_SIZE
+        mask = 0
+        for i in range(len(scaled)):
+            if not self._records or abs(scaled[i] - self._last[i]) > self._metrics[i][2]:
+                mask |= 1 << i
+            else:
+                self.suppressed += 1
+        self.samples += 1
+        if not mask:
+            return  # nothing moved, the next record's time covers it
+        struct.pack_into(_RECORD, self._buffer, self._used, utc - self._base, mask)
+        self._used += _RECORD_SIZE
+        for i in range(len(scaled)):
+            if mask & 1 << i:
+                struct.pack_into("<H", self._buffer, self._used, scaled[i])
+                self._used += 2
+                self._last[i] = scaled[i]
+        self._records += 1
+
+    # Seal the batch into the backlog, returns False if it was empty
+    def close(self):
+        if not self._records:
+            return False
+        struct.pack_into(_HEADER, self._buffer, 0, VERSION, self._base, self._uptime, self._records)
+        self.backlog.append(bytes(self._buffer[: self._used]))
+        self.batches += 1
+        if len(self.backlog) > self._max_backlog:
+            self.backlog.pop(0)
+            self.dropped += 1
+        self._records = 0
+        self._used = 0
+        return True
+
+    # Publish the backlog oldest first with QoS 1, stops at the first batch
+    # on_publish did not confirm.  Client errors are left to the caller.
+    def publish(self, client, topic):
+        sent = 0
+        while self.backlog:
+            self._sending = self.backlog[0]
+            client.publish(topic, self._sending, qos=1)
+            if self._sending is not None:
+                break
+            sent += 1
+        return sent
+
+    # From the MQTT client's on_publish for our topic
+    def confirm(self):
+        if self._sending is None or not self.backlog or self.backlog[0] is not self._sending:
+            return
+        self.backlog.pop(0)
+        self.published += 1
+        self.bytes += len(self._sending)
+        self._sending = None
+
+    def stats(self):
+        return "samples %d suppressed %d batches %d published %d backlog %d dropped %d bytes %d" % (
+            self.samples,
+            self.suppressed,
+            self.batches,
+            self.published,
+            len(self.backlog),
+            self.dropped,
+            self.bytes,
+        )
+
+
+# (uptime at the first record, [(utc, {name: value})]) from a payload,
+# values not in a record carried over from the one before
+def decode(payload, metrics=METRICS):
+    version, base, uptime, count = struct.unpack_from(_HEADER, payload, 0)
+    if version != VERSION:
+        raise ValueError("telemetry version %d" % version)
+    offset = _HEADER_SIZE
+    values = {}
+    rows = []
+    for _ in range(count):
+        seconds, mask = struct.unpack_from(_RECORD, payload, offset)
+        offset += _RECORD_SIZE
+        for i, (name, scale, _) in enumerate(metrics):
+            if mask & 1 << i:
+                values[name] = struct.unpack_from("<H", payload, offset)[0] / scale
+                offset += 2
+        rows.append((base + seconds, dict(values)))
+    return uptime, rows
@@ -0,0 +1,80 @@
+#################################
+### Day / night theme         ###
+#################################
+#
+# The background and the digit atlases share palettes owned by the theme,
+# so switching between day and night is a couple of palette writes
+# instead of a new background bitmap and a recolour of every label.  The
+# current theme is remembered and applying the same one again does
+# nothing.  The MagTag text labels keep their own palettes and are
+# recoloured through the renderer, which also skips unchanged colours.
+
+import displayio
+
+DAY = (0x000000, 0xFFFFFF)  # (text, background)
+NIGHT = (0xFFFFFF, 0x000000)
+
+
+# Night from start up to (not including) stop, across midnight if start > stop.
+# With start 18 and stop 6 hour 18 is night and hour 6 is day.
+def is_night_hour(hour, start, stop):
+    if start > stop:
+        return hour >= start or hour < stop
+    return start <= hour < stop
+
+
+# Seconds from local (seconds since the epoch, local time) to the next
+# start or stop hour, at most limit so DST changes and clock steps are
+# picked up
+def seconds_to_change(local, start, stop, limit=3600):
+    of_day = local % 86400
+    delay = limit
+    for hour in (start, stop):
+        delay = min(delay, (hour * 3600 - of_day - 1) % 86400 + 1)
+    return delay
+
+
+class Theme:
+    def __init__(self, magtag, renderer, count, day=DAY, night=NIGHT):
+        self._renderer = renderer
+        self._count = count
+        self._day = day
+        self._night = night
+        # text palette, 0 is transparent like a Label's
+        self.palette = displayio.Palette(2)
+        self.palette.make_transparent(0)
+        self.palette[1] = day[0]
+        # full screen background, one colour at 1 bit per pixel
+        display = magtag.graphics.display
+        self._background = displayio.Palette(1)
+        self._background[0] = day[1]
+        bitmap = displayio.Bitmap(display.width, display.height, 1)
+        # MagTag's own background (white by default) is in splash[0] and
+        # would cover this one, so it goes and ours takes its place
+        magtag.graphics.set_background(None)
+        magtag.splash.insert(0, displayio.TileGrid(bitmap, pixel_shader=self._background))
+        self.night = None  # None until applied, then True or False
+        self.changes = 0
+        self.skipped = 0
+
+    # Switch to the night or day theme, returns True if anything changed
+    def apply(self, night):
+        if night == self.night:
+            self.skipped += 1
+            return False
+        text, background = self._night if night else self._day
+        self.palette[1] = text
+        self._background[0] = background
+        for i in range(self._count):
+            self._renderer.set_color(i, text)  # only the labels with their own palette
+        self._renderer.touch()
+        self.night = night
+        self.changes += 1
+        return True
+
+    def stats(self):
+        return "theme %s changes %d skipped %d" % (
+            "night" if self.night else "day",
+            self.changes,
+            self.skipped,
+        )
@@ -0,0 +1,157 @@
+#############################
+### Local timekeeping     ###
+#############################
+#
+# Formats the clock fields from the RTC instead of waiting for MQTT pushes.
+# The RTC keeps UTC; tz_offset and optional DST rules are applied here.
+# NTP and MQTT are only used now and then to discipline the drift.
+#
+# Date maths is done on plain seconds (no time.localtime) so it behaves the
+# same on CircuitPython and on a host with any timezone set.
+
+import time
+
+DAYS = ("Sun", "Mon", "Tue", "Wed", "Thu", "Fri", "Sat")
+MONTHS = ("Jan", "Feb", "Mar", "Apr", "May", "Jun", "Jul", "Aug", "Sep", "Oct", "Nov", "Dec")
+
+# DST rules: (start month, start Sunday, start hour, end month, end Sunday, end hour, save seconds)
+# Sunday is 1-4 for the nth Sunday of the month or 5 for the last one.  Hours
+# are local standard time.  Start after end means southern hemisphere.
+DST_EU = (3, 5, 2, 10, 5, 2, 3600)  # Central European Time, 01:00 UTC both ways
+DST_US = (3, 2, 2, 11, 1, 1, 3600)
+DST_AU = (10, 1, 2, 4, 1, 2, 3600)  # NSW, VIC, ACT, TAS (not QLD)
+
+
+# Everything the display needs to know about the current time
+class TimeFields:
+    def __init__(self):
+        self.time = "00:00"
+        self.date = "00.00.00"
+        self.dowa = "xxx"  # Day of Week abbreviations Mon/Tue/Wed etc.
+        self.day = "00"
+        self.moya = "xxx"  # Month of Year abbreviations Jan/Feb/Mar etc.
+        self.year2 = "00"
+        self.month = "00"
+        self.hour = 0
+        self.days = None  # local day number the date fields are for
+
+    def __str__(self):
+        return "%s %s %s.%s.%s" % (self.time, self.dowa, self.day, self.month, self.year2)
+
+
+# Days since 1970-01-01 to (year, month, day), proleptic Gregorian
+def civil_from_days(days):
+    days += 719468
+    era = days // 146097
+    doe = days - era * 146097
+    yoe = (doe - doe // 1460 + doe // 36524 - doe // 146096) // 365
+    doy = doe - (365 * yoe + yoe // 4 - yoe // 100)
+    mp = (5 * doy + 2) // 153
+    day = doy - (153 * mp + 2) // 5 + 1
+    month = mp + 3 if mp < 10 else mp - 9
+    return yoe + era * 400 + (1 if month <= 2 else 0), month, day
+
+
+# (year, month, day) to days since 1970-01-01
+def days_from_civil(year, month, day):
+    year -= 1 if month <= 2 else 0
+    era = year // 400
+    yoe = year - era * 400
+    doy = (153 * (month + (-3 if month > 2 else 9)) + 2) // 5 + day - 1
+    doe = yoe * 365 + yoe // 4 - yoe // 100 + doy
+    return era * 146097 + doe - 719468
+
+
+# Weekday of a day number, 0 = Sunday
+def weekday(days):
+    return (days + 4) % 7
+
+
+# Day number of the nth (5 = last) Sunday of a month
+def nth_sunday(year, month, n):
+    if n >= 5:
+        next_month = days_from_civil(year + month // 12, month % 12 + 1, 1)
+        return next_month - 1 - weekday(next_month - 1)
+    first = days_from_civil(year, month, 1)
+    return first + (7 - weekday(first)) % 7 + 7 * (n - 1)
+
+
+# True if DST is in force at a local standard time (in seconds)
+def dst_active(rule, standard):
+    start_month, start_n, start_hour, end_month, end_n, end_hour, _ = rule
+    year = civil_from_days(standard // 86400)[0]
+    start = nth_sunday(year, start_month, start_n) * 86400 + start_hour * 3600
+    end = nth_sunday(year, end_month, end_n) * 86400 + end_hour * 3600
+    if start < end:
+        return start <= standard < end
+    return standard >= start or standard < end
+
+
+class LocalClock:
+    def __init__(self, tz_offset, dst=None, now=time.time):
+        self.tz_offset = tz_offset
+        self.dst = dst
+        self._now = now  # RTC seconds (UTC); any callable for tests
+        self.correction = 0  # seconds added to the RTC reading
+        self.last_sync = None  # UTC of the last discipline
+        self.drift = 0.0  # seconds per day since the sync before
+        self.syncs = 0
+        self.minute = None  # local minute number last filled in by update()
+
+    def utc(self):
+        return int(self._now()) + self.correction
+
+    # Local wall clock seconds with tz_offset and DST applied
+    def local(self, utc=None):
+        standard = (self.utc() if utc is None else utc) + self.tz_offset
+        if self.dst is not None and dst_active(self.dst, standard):
+            return standard + self.dst[6]
+        return standard
+
+    # Fill a TimeFields, returns True if anything shown changed
+    def update(self, fields):
+        local = self.local()
+        days = local // 86400
+        secs = local % 86400
+        year, month, day = civil_from_days(days)
+        hour = secs // 3600
+        self.minute = local // 60
+        clock = "%02d:%02d" % (hour, secs // 60 % 60)
+        if clock == fields.time and hour == fields.hour and days == fields.days:
+            return False
+        fields.time = clock
+        fields.hour = hour
+        fields.days = days
+        fields.day = "%02d" % day
+        fields.month = "%02d" % month
+        fields.year2 = "%02d" % (year % 100)
+        fields.date = fields.day + "." + fields.month + "." + fields.year2
+        fields.dowa = DAYS[weekday(days)]
+        fields.moya = MONTHS[month - 1]
+        return True
+
+    # Seconds until the next local minute starts, or the next one that is
+    # a multiple of minutes (e.g. 5 for :00, :05, :10 ...)
+    def seconds_to_next_minute(self, minutes=1):
+        return minutes * 60 - self.local() % (minutes * 60)
+
+    # Correct the clock to a trusted UTC time (from NTP)
+    def discipline(self, utc):
+        error = utc - self.utc()
+        if self.last_sync is not None and utc > self.last_sync:
+            self.drift = error * 86400 / (utc - self.last_sync)
+        self.correction += error
+        self.last_sync = utc
+        self.syncs += 1
+        return error
+
+    # Correct by whole minutes if MQTT's HH:MM disagrees by more than a minute
+    def discipline_minutes(self, hour, minute):
+        local = self.local()
+        shown = local % 86400 // 60
+        error = (hour * 60 + minute - shown + 720) % 1440 - 720
+        if -1 <= error <= 1:
+            return 0
+        self.correction += error * 60
+        self.syncs += 1
+        return error * 60
@@ -0,0 +1,85 @@
+#####################################
+### Non-blocking tone sequencer   ###
+#####################################
+#
+# MagTag.peripherals.play_tone blocks for the length of the tone, so a
+# chime used to hold up MQTT, UDP and tap checks.  The sequencer keeps one
+# PWMOut on the speaker pin and plays a queue of notes from a scheduler
+# task: step() starts the next note when the current one is over and says
+# how long until it wants to run again.  The speaker amplifier is only
+# enabled while a sequence plays.
+#
+# A pattern is data, a tuple of (frequency, seconds) notes where frequency
+# 0 is a rest.
+
+import time
+
+BOOT = ((1046.50, 0.125), (1318.51, 0.125))  # C6, E6
+CHIME = ((4096, 0.125), (0, 0.125), (4096, 0.125))  # C8 minus 38 cents, twice
+TAP = ((4096, 0.125),)
+
+ON = 2**15  # duty cycle, a square wave
+
+
+class ToneSequencer:
+    # speaker(on) switches the amplifier, e.g. MagTag's speaker_disable
+    def __init__(self, pwm, speaker, monotonic=time.monotonic):
+        self._pwm = pwm
+        self._speaker = speaker
+        self._monotonic = monotonic
+        self._queue = []
+        self._end = 0  # monotonic time the current note is over
+        self.busy = False
+        # counters
+        self.sequences = 0
+        self.notes = 0
+        self.late = 0.0  # worst delay starting a note, in seconds
+
+    # Queue notes after anything still playing, returns seconds until they are done
+    def play(self, notes):
+        self._queue.extend(notes)
+        if not self.busy:
+            self.busy = True
+            self.sequences += 1
+            self._end = self._monotonic()
+            self._speaker(True)
+        return self._end - self._monotonic() + sum(note[1] for note in self._queue)
+
+    # Start the next note if the current one is over.  Returns seconds until
+    # the next call is needed, None once the sequence has finished.
+    def step(self):
+        if not self.busy:
+            return None
+        now = self._monotonic()
+        if now < self._end:
+            return self._end - now
+        self.late = max(self.late, now - self._end)
+        if not self._queue:
+            self.stop()
+            return None
+        frequency, seconds = self._queue.pop(0)
+        if frequency:
+            self._pwm.frequency = int(frequency)
+            self._pwm.duty_cycle = ON
+        else:
+            self._pwm.duty_cycle = 0
+        self.notes += 1
+        self._end = now + seconds
+        return seconds
+
+    def stop(self):
+        self._queue = []
+        self._pwm.duty_cycle = 0
+        if self.busy:
+            self._speaker(False)
+        self.busy = False
+
+    # Play the queue out before returning, for when there is no scheduler yet
+    def wait(self, sleep=time.sleep):
+        delay = self.step()
+        while delay is not None:
+            sleep(delay)
+            delay = self.step()
+
+    def stats(self):
+        return "sequences %d notes %d late %dms" % (self.sequences, self.notes, self.late * 1000)
@@ -0,0 +1,240 @@
+#####################################
+### Input trace recorder          ###
+#####################################
+#
+# Records what the loop was given, so a unit that misbehaves in the field
+# can be replayed on the host (tools/sim/replay.py): every MQTT message,
+# every UDP datagram, taps, and light and battery readings that moved past
+# a small deadband.  Records go into a preallocated byte ring, the newest
+# overwriting the oldest, and can leave the board two ways:
+#   save()    the ring to microcontroller.nvm, after a crash or on the
+#             "trace save" command (nvm is flash, so never every record)
+#   stream    records copied to a datagram buffer and sent to a host
+#             whenever it fills or on flush()
+#
+# Everything is a chunk, little-endian:
+#   header  <4sIIH  b"MTT2", trace id, UTC when the trace started, bytes of records
+#   record  <IHBB   milliseconds after the trace started (low 32 bits, high
+#                   16 bits, so it does not wrap after 49 days), kind,
+#                   payload bytes, then the payload (up to 255 bytes)
+# A capture file is chunks back to back, as they came off the board.
+# load() turns that into (utc, kind, payload) on the host too.
+#
+# The trace starts at boot, often before NTP, so its UTC can be far out.
+# rebase() moves it when the clock is stepped.  Records keep their place,
+# they are timed from the monotonic start, and load() times every chunk of
+# a trace (same id) from the UTC in its newest chunk.  Chunks from the
+# first format (b"MTT1", <4sIH and <IBB) still load.
+
+import random
+import struct
+import time
+
+BOOT = 0  # the trace started
+MQTT = 1  # topic, a zero byte, the message
+UDP = 2  # the datagram
+TAP = 3
+SENSORS = 4  # <HH raw light, battery mV
+NAMES = {BOOT: "boot", MQTT: "mqtt", UDP: "udp", TAP: "tap", SENSORS: "sensors"}
+
+_MAGIC = b"MTT2"
+_HEADER = "<4sIIH"
+_HEADER_SIZE = struct.calcsize(_HEADER)
+_RECORD = "<IHBB"
+_RECORD_SIZE = struct.calcsize(_RECORD)
+_FORMATS = {_MAGIC: (_HEADER, _RECORD), b"MTT1": ("<4sIH", "<IBB")}
+
+
+class TraceRecorder:
+    def __init__(self, utc, size=2048, light_band=256, battery_band=10, monotonic=time.monotonic):
+        self._monotonic = monotonic
+        self.utc = utc  # when the trace started, records are timed from here
+        self._start = monotonic()
+        self.id = random.getrandbits(32)  # ties the chunks of this trace together
+        self.enabled = size > 0
+        self._ring = bytearray(max(size, 1))
+        self._size = len(self._ring)
+        self._head = 0  # oldest record
+        self._used = 0
+        self._header = bytearray(_RECORD_SIZE)
+        self.light_band = light_band  # raw light change worth a record
+        self.battery_band = battery_band  # mV
+        self._light = None
+        self._battery = None
+        self._sock = None
+        self._address = None
+        self._stream = None
+        self._pending = 0
+        # counters
+        self.records = 0
+        self.overwritten = 0  # records pushed out of the ring
+        self.sent = 0  # datagrams
+        self.dropped = 0  # datagrams lost to send errors
+        self.saves = 0
+        self.rebases = 0
+        self.record(BOOT)
+
+    # The clock was stepped to utc, time the trace from it
+    def rebase(self, utc):
+        self.utc = int(utc - (self._monotonic() - self._start))
+        self.rebases += 1
+
+    # Copy records to a host as well, e.g. stream(sock, ("10.1.0.1", 5141))
+    def stream(self, sock, address, size=512):
+        self._sock = sock
+        self._address = address
+        self._stream = bytearray(size)
+        data = self.chunk(size)  # What was recorded before, the boot at least
+        self._stream[: len(data)] = data
+        self._pending = len(data)
+
+    def record(self, kind, payload=b""):
+        if not self.enabled:
+            return
+        payload = payload[:255]
+        length = _RECORD_SIZE + len(payload)
+        if length > self._size:
+            return
+        ms = int((self._monotonic() - self._start) * 1000)
+        struct.pack_into(_RECORD, self._header, 0, ms & 0xFFFFFFFF, ms >> 32, kind, len(payload))
+        while self._used + length > self._size:
+            self._evict()
+        tail = (self._head + self._used) % self._size
+        self._put(tail, self._header)
+        self._put((tail + _RECORD_SIZE) % self._size, payload)
+        self._used += length
+        self.records += 1
+        if self._stream is not None:
+            if self._pending + length > len(self._stream):
+                self.flush()
+            self._stream[self._pending : self._pending + _RECORD_SIZE] = self._header
+            self._stream[self._pending + _RECORD_SIZE : self._pending + length] = payload
+            self._pending += length
+
+    def mqtt(self, topic, message):
+        if self.enabled:
+            self.record(MQTT, topic.encode("utf-8") + b"\x00" + (message.encode("utf-8") if isinstance(message, str) else bytes(message)))
+
+    def udp(self, data):
+        if self.enabled:
+            self.record(UDP, bytes(data))
+
+    def tap(self):
+        self.record(TAP)
+
+    # Raw light and volts, only once they moved past the deadband
+    def sensors(self, light, volts):
+        millivolts = int(volts * 1000)
+        if (
+            self._light is not None
+            and abs(light - self._light) <= self.light_band
+            and abs(millivolts - self._battery) <= self.battery_band
+        ):
+            return
+        self._light = light
+        self._battery = millivolts
+        self.record(SENSORS, struct.pack("<HH", min(max(int(light), 0), 0xFFFF), min(max(millivolts, 0), 0xFFFF)))
+
+    # Send what is waiting in the stream buffer as one chunk
+    def flush(self):
+        if self._stream is None or self._pending == _HEADER_SIZE:
+            return
+        struct.pack_into(_HEADER, self._stream, 0, _MAGIC, self.id, self.utc, self._pending - _HEADER_SIZE)
+        try:
+            self._sock.sendto(memoryview(self._stream)[: self._pending], self._address)
+            self.sent += 1
+        except OSError:
+            self.dropped += 1
+        self._pending = _HEADER_SIZE
+
+    # The ring oldest first as one chunk, cut to size bytes at a record boundary
+    def chunk(self, size=None):
+        data = self._get(self._head, self._used)
+        offset = 0
+        limit = self._used if size is None else size - _HEADER_SIZE
+        while len(data) - offset > limit:
+            offset += _RECORD_SIZE + data[offset + _RECORD_SIZE - 1]
+        return struct.pack(_HEADER, _MAGIC, self.id, self.utc, len(data) - offset) + data[offset:]
+
+    # Write the ring to memory (nvm) at offset, only if it changed, nvm is flash
+    def save(self, memory, offset=1024, size=3072):
+        data = self.chunk(size)
+        if bytes(memory[offset : offset + len(data)]) != data:
+            memory[offset : offset + len(data)] = data
+        self.saves += 1
+        return len(data)
+
+    def stats(self):
+        return "records %d kept %d bytes overwritten %d sent %d dropped %d saves %d rebases %d" % (
+            self.records,
+            self._used,
+            self.overwritten,
+            self.sent,
+            self.dropped,
+            self.saves,
+            self.rebases,
+        )
+
+    def _evict(self):
+        length = _RECORD_SIZE + self._ring[(self._head + _RECORD_SIZE - 1) % self._size]
+        self._head = (self._head + length) % self._size
+        self._used -= length
+        self.overwritten += 1
+
+    def _put(self, pos, data):
+        first = min(len(data), self._size - pos)
+        self._ring[pos : pos + first] = data[:first]
+        if first < len(data):
+            self._ring[0 : len(data) - first] = data[first:]
+
+    def _get(self, pos, length):
+        if pos + length <= self._size:
+            return bytes(self._ring[pos : pos + length])
+        return bytes(self._ring[pos:]) + bytes(self._ring[: pos + length - self._size])
+
+
+# The chunk save() left at offset, or None.  Clears it so it shows once.
+def recover(memory, offset=1024, size=3072):
+    header = bytes(memory[offset : offset + _HEADER_SIZE])
+    if header[0:4] != _MAGIC:
+        return None
+    length = struct.unpack(_HEADER, header)[3]
+    if length > size - _HEADER_SIZE:
+        return None
+    data = bytes(memory[offset : offset + _HEADER_SIZE + length])
+    memory[offset : offset + 4] = b"\x00\x00\x00\x00"
+    return data
+
+
+# [(utc, kind, payload)] from chunks back to back, in the order recorded
+def load(data):
+    chunks = []  # (trace id, utc, [(ms, kind, payload)])
+    starts = {}  # trace id: utc of its newest chunk
+    offset = 0
+    while offset + 4 <= len(data):
+        formats = _FORMATS.get(bytes(data[offset : offset + 4]))
+        if formats is None:
+            raise ValueError("no trace chunk at byte %d" % offset)
+        header, record = formats
+        if header == _HEADER:
+            _, trace, utc, length = struct.unpack_from(header, data, offset)
+        else:
+            _, utc, length = struct.unpack_from(header, data, offset)
+            trace = None
+        offset += struct.calcsize(header)
+        end = offset + length
+        records = []
+        while offset < end:
+            fields = struct.unpack_from(record, data, offset)
+            ms = fields[0] if len(fields) == 3 else fields[0] | fields[1] << 32
+            offset += struct.calcsize(record)
+            records.append((ms, fields[-2], bytes(data[offset : offset + fields[-1]])))
+            offset += fields[-1]
+        chunks.append((trace, utc, records))
+        if trace is not None:
+            starts[trace] = utc
+    events = []
+    for trace, utc, records in chunks:
+        utc = starts.get(trace, utc)
+        events.extend((utc + ms / 1000, kind, payload) for ms, kind, payload in records)
+    return events
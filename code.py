@@ -4,10 +4,12 @@
 #import os  # DEBUG
 import gc  # Garbage Collector
 import time  # Pretty important for a clock
+boot_start = time.monotonic()  # For the boot timing report
 import rtc  # for RTC; As above
 import ssl  # For MQTT
-import struct  # Primarily used by NTP
 from microcontroller import watchdog as wd  # Watchdog
+from microcontroller import nvm  # Warm boot cache and crash log
+import microcontroller  # reset() after a crash dump
 from watchdog import WatchDogMode
 import socketpool
 import wifi
@@ -16,7 +18,30 @@ import digitalio  # For red LED (D13) on the back of the board
 import adafruit_lis3dh  # Accelerometer
 import alarm
 import neopixel
+import pwmio  # Speaker
 from adafruit_magtag.magtag import MagTag
+import clock_font  # Compiled glyph-subset fonts
+from clock_display import LabelRenderer  # Only redraw labels that changed
+from clock_refresh import RefreshScheduler  # Partial updates of the changed area, full ones to clear ghosting
+from clock_mqtt import TopicDispatcher  # time/ topic handling
+from clock_time import LocalClock, TimeFields  # Time kept locally from the RTC
+from clock_sleep import SleepState, seconds_to_boundary, DRAW, RESYNC  # Deep sleep state
+from clock_tasks import Scheduler  # Deadline based tasks instead of one fixed loop
+from clock_ntp import SNTPClient  # Non-blocking NTP
+from clock_sensors import SensorSampler, BATT_EMPTY  # Cached light and battery readings
+from clock_commands import CommandRegistry  # UDP control port commands
+from clock_profile import Profiler  # Per-phase timing and heap use
+from clock_digits import DigitDisplay  # Time and date drawn from pre-rasterised tiles
+from clock_theme import Theme, is_night_hour, seconds_to_change  # Day/night palettes
+from clock_net import ConnectionManager  # WiFi and MQTT reconnects with backoff
+from clock_boot import BootCache, BootTimer, rtc_valid  # Last screen and AP kept in nvm
+from clock_tap import TapInterrupt  # Taps latched on the LIS3DH INT1 pin
+from clock_tone import ToneSequencer, BOOT, CHIME, TAP  # Sounds played from a task, never blocking
+from clock_policy import Policy, POLICIES  # Update cadence from light, battery and taps
+from clock_log import Logger, SerialSink, UDPSink, MQTTSink, LEVELS, DEBUG, recover  # Leveled logging, ring kept over a crash
+from clock_energy import EnergyMeter, MODEL  # Charge used per activity and the runtime left
+from clock_telemetry import Telemetry  # Light, battery and taps batched into one MQTT message
+from clock_trace import TraceRecorder, recover as recover_trace  # Inputs recorded for replay on a host
 import adafruit_minimqtt.adafruit_minimqtt as MQTT  # MQTT Client
 
 wd.timeout = 30  # Set a timeout in seconds
@@ -29,14 +54,24 @@ wd.feed()  # Feed watchdog
 #
 # Features:
 #   Only updates screen if time has changed (every 60s usually)
+#   Partial e-ink updates of just the changed area where the display driver has them, a full refresh every few and at the day/night switch
 #   Hourly chime between defined hours
 #   Inverts screen between defined hours
 #   Detects if the device is tapped and turns on neopixels for a defined time
+#   Taps can be read from the accelerometer's interrupt pin, and wake the board from sleep
 #   Time synced initially from an NTP server
 #   Display data from MQTT
-#   Watchdog reset if things go wrong (e.g. MQTT connection lost)
-#   Listen for live UDP packet and exec() the command
+#   Watchdog reset if things go wrong
+#   Reconnects WiFi and MQTT in the background with backoff, keeping the MQTT session
+#   Listen for UDP commands (brightness, refresh, invert, chime, NTP, stats)
 #   Red LED on the back of the board (D13) on when running code and off when sleeping
+#   Per-phase timing and heap stats published to clock/<mac>/stats
+#   Warm boot: after a reset the time is painted from the RTC before networking, WiFi joins the last AP without a scan
+#   Adaptive cadence: redraws and polls less in the dark or on a low battery, full speed after a tap
+#   Leveled logging to serial, UDP and MQTT, the last records saved to nvm before a watchdog reset
+#   Energy accounting per activity (e-ink, WiFi, MQTT, NTP, NeoPixels, speaker) with the battery runtime left
+#   Light, battery, taps and uptime published to clock/<mac>/telemetry in delta-encoded batches
+#   Input trace (MQTT, UDP, taps, sensors) saved to nvm on a crash or streamed over UDP, replayed with tools/sim/replay.py
 
 #   Notes:
 #     https://learn.adafruit.com/adafruit-magtag
@@ -54,45 +89,131 @@ wd.feed()  # Feed watchdog
 #     Digital-7-77.bdf
 #     Digital-7-38.bdf
 #     ThinPixel-7-20.bdf
+#     Compiled to glyph subsets for faster boot and less RAM (copy the .mtf files too):
+#       python3 tools/font_compiler.py Digital-7-77.bdf Digital-7-38.bdf ThinPixel-7-20.bdf
 
 ############################
 ### Set your preferences ###
 ############################
-sleep_time = 1  # how long to sleep between loops
-# this will also multiply duration of other functions like tap_duration
+sleep_time = 60  # how often to print light/battery and collect garbage (MicroPython also collects when the heap is full)
+mqtt_poll = 1  # seconds between MQTT checks
+mqtt_timeout = 0.1  # how long each MQTT check waits for messages
+mqtt_drain = 16  # most messages taken per MQTT check, a full refill of time/# is 14
+udp_poll = 0.5  # seconds between UDP command checks, made in the idle wait
+tap_poll = 0.5  # seconds between tap checks, with tap_irq a look at INT1 in the idle wait
+sensor_period = 10  # seconds between light and battery readings, smoothed over the last 8
 
 hour_chime = 1  # chime hourly if enabled
 hour_chime_start = 10  # start hour for chime
 hour_chime_stop = 22  # stop hour for chime
 
 tap_enable = 1  # enable tap detection
-tap_duration = 5  # how long to keep the lights on after a tap
+tap_duration = 5  # seconds to keep the lights on after a tap
 tap_threshold = 119  # 80 default, but i use 119 to avoid false positives. 127 is max
+tap_irq = 1  # 1 = watch the LIS3DH INT1 pin instead of polling it over I2C, a tap wakes the board from sleep
+light_sleep = 0  # 1 = light sleep between tasks instead of time.sleep, with tap_irq a tap wakes it
 
 invert_enable = 1  # enable invert screen
-invert_start = 18  # start hour for invert
-invert_stop = 6  # stop hour for invert
+invert_start = 18  # start hour for invert, night from 18:00
+invert_stop = 6  # stop hour for invert, day again from 06:00
+invert_force = None  # None = by the hours above, True/False = forced night/day (UDP "invert")
+
+digit_atlas = 1  # 1 = draw the time and date from a pre-rasterised digit atlas, 0 = text labels
+partial_refresh = 0  # 1 = fast updates of just the changed areas, needs a display driver with refresh_areas([(x, y, width, height), ...]), see clock_refresh.py
+partial_full_every = 10  # partial updates before a full refresh clears the ghosting, one is also done at invert_start and invert_stop
 
 tz_offset = 3600 * 10  # GMT+10 for me in Australia
+dst_rule = None  # None for no DST, or a rule like DST_AU in clock_time.py e.g. (10, 1, 2, 4, 1, 2, 3600)
+local_time = 1  # 1 = keep time from the RTC, MQTT and NTP only correct drift. 0 = show MQTT time
 ntp_server = "10.1.0.1"  # NTP server eg. au.pool.ntp.org
 ntp_port = 123  # NTP UDP port defaults to 123
+ntp_boot_timeout = 5  # seconds to wait for NTP at boot
+ntp_min_poll = 64  # NTP poll interval in seconds, doubles up to ntp_max_poll while the clock is stable
+ntp_max_poll = 16384
+
+warm_boot = 1  # 1 = after a reset paint from the RTC and the nvm cache first, then bring the network up in the background
+boot_cache_period = 3600  # seconds between nvm cache saves, only written if it changed (nvm is flash, mind the wear)
+
+deep_sleep = 0  # 1 = deep sleep between minutes and redraw from the RTC (needs local_time = 1)
+deep_sleep_resync = 60  # minutes of deep sleep between networked boots for NTP, 0 = never
+
+udp_exec_allow = ()  # python snippets the UDP "exec" command may run, e.g. ("led.value = True",)
+udp_exec_any = 0  # 1 = let "exec" run any python sent to the UDP port (old behaviour)
+
+mqtt_packed = 0  # 1 = only subscribe to the packed time/state topic, 0 = everything under time/#
+mqtt_atomic = 1  # apply all time fields from one loop together
+mqtt_boot_timeout = 10  # seconds to try the broker at boot, after that it is retried in the background
+mqtt_backoff_max = 300  # longest wait between reconnect attempts, in seconds
+mqtt_resubscribe = 180  # subscribe again if no MQTT message arrives for this many seconds
+
+stats_interval = 300  # seconds between stats snapshots on clock/<mac>/stats, 0 = off
+
+policy_enable = 1  # 1 = redraw and poll less in the dark or on a low battery, see clock_policy.py
+policy_table = None  # None = POLICIES in clock_policy.py, or your own dict in the same shape
+policy_dark = 3  # light percent at or below which the room counts as dark
+policy_low_battery = 3.8  # volts below which the battery counts as low (not while charging)
+policy_active = 120  # seconds of full speed after a tap
+
+log_level = "info"  # what goes to serial, UDP and MQTT: "debug" (light/battery every second), "info", "warning" or "error". UDP "log" changes it
+log_keep = "info"  # lowest level kept in the ring for UDP "log tail" and the crash dump
+log_ring = 64  # records kept in the ring
+log_udp = None  # None, or ("10.1.0.1", 5140) to send log lines there in batches
+log_mqtt = 1  # 1 = warnings and errors to clock/<mac>/log
+log_flush = 60  # seconds between UDP and MQTT log batches
+log_crash_dump = 1  # 1 = a watchdog timeout or crash in the loop saves the ring to nvm, then resets. Shown at the next boot
+
+energy_enable = 1  # 1 = account the charge each activity uses (UDP "energy"), hours left shown on the battery label
+energy_model = None  # None = MODEL in clock_energy.py, or your own {activity: (mA while on, mAs each time)}
+battery_mah = 420  # battery capacity
+
+telemetry_enable = 1  # 1 = publish light, battery, taps and uptime to clock/<mac>/telemetry, see clock_telemetry.py
+telemetry_sample = 60  # seconds between samples, only values that moved past their deadband are kept
+telemetry_period = 900  # seconds between batches, one MQTT message each
+telemetry_backlog = 16  # batches kept while the broker is away, the oldest are dropped after that
+
+trace_enable = 1  # 1 = record MQTT messages, UDP commands, taps and sensor readings for tools/sim/replay.py, see clock_trace.py
+trace_ring = 2048  # bytes of the newest records kept, saved to nvm on a crash or with UDP "trace save"
+trace_udp = None  # None, or ("10.1.0.1", 5141) to stream the records there (python3 tools/sim/replay.py --listen 5141 day.trace)
+trace_flush = 60  # seconds between trace datagrams, sooner if the buffer fills
 
 # other initial vars and constants that won't usually need to be changed
-ntp_time_correction = 2_208_988_800  # epoch time in seconds offset
+log = Logger(LEVELS[log_level], keep=LEVELS[log_keep], size=log_ring)
+log.add(SerialSink())  # UDP and MQTT sinks are added once the network is up
+log_nvm_offset = 4096  # Crash dump in nvm, clear of the warm boot cache
+crash_log = recover(nvm, log_nvm_offset)  # Cleared once read, so it only shows once
+if crash_log:
+    print("Log saved before the last reset:")
+    print(crash_log)
+trace_nvm_offset = 1024  # Input trace in nvm, between the warm boot cache and the log
+crash_trace = recover_trace(nvm, trace_nvm_offset)  # Sent to trace_udp once the network is up
+if crash_trace:
+    print("Input trace saved before the last reset: %d bytes" % len(crash_trace))
 magtag = MagTag()
-mqtt_sub_time = "00:00"
-mqtt_sub_date = "00.00.00"
-mqtt_sub_time_old = "xx:xx"
-mqtt_sub_dowa = "xxx"  # Day of Week abbreviations Mon/Tue/Wed etc.
-mqtt_sub_day = 00
-mqtt_sub_moya = "xxx"  # Month of Year abbreviations Jan/Feb/Mar etc.
-mqtt_sub_year2 = 00
-mqtt_sub_month = 00
-mqtt_sub_hour = 00
-mqtt_sub_hour_old = 25
-time_mono_last = time.monotonic()
+sensors = SensorSampler(magtag.peripherals, period=sensor_period)  # Light and battery, read once per period
+mqtt_sub = TimeFields()  # time, date, dowa, day, moya, year2, month, hour
+clock = LocalClock(tz_offset, dst_rule)  # RTC holds UTC, offset applied when formatting
+now_fields = TimeFields() if local_time == 1 else mqtt_sub  # What the display shows
+time_old = "xx:xx"
+hour_old = 25
 lis = adafruit_lis3dh.LIS3DH_I2C(board.I2C(), address=0x19) # MagTag Accelerometer
 tap_counter = 0
+tap_total = 0  # Taps since boot, for telemetry
+sleep_state = SleepState(8)  # What survives deep sleep
+boot_cache = BootCache(nvm, sleep_state)  # What survives a reset
+boot_timer = BootTimer(boot_start)  # Boot phase timings
+profiler = Profiler()  # Time and heap per loop phase
+scheduler = None  # Set up in the Tasks section
+energy = EnergyMeter(energy_model or MODEL, capacity=battery_mah, empty=BATT_EMPTY)  # Time and count per activity
+telemetry = Telemetry(backlog=telemetry_backlog)  # Samples batched between publishes
+trace = TraceRecorder(clock.utc(), size=trace_ring if trace_enable == 1 else 0)  # Inputs, newest kept
+policy = Policy(
+    {"display": 1, "mqtt": mqtt_poll, "udp": udp_poll, "tap": tap_poll, "sensors": sensor_period, "housekeeping": sleep_time},
+    table=policy_table or POLICIES,
+    dark=policy_dark,
+    low_battery=policy_low_battery,
+    active_for=policy_active,
+    log=log,
+)  # Task periods for the conditions, the preferences above are "normal"
 
 magtag.peripherals.neopixels.brightness = 1
 magtag.peripherals.neopixel_disable = False
@@ -107,6 +228,7 @@ magtag.peripherals.neopixel_disable = False
 #print(magtag.peripherals.battery) # Battery voltage
 #print(magtag.peripherals.light) # My Light sensor range 556-52487
 # percentage = 100 * (magtag.peripherals.light - 556) / (52487 - 556)
+# Both are read through sensors (clock_sensors.py) so each is only converted once per period
 
 # Red LED on the back of the board
 led = digitalio.DigitalInOut(board.D13)
@@ -129,6 +251,20 @@ led.direction = digitalio.Direction.OUTPUT
 #pwm.duty_cycle = 2 ** 15
 #time.sleep(sleep_time)
 
+# The way tones are played now: one PWMOut driven by the tone task (clock_tone.py)
+def speaker(on):
+    magtag.peripherals.speaker_disable = not on
+    if on:
+        energy.start("speaker")
+    else:
+        energy.stop("speaker")
+
+# Time fn as an energy activity, see clock_energy.py
+def metered(name, fn):
+    return energy.wrap(name, fn) if energy_enable == 1 else fn
+
+tones = ToneSequencer(pwmio.PWMOut(board.SPEAKER, frequency=1000, duty_cycle=0, variable_frequency=True), speaker)
+
 ###############
 ### SECRETS ###
 ###############
@@ -170,6 +306,8 @@ aio_key = secrets["aio_key"]
 #####################
 # Enable accel tap detection
 lis.set_tap(1, threshold=tap_threshold, time_limit=10, time_latency=20, time_window=255)
+if tap_irq == 1:
+    taps = TapInterrupt(lis, board.ACCELEROMETER_INTERRUPT)  # Clicks latched on INT1, see clock_tap.py
 ### https://www.st.com/resource/en/design_tip/dm00069521-simple-screen-rotation-using-the-accelerometer-builtin-4d-detection-interrupt--stmicroelectronics.pdf
 ### lis._write_register_byte(0x20, 0x3F)  # low power mode with ODR = 25Hz
 ### lis._write_register_byte(0x22, 0x40)  # AOI1 interrupt generation is routed to INT1 pin
@@ -183,22 +321,316 @@ lis.set_tap(1, threshold=tap_threshold, time_limit=10, time_latency=20, time_win
 ### _, y, _ = lis.acceleration
 # Accelerometer end
 
+################
+### Graphics ###
+################
+mid_x = magtag.graphics.display.width // 2 - 1
+midl_x = magtag.graphics.display.width // 2 // 2 + 9
+# use the compiled .mtf fonts if present, otherwise the BDF files
+font_large = clock_font.register(magtag, "/Digital-7-77.bdf")
+font_small = clock_font.register(magtag, "/Digital-7-38.bdf")
+font_micro = clock_font.register(magtag, "/ThinPixel-7-20.bdf")
+# text top large clock
+magtag.add_text(
+    text_font=font_large,
+    text_color=(0x000000),
+    #text_position=(mid_x,6),
+    text_position=(midl_x, 6),
+    text_anchor_point=(0.485, 0.20),  # centre for scale 2
+    text_scale=1,
+    is_data=False,
+)
+# text bot large
+magtag.add_text(
+    text_font=font_large,
+    text_color=(0x000000),
+    text_position=(mid_x, 68),
+    text_anchor_point=(0.485, 0.20),  # centre for scale 2
+    text_scale=1,
+    is_data=False,
+)
+# text small a
+magtag.add_text(
+    text_font=font_small,
+    text_color=(0x000000),
+    text_position=(((magtag.graphics.display.width // 4) * 3) + 12, 5),
+    text_anchor_point=(0.5, 0.20),  # centre for scale 2
+    text_scale=1,
+    is_data=False,
+)
+# text small b
+magtag.add_text(
+    text_font=font_small,
+    text_color=(0x000000),
+    text_position=(((magtag.graphics.display.width // 4) * 3) + 12, 35),
+    text_anchor_point=(0.5, 0.20),  # centre for scale 2
+    text_scale=1,
+    is_data=False,
+)
+# text small c
+magtag.add_text(
+    text_font=font_small,
+    text_color=(0x000000),
+    text_position=(mid_x, 67),
+    text_anchor_point=(0.485, 0.20),  # centre for scale 2
+    text_scale=1,
+    is_data=False,
+)
+# text small d
+magtag.add_text(
+    text_font=font_small,
+    text_color=(0x000000),
+    text_position=(mid_x, 97),
+    text_anchor_point=(0.485, 0.20),  # centre for scale 2
+    text_scale=1,
+    is_data=False,
+)
+# text micro a
+magtag.add_text(
+    text_font=font_micro,
+    text_color=(0x000000),
+    text_position=(1, 119),
+    text_anchor_point=(0, 1),  # centre for scale 2
+    text_scale=1,
+    is_data=False,
+)
+# text micro b - Batt voltage
+magtag.add_text(
+    #text_font="/SmallestPixel-7-10.bdf",
+    text_font=font_micro,
+    text_color=(0x000000),
+    text_position=(magtag.graphics.display.width + 1, 120),
+    text_anchor_point=(1, 1),  # centre for scale 2
+    text_scale=1,
+    is_data=False,
+)
+magtag.refresh = metered("eink", magtag.refresh)  # Every refresh, whoever asks for it
+
+# Where label index is on screen, for the partial refresh areas
+def label_bounds(index):
+    label = magtag._text[index]["label"]
+    if label is None:
+        return None
+    box = label.bounding_box
+    return (label.x + box[0], label.y + box[1], box[2], box[3])
+
+partial_areas = getattr(magtag.graphics.display, "refresh_areas", None)
+if partial_areas is None:  # Once at boot, whatever partial_refresh says
+    if partial_refresh == 1:
+        log.warning("This display driver has no partial refresh, every refresh is full")
+    else:
+        log.info("Display driver has no refresh_areas, partial refresh not available")
+if partial_refresh != 1:
+    partial_areas = None
+refresher = RefreshScheduler(
+    magtag.graphics.display.width,
+    magtag.graphics.display.height,
+    magtag.refresh,
+    partial=metered("eink_partial", partial_areas) if partial_areas else None,
+    full_every=partial_full_every,
+)  # Partial or full, changed areas counted either way
+renderer = LabelRenderer(magtag, 8, bounds=label_bounds, scheduler=refresher)
+theme = Theme(magtag, renderer, 8)  # Background and digits share its palettes
+if digit_atlas == 1:
+    # Same place and anchor as text top large and text small b, drawn by tile index
+    time_digits = DigitDisplay(magtag._fonts[font_large], "00:00", (midl_x, 6), (0.485, 0.20), palette=theme.palette)
+    date_digits = DigitDisplay(
+        magtag._fonts[font_small],
+        "00.00.00",
+        (((magtag.graphics.display.width // 4) * 3) + 12, 35),
+        (0.5, 0.20),
+        palette=theme.palette,
+    )
+    magtag.splash.append(time_digits)
+    magtag.splash.append(date_digits)
+    renderer.attach(0, time_digits)
+    renderer.attach(3, date_digits)
+
+# Night time from invert_start up to invert_stop
+def is_night():
+    if invert_force is not None:  # Set over UDP with "invert"
+        return invert_force
+    return is_night_hour(now_fields.hour, invert_start, invert_stop)
+
+# Returns True if the theme changed, does nothing if it is already right
+def apply_invert():
+    if invert_enable == 1:
+        return theme.apply(is_night())
+    return False
+
+# Text for every label from one shared sensor snapshot
+def frame_texts():
+    sensors.sample()  # Only reads if the snapshot is older than sensor_period
+    batt_v = str(round(sensors.battery, 2)) + "v"
+    if sensors.charging:
+        batt = "Chg " + str(sensors.batt_pc) + "% " + batt_v
+    else:
+        batt = str(sensors.batt_pc) + "% " + batt_v
+        hours = energy.hours_left(sensors.batt_pc) if energy_enable == 1 else None
+        if hours is not None:
+            batt += " %dh" % hours  # Runtime left
+    return [
+        now_fields.time,
+        "",
+        now_fields.dowa + " " + now_fields.moya,
+        now_fields.day + "." + now_fields.month + "." + now_fields.year2,
+        "Light: " + str(sensors.light),
+        batt_v,
+        "L:" + str(sensors.light_pc) + "% " + str(sensors.light),
+        batt,
+    ]
+
+def draw_frame(texts):
+    for i in range(8):
+        renderer.set_text(i, texts[i])
+    renderer.refresh()  # One refresh for all changed labels
+    sleep_state.texts = texts
+    boot_timer.painted()  # Only the first one counts
+
+# Queue a pattern from clock_tone.py, the tone task plays it.
+# Before the tasks run (deep sleep wakes) tones.wait() plays it out.
+def sound(pattern):
+    tones.play(pattern)
+    if scheduler is not None:
+        scheduler.call_later("tone", 0, tone_task)
+
+def chime():
+    sound(CHIME)
+
+def hourly_chime(hour):
+    if hour >= hour_chime_start and hour <= hour_chime_stop:
+        log.info("  Hourchime!")
+        chime()
+
+apply_invert()
+boot_timer.mark("graphics")
+# Graphics end
+
+##################
+### Deep sleep ###
+##################
+# Keep the frame, clock discipline and AP in nvm for the next warm boot
+def save_boot_cache():
+    if wifi.radio.ipv4_address:
+        boot_cache.channel = wifi.radio.ap_info.channel
+        boot_cache.bssid = bytes(wifi.radio.ap_info.bssid)
+    sleep_state.minute = clock.minute or 0
+    sleep_state.hour = hour_old
+    sleep_state.inverted = 1 if is_night() else 0
+    sleep_state.capture_clock(clock)
+    if boot_cache.save():  # Only writes if something changed
+        log.info("  Boot cache saved, writes: %d", boot_cache.writes)
+
+# Sleep until the next minute with the state in alarm.sleep_memory.
+# Returns straight away if the minute turned since it was drawn.
+def deep_sleep_until_next_minute():
+    local = clock.local()
+    if local // 60 != clock.minute:
+        return
+    sleep_state.minute = local // 60  # A tap can wake it before the next minute
+    sleep_state.hour = hour_old
+    sleep_state.tap_counter = tap_counter
+    sleep_state.inverted = 1 if is_night() else 0
+    sleep_state.capture_clock(clock)
+    if warm_boot == 1 and sleep_state.wakes == 0:
+        save_boot_cache()  # Once per networked boot, the AP may have changed
+    sleep_state.save(alarm.sleep_memory)
+    tones.wait()  # Deep sleep would cut it off
+    led.value = False
+    wd.feed()
+    time_alarm = alarm.time.TimeAlarm(monotonic_time=time.monotonic() + seconds_to_boundary(local))
+    if tap_enable == 1 and tap_irq == 1:
+        alarm.exit_and_deep_sleep_until_alarms(time_alarm, taps.alarm())  # A tap wakes it too
+    alarm.exit_and_deep_sleep_until_alarms(time_alarm)
+
+# Woken from deep sleep by a tap: lights on for a while, then back to sleep
+def tap_wake():
+    taps.clear()  # Release INT1 or the alarm fires again straight away
+    log.info("  Tap woke the board")
+    magtag.peripherals.neopixels.fill((1, 1, 1))
+    energy.start("neopixel")
+    sound(TAP)
+    tones.wait()
+    time.sleep(tap_duration)  # Well inside the watchdog timeout
+    magtag.peripherals.neopixels.fill((0, 0, 0))
+    energy.stop("neopixel")
+
+# Woken by our time alarm: redraw from the RTC without the network
+woke = deep_sleep == 1 and local_time == 1 and alarm.wake_alarm is not None and sleep_state.load(alarm.sleep_memory)
+if woke:
+    sleep_state.restore_clock(clock)
+    clock.minute = sleep_state.minute  # The minute on the panel, a tap can wake it before the next
+    hour_old = sleep_state.hour
+    tap_counter = sleep_state.tap_counter
+    if tap_enable == 1 and tap_irq == 1 and taps.woke(alarm.wake_alarm):
+        tap_wake()
+    action = sleep_state.plan(clock.local(), deep_sleep_resync)
+    while action != RESYNC:
+        if action == DRAW:
+            clock.update(now_fields)
+            sleep_state.wakes += 1
+            texts = frame_texts()
+            night = 1 if is_night() else 0
+            # the e-ink still shows the last frame, only draw if it differs
+            if texts != sleep_state.texts or night != sleep_state.inverted:
+                apply_invert()
+                draw_frame(texts)
+            if now_fields.hour != hour_old and hour_chime == 1:
+                hourly_chime(now_fields.hour)
+            hour_old = now_fields.hour
+        deep_sleep_until_next_minute()
+        action = DRAW
+    print("Deep sleep resync, starting network")
+# Deep sleep end
+
+#################
+### Warm boot ###
+#################
+# The RTC kept the time and the e-ink kept the last frame over the reset.
+# Paint the current time now and leave MQTT and NTP to their tasks.
+warm = warm_boot == 1 and local_time == 1 and rtc_valid() and boot_cache.load(state=not woke)
+if warm:
+    if not woke:  # Sleep memory is newer than nvm when there is one
+        sleep_state.restore_clock(clock)
+    clock.update(now_fields)
+    apply_invert()
+    texts = frame_texts()
+    if texts != sleep_state.texts or (1 if is_night() else 0) != sleep_state.inverted:
+        draw_frame(texts)
+    else:
+        for i in range(8):
+            renderer.set_text(i, texts[i])
+        renderer.shown()  # Still on the panel, no refresh
+    boot_timer.painted()
+    time_old = now_fields.time
+    hour_old = now_fields.hour  # No chime for a reset
+    print("Warm boot", now_fields.time, "channel", boot_cache.channel)
+boot_timer.mark("paint")
+# Warm boot end
+
+
 ############
 ### WIFI ###
 ############
 print("MAC addr:", [hex(i) for i in wifi.radio.mac_address])
-print("Available WiFi networks:")
-for network in wifi.radio.start_scanning_networks():
-    print("  %s\t\tRSSI: %d\tChannel: %d" % (str(network.ssid, "utf-8"), network.rssi, network.channel))
-time.sleep(1)
-wifi.radio.stop_scanning_networks()
+if not (warm and boot_cache.channel):  # Joining the cached AP needs no scan
+    print("Available WiFi networks:")
+    for network in wifi.radio.start_scanning_networks():
+        print("  %s\t\tRSSI: %d\tChannel: %d" % (str(network.ssid, "utf-8"), network.rssi, network.channel))
+    time.sleep(1)
+    wifi.radio.stop_scanning_networks()
 print("Connecting to %s" % secrets["ssid"])
-wifi.radio.connect(secrets["ssid"], secrets["password"], timeout=10)
+# Link and MQTT session are kept up by net, see clock_net.py
+net = ConnectionManager(wifi.radio, secrets["ssid"], secrets["password"], max_backoff=mqtt_backoff_max, resubscribe_after=mqtt_resubscribe, log=log)
+if warm_boot == 1 and boot_cache.channel:
+    net.prefer(boot_cache.channel, boot_cache.bssid)  # Falls back to a normal join if it fails
+net.connect(feed=wd.feed, feed_every=wd.timeout / 3)  # Retries with backoff until the link is up
 print("Connected to %s!" % secrets["ssid"])
 print(wifi.radio.ipv4_gateway)
 
 # Create a socket pool
 pool = socketpool.SocketPool(wifi.radio)
+boot_timer.mark("wifi")
 # WiFi end
 
 #########################
@@ -211,6 +643,78 @@ udp_sock.bind((str(myip), udp_port))
 packet = bytearray(1024)
 udp_sock.setblocking(False)
 #udp_sock.settimeout(0.1)
+if log_udp:
+    log.add(UDPSink(udp_sock, log_udp))  # Batched, sent by the log task
+if trace_udp and trace_enable == 1:
+    trace.stream(udp_sock, trace_udp)  # Batched, sent by the trace task
+    if crash_trace:
+        try:
+            udp_sock.sendto(crash_trace, trace_udp)  # Goes first in the capture
+        except OSError as e:
+            log.warning("Trace send failed: %s", e)
+
+# Commands the UDP port understands, e.g. "1|bright 0.2;refresh"
+commands = CommandRegistry(exec_allow=udp_exec_allow, allow_any=udp_exec_any == 1, exec_globals=globals(), log=log)
+
+def bright_command(args):
+    if args:
+        magtag.peripherals.neopixels.brightness = float(args)
+    return magtag.peripherals.neopixels.brightness
+
+def refresh_command(args):
+    renderer.refresh(force=True)
+
+def invert_command(args):
+    global invert_force
+    if args == "auto":
+        invert_force = None
+    elif args in ("on", "off"):
+        invert_force = args == "on"
+    else:
+        invert_force = not is_night()  # toggle
+    apply_invert()
+    renderer.refresh()
+    return "night" if is_night() else "day"
+
+def chime_command(args):
+    chime()
+
+def ntp_command(args):
+    ntp.resync()
+    scheduler.wake("ntp")
+
+def log_command(args):
+    if args == "tail":
+        return " | ".join(log.tail(8))
+    if args:
+        log.set_level(LEVELS[args])
+    return log.stats()
+
+def energy_command(args):
+    return energy.report(sensors.batt_pc)
+
+def telemetry_command(args):
+    return telemetry.stats()
+
+def trace_command(args):
+    if args == "save":
+        trace.save(nvm, trace_nvm_offset)  # Read it back with recover_trace() after a reset
+    return trace.stats()
+
+def stats_command(args):
+    collect()
+    return "free %d %s; %s; %s; %s; %s; %s; boot %s; policy %s" % (gc.mem_free(), renderer.stats(), refresher.stats(), ntp.stats(), net.stats(), commands.stats(), profiler.snapshot(), boot_timer.report(), policy.stats())
+
+commands.register("bright", bright_command, "[0-1] neopixel brightness")
+commands.register("refresh", refresh_command, "force a display refresh")
+commands.register("invert", invert_command, "[on|off|auto] toggle night colours")
+commands.register("chime", chime_command, "play the hourly chime")
+commands.register("ntp", ntp_command, "resync NTP now")
+commands.register("stats", stats_command, "memory, display, NTP, network, command and profiler counters")
+commands.register("energy", energy_command, "average mA per activity and the runtime left")
+commands.register("telemetry", telemetry_command, "telemetry samples, batches and backlog")
+commands.register("trace", trace_command, "[save] input trace counters, or save the trace to nvm")
+commands.register("log", log_command, "[debug|info|warning|error|tail] log level, or the last records")
 # UDP end
 
 ############
@@ -239,60 +743,47 @@ udp_sock.setblocking(False)
 0 0     * * *   root    /usr/bin/mosquitto_pub -u mqtt -P mqtt -r -t time/year  -m "$(date +\%Y)" > /dev/null 2>&1
 0 0     * * *   root    /usr/bin/mosquitto_pub -u mqtt -P mqtt -r -t time/year2 -m "$(date +\%y)" > /dev/null 2>&1
 #* *    * * *   root    /usr/bin/mosquitto_pub -u mqtt -P mqtt -r -t time/hour  -m "$(date +\%d-\%m-\%Y)" > /dev/null 2>&1
+
+# All fields in one packed message, used with mqtt_packed = 1
+* *     * * *   root    /usr/bin/mosquitto_pub -u mqtt -P mqtt -r -t time/state -m "$(date +\%y\%m\%d\%H\%M\%w)" > /dev/null 2>&1
 '''
 # Then cron will populate the MQTT broker with the time
 # note the -r MQTT flag that makes the values persistent
+# Or run tools/time_publisher.py instead of the crontab: one process and one connection,
+# every field from the same timestamp. --dry-run checks it against the lines above
 
 def connect(mqtt_client, userdata, flags, rc):
-    print("Connected to MQTT Broker!")
-    print("Flags: {0} RC: {1}".format(flags, rc))
+    log.info("Connected to MQTT Broker! Flags: %s RC: %s", flags, rc)
 
 def disconnect(mqtt_client, userdata, rc):
-    print("Disconnected from MQTT Broker!")
+    log.warning("Disconnected from MQTT Broker!")
 
 def subscribe(mqtt_client, userdata, topic, granted_qos):
-    print("Subscribed to {0} with QOS level {1}".format(topic, granted_qos))
+    log.info("Subscribed to %s with QOS level %s", topic, granted_qos)
 
 def unsubscribe(mqtt_client, userdata, topic, pid):
-    print("Unsubscribed from {0} with PID {1}".format(topic, pid))
+    log.info("Unsubscribed from %s with PID %s", topic, pid)
 
 def publish(mqtt_client, userdata, topic, pid):
-    print("Published to {0} with PID {1}".format(topic, pid))
-
-def message(client, topic, message):
-    if topic == "time/time":
-        global mqtt_sub_time
-        global mqtt_sub_time_old
-        mqtt_sub_time = message
-        print("mqtt_sub_time:" + mqtt_sub_time)
-    if topic == "time/date2":
-        global mqtt_sub_date
-        mqtt_sub_date = message
-        print("mqtt_sub_date:" + mqtt_sub_date)
-    if topic == "time/dowa":
-        global mqtt_sub_dowa
-        mqtt_sub_dowa = message
-        print("mqtt_sub_dowa:" + mqtt_sub_dowa)
-    if topic == "time/day":
-        global mqtt_sub_day
-        mqtt_sub_day = message
-        print("mqtt_sub_day:" + mqtt_sub_day)
-    if topic == "time/moya":
-        global mqtt_sub_moya
-        mqtt_sub_moya = message
-        print("mqtt_sub_moya:" + mqtt_sub_moya)
-    if topic == "time/year2":
-        global mqtt_sub_year2
-        mqtt_sub_year2 = message
-        print("mqtt_sub_year2:" + mqtt_sub_year2)
-    if topic == "time/month":
-        global mqtt_sub_month
-        mqtt_sub_month = message
-        print("mqtt_sub_month:" + mqtt_sub_month)
-    if topic == "time/hour":
-        global mqtt_sub_hour
-        mqtt_sub_hour = int(message)
-        print("mqtt_sub_hour:", mqtt_sub_hour)
+    log.debug("Published to %s with PID %s", topic, pid)
+    if topic == telemetry_topic:
+        telemetry.confirm()  # The broker has the batch, it can leave the backlog
+
+# Stats snapshots go to clock/<mac>/stats so many units can share a broker
+stats_topic = "clock/%s/stats" % "".join("%02x" % i for i in wifi.radio.mac_address)
+log_topic = "clock/%s/log" % "".join("%02x" % i for i in wifi.radio.mac_address)
+telemetry_topic = "clock/%s/telemetry" % "".join("%02x" % i for i in wifi.radio.mac_address)
+
+# Topic table and parsers live in clock_mqtt.py
+dispatcher = TopicDispatcher(mqtt_sub, atomic=mqtt_atomic == 1, log=log)
+
+def message(mqtt_client, topic, msg):
+    net.heard()  # The session is alive
+    trace.mqtt(topic, msg)
+    dispatcher.message(mqtt_client, topic, msg)
+
+def subscribe_all(mqtt_client):
+    dispatcher.subscribe(mqtt_client, packed=mqtt_packed == 1)  # One subscription for all time fields
 
 # Set up a MiniMQTT Client
 mqtt_client = MQTT.MQTT(
@@ -302,6 +793,7 @@ mqtt_client = MQTT.MQTT(
     password=secrets["mqtt_pass"],
     socket_pool=pool,
     ssl_context=ssl.create_default_context(),
+    client_id="magtag-clock-%s" % "".join("%02x" % i for i in wifi.radio.mac_address[3:]),  # Fixed, for a persistent session
 )
 
 # Connect callback handlers to mqtt_client
@@ -312,16 +804,15 @@ mqtt_client.on_unsubscribe = unsubscribe
 mqtt_client.on_publish = publish
 mqtt_client.on_message = message
 #print("Attempting to connect to %s" % mqtt_client.broker)
-mqtt_client.connect()
+net.use_mqtt(mqtt_client, subscribe_all)
+if log_mqtt == 1:
+    log.add(MQTTSink(mqtt_client, log_topic, lambda: net.connected))  # Published by the log task
 #print("Subscribing to %s" % mqtt_topic)
-mqtt_client.subscribe("time/time", 1)
-mqtt_client.subscribe("time/date2", 1)
-mqtt_client.subscribe("time/dowa", 1)
-mqtt_client.subscribe("time/day", 1)
-mqtt_client.subscribe("time/moya", 1)
-mqtt_client.subscribe("time/year2", 1)
-mqtt_client.subscribe("time/month", 1)
-mqtt_client.subscribe("time/hour", 1)
+if warm:
+    print("MQTT connects in the background")  # The net task runs first thing
+elif not net.connect(mqtt_boot_timeout, feed=wd.feed):  # Keeps trying from the net task if the broker is down
+    print("MQTT not connected yet:", net.stats())
+boot_timer.mark("mqtt")
 #print("Publishing to %s" % mqtt_topic)
 #mqtt_client.publish(mqtt_topic, "Hello Broker!")
 #print("Unsubscribing from %s" % mqtt_topic)
@@ -341,146 +832,25 @@ mqtt_client.subscribe("time/hour", 1)
 ###########
 ### NTP ###
 ###########
-def get_ntp_time(pool):
-    packet = bytearray(48)
-    packet[0] = 0b00100011
-
-    for i in range(1, len(packet)):
-        packet[i] = 0
-
-    with pool.socket(pool.AF_INET, pool.SOCK_DGRAM) as sock:
-        sock.settimeout(None)
-        sock.sendto(packet, (ntp_server, ntp_port))
-        sock.recv_into(packet)
-        destination = time.monotonic_ns()
-
-    seconds = struct.unpack_from("!I", packet, offset=len(packet) - 8)[0]
-    ntp_localtime_tz = seconds - ntp_time_correction + tz_offset
-    # compensate is there's more than 1s since we retrieved the time
-    return time.localtime(
-        ntp_localtime_tz + (time.monotonic_ns() - destination) // 1_000_000_000
-    )
+# Non-blocking SNTP in clock_ntp.py, stepped into the RTC, slewed into the clock after that
+def set_rtc(utc):
+    rtc.RTC().datetime = time.localtime(utc)
+    trace.rebase(utc)  # Records were timed from a boot before NTP
 
-try:
-    now = get_ntp_time(pool)
-except:
+ntp = SNTPClient(pool, ntp_server, clock, port=ntp_port, min_poll=ntp_min_poll, max_poll=ntp_max_poll, set_rtc=set_rtc, log=log)
+if warm and not woke:  # A deep sleep resync boot is here for NTP, it waits as usual
+    print("NTP syncs in the background")  # The RTC is already close, the ntp task runs first thing
+elif ntp.sync(ntp_boot_timeout):  # Bounded, the clock keeps going from the RTC if it fails
+    print("  NTP", rtc.RTC().datetime, ntp.stats())
+else:
     print("NTP Broken")
-rtc.RTC().datetime = now
-print("  NTP", now)
+if local_time == 1:
+    clock.update(now_fields)
+    apply_invert()
+sleep_state.wakes = 0
+boot_timer.mark("ntp")
 # NTP end
 
-################
-### Graphics ###
-################
-magtag.graphics.set_background(0xffffff)
-mid_x = magtag.graphics.display.width // 2 - 1
-midl_x = magtag.graphics.display.width // 2 // 2 + 9
-# text top large clock
-magtag.add_text(
-    text_font="/Digital-7-77.bdf",
-    text_color=(0x000000),
-    #text_position=(mid_x,6),
-    text_position=(midl_x, 6),
-    text_anchor_point=(0.485, 0.20),  # centre for scale 2
-    text_scale=1,
-    is_data=False,
-)
-# text bot large
-magtag.add_text(
-    text_font="/Digital-7-77.bdf",
-    text_color=(0x000000),
-    text_position=(mid_x, 68),
-    text_anchor_point=(0.485, 0.20),  # centre for scale 2
-    text_scale=1,
-    is_data=False,
-)
-# text small a
-magtag.add_text(
-    text_font="/Digital-7-38.bdf",
-    text_color=(0x000000),
-    text_position=(((magtag.graphics.display.width // 4) * 3) + 12, 5),
-    text_anchor_point=(0.5, 0.20),  # centre for scale 2
-    text_scale=1,
-    is_data=False,
-)
-# text small b
-magtag.add_text(
-    text_font="/Digital-7-38.bdf",
-    text_color=(0x000000),
-    text_position=(((magtag.graphics.display.width // 4) * 3) + 12, 35),
-    text_anchor_point=(0.5, 0.20),  # centre for scale 2
-    text_scale=1,
-    is_data=False,
-)
-# text small c
-magtag.add_text(
-    text_font="/Digital-7-38.bdf",
-    text_color=(0x000000),
-    text_position=(mid_x, 67),
-    text_anchor_point=(0.485, 0.20),  # centre for scale 2
-    text_scale=1,
-    is_data=False,
-)
-# text small d
-magtag.add_text(
-    text_font="/Digital-7-38.bdf",
-    text_color=(0x000000),
-    text_position=(mid_x, 97),
-    text_anchor_point=(0.485, 0.20),  # centre for scale 2
-    text_scale=1,
-    is_data=False,
-)
-# text micro a
-magtag.add_text(
-    text_font="/ThinPixel-7-20.bdf",
-    text_color=(0x000000),
-    text_position=(1, 119),
-    text_anchor_point=(0, 1),  # centre for scale 2
-    text_scale=1,
-    is_data=False,
-)
-# text micro b - Batt voltage
-magtag.add_text(
-    #text_font="/SmallestPixel-7-10.bdf",
-    text_font="/ThinPixel-7-20.bdf",
-    text_color=(0x000000),
-    text_position=(magtag.graphics.display.width + 1, 120),
-    text_anchor_point=(1, 1),  # centre for scale 2
-    text_scale=1,
-    is_data=False,
-)
-if invert_enable == 1:
-    if mqtt_sub_hour <= invert_start and mqtt_sub_hour >= invert_stop:
-        #print("DayVision")
-        magtag.graphics.set_background(0xffffff)
-        magtag.set_text_color(0x000000, index=0)
-        magtag.set_text_color(0x000000, index=1)
-        magtag.set_text_color(0x000000, index=2)
-        magtag.set_text_color(0x000000, index=3)
-        magtag.set_text_color(0x000000, index=4)
-        magtag.set_text_color(0x000000, index=5)
-        magtag.set_text_color(0x000000, index=6)
-        magtag.set_text_color(0x000000, index=7)
-    else:
-        #print("NightVision")
-        magtag.graphics.set_background(0x000000)
-        magtag.set_text_color(0xffffff, index=0)
-        magtag.set_text_color(0xffffff, index=1)
-        magtag.set_text_color(0xffffff, index=2)
-        magtag.set_text_color(0xffffff, index=3)
-        magtag.set_text_color(0xffffff, index=4)
-        magtag.set_text_color(0xffffff, index=5)
-        magtag.set_text_color(0xffffff, index=6)
-        magtag.set_text_color(0xffffff, index=7)
-# Graphics end
-
-# check if time.monotonic() was longer than 60s ago
-def time_mono_sixty():
-    global time_mono_last
-    if time.monotonic() - time_mono_last > 60:
-        time_mono_last = time.monotonic()
-        return True
-    return False
 
 # convert bytes to KB/MB/GB etc.
 def convert_bytes(num):
@@ -493,124 +863,264 @@ def convert_bytes(num):
 ##################################################
 ### Make a noise to signify starting main loop ###
 ##################################################
-magtag.peripherals.speaker_disable = False
-magtag.peripherals.play_tone(1046.50, 0.125)  # C6
-#time.sleep(0.125)
-magtag.peripherals.play_tone(1318.51, 0.125)  # E6
-magtag.peripherals.speaker_disable = True
-
-wd.feed()  # Feed watchdog
-
-while True:
-    try:
-        mqtt_client.loop()
-    except (ValueError, RuntimeError) as e:
-        print("Failed to get data, retrying\n", e)
-        wifi.reset()
-        mqtt_client.reconnect()
-        continue
+if not warm:  # Quiet after a reset or a deep sleep resync
+    sound(BOOT)  # C6, E6, played once the tasks run
 
+#############
+### Tasks ###
+#############
+# Each subsystem is a task with its own deadline, see clock_tasks.py
+def mqtt_task():
+    if not net.connected:
+        return  # The net task reconnects
     try:
-        data, addr = udp_sock.recvfrom_into(packet)  # Receive UDP data
-        print("RX: Size:", data, "Data:", str(packet[:data]), "\nDecoded:", packet[:data - 1].decode("utf-8")) # Print received data
-        exec(str(packet[:data - 1].decode("utf-8"))) # Execute received data
-    except Exception as err:
-        if "EAGAIN" in str(err): # If no data received, skip
-            pass
-        else: # If error, print
-            print("Error:", err)
-
-    if time_mono_sixty() == True: # If more than 60s since last update
-        print("  Sixty seconds passed...")
-        if invert_enable == 1:
-            if mqtt_sub_hour <= invert_start and mqtt_sub_hour >= invert_stop:
-                #print("DayVision")
-                magtag.graphics.set_background(0xffffff)
-                magtag.set_text_color(0x000000, index=0)
-                magtag.set_text_color(0x000000, index=1)
-                magtag.set_text_color(0x000000, index=2)
-                magtag.set_text_color(0x000000, index=3)
-                magtag.set_text_color(0x000000, index=4)
-                magtag.set_text_color(0x000000, index=5)
-                magtag.set_text_color(0x000000, index=6)
-                magtag.set_text_color(0x000000, index=7)
-            else:
-                #print("NightVision")
-                magtag.graphics.set_background(0x000000)
-                magtag.set_text_color(0xffffff, index=0)
-                magtag.set_text_color(0xffffff, index=1)
-                magtag.set_text_color(0xffffff, index=2)
-                magtag.set_text_color(0xffffff, index=3)
-                magtag.set_text_color(0xffffff, index=4)
-                magtag.set_text_color(0xffffff, index=5)
-                magtag.set_text_color(0xffffff, index=6)
-                magtag.set_text_color(0xffffff, index=7)
-        try:
-            print("    TimeNTP:", get_ntp_time(pool))
-            print("    TimeRTC:", rtc.RTC().datetime)
-        except:
-            print("NTP BROKE")
-
-    if mqtt_sub_time != mqtt_sub_time_old: # If time changed do stuff
-        magtag.set_text(mqtt_sub_time, index=0, auto_refresh=False)
-        magtag.set_text("", index=1, auto_refresh=False)
-        magtag.set_text(mqtt_sub_dowa + " " + mqtt_sub_moya, index=2, auto_refresh=False)
-        magtag.set_text(mqtt_sub_day + "." + mqtt_sub_month + "." + mqtt_sub_year2, index=3, auto_refresh=False,)
-        magtag.set_text("Light: " + str(magtag.peripherals.light), index=4, auto_refresh=False)
-        magtag.set_text(str(round(magtag.peripherals.battery, 2)) + "v", index=5, auto_refresh=False)
-        magtag.set_text("L:" + str(int(round(100 * (magtag.peripherals.light - 556) / (52487 - 556), 0))) + "% " + str(magtag.peripherals.light), index=6, auto_refresh=False)
-        magtag.set_text(str(round(magtag.peripherals.battery, 2)) + "v", index=7, auto_refresh=False)
-        if int(round(100 * (magtag.peripherals.battery - 3.71) / (4.175 - 3.71), 0)) > 100:
-            magtag.set_text("Chg " + str(int(round(100 * (magtag.peripherals.battery - 3.71) / (4.175 - 3.71), 0))) + "% " + str(round(magtag.peripherals.battery, 2)) + "v", index=7, auto_refresh=True)
+        for _ in range(mqtt_drain):  # minimqtt handles one message per loop()
+            if mqtt_client.loop(mqtt_timeout) is None:
+                break
+    except (ValueError, RuntimeError, OSError, MQTT.MMQTTException) as e:
+        log.warning("Failed to get data, reconnecting: %s", e)
+        net.lost(e)
+        scheduler.wake("net")
+        return
+    if dispatcher.commit():  # Apply everything received this task at once
+        log.debug("  MQTT time: %s", mqtt_sub)
+        if local_time == 1:  # Only used to catch a badly drifted RTC
+            # Only with a time and hour sent together, not a fresh time and a stale hour
+            if "time" in dispatcher.last and "hour" in dispatcher.last and clock.discipline_minutes(mqtt_sub.hour, int(mqtt_sub.time[3:5])):
+                trace.rebase(clock.utc())
         else:
-            magtag.set_text(str(int(round(100 * (magtag.peripherals.battery - 3.71) / (4.175 - 3.71), 0))) + "% " + str(round(magtag.peripherals.battery, 2)) + "v", index=7, auto_refresh=True)
-        print("  Updating screen...")
-
-    if mqtt_sub_hour != mqtt_sub_hour_old and hour_chime == 1: # If hour changed do stuff
-        if mqtt_sub_hour >= hour_chime_start and mqtt_sub_hour <= hour_chime_stop:
-            print("  Hourchime!")
-            magtag.peripherals.speaker_disable = False
-            magtag.peripherals.play_tone(4096, 0.125)  # C8 minus 38 cents
-            time.sleep(0.125)
-            magtag.peripherals.play_tone(4096, 0.125)  # C8 minus 38 cents
-            magtag.peripherals.speaker_disable = True
-    mqtt_sub_time_old = mqtt_sub_time
-    mqtt_sub_hour_old = mqtt_sub_hour
-
-    if lis.tapped == True and tap_enable == 1: # If tap detected do stuff
-        print("  LIS3DH tapped!")
+            update_display()
+
+def udp_task():
+    commands.poll(udp_sock, packet, trace.udp)  # Replies to every command, see clock_commands.py
+
+# Runs on each minute boundary with local_time, or when MQTT time arrives
+def update_display():
+    global time_old, hour_old
+    if local_time == 1:
+        clock.update(now_fields)
+    if now_fields.hour != hour_old:
+        apply_invert()  # MQTT time can arrive after the theme task ran
+    if now_fields.time != time_old or renderer.dirty: # If time (or theme) changed do stuff
+        draw_frame(frame_texts())
+        if log.enabled(DEBUG):  # Only build the stats if they go somewhere
+            log.debug("  Updating screen... %s %s", renderer.stats(), refresher.stats())
+    if now_fields.hour != hour_old and hour_chime == 1: # If hour changed do stuff
+        hourly_chime(now_fields.hour)
+    time_old = now_fields.time
+    hour_old = now_fields.hour
+    if deep_sleep == 1 and local_time == 1 and tap_counter == 0:
+        deep_sleep_until_next_minute()  # Does not return unless the minute just turned
+    if local_time == 1:
+        return clock.seconds_to_next_minute(policy.settings["display"])  # Every few minutes in the dark
+
+tone_task = profiler.wrap("chime", tones.step)  # Next note, returns None when done
+
+def sixty_task():
+    if not log.enabled(DEBUG):  # All of it is stats, the "stats" command has them too
+        return
+    log.debug("  Sixty seconds passed...")
+    log.debug("    TimeRTC: %s Drift: %s s/day", rtc.RTC().datetime, clock.drift)
+    log.debug("    NTP: %s", ntp.stats())
+    log.debug("  Tasks: %s", scheduler.stats())
+    log.debug("  Net: %s", net.stats())
+    log.debug("  Profile: %s", profiler.stats())
+    log.debug("  Theme: %s", theme.stats())
+    log.debug("  Tones: %s", tones.stats())
+    log.debug("  Policy: %s", policy.stats())
+    log.debug("  Log: %s", log.stats())
+    log.debug("  Energy: %s", energy.report(sensors.batt_pc))
+    log.debug("  Telemetry: %s", telemetry.stats())
+    log.debug("  Trace: %s", trace.stats())
+    if tap_enable == 1 and tap_irq == 1:
+        log.debug("  Taps: %s", taps.stats())
+
+# Runs at invert_start and invert_stop (and at least hourly)
+def theme_task():
+    refresher.clean()  # A quiet moment to clear the ghosting of partial updates
+    if apply_invert():
+        log.info("  Theme: %s", theme.stats())
+        if not scheduler.wake("display"):  # Redraw with the next frame if there is a display task
+            renderer.refresh()
+    return seconds_to_change(clock.local(), invert_start, invert_stop)
+
+def tap_task():
+    global tap_counter, tap_total
+    if taps.poll() if tap_irq == 1 else lis.tapped: # If tap detected do stuff
+        log.info("  LIS3DH tapped!")
+        tap_total += 1
+        trace.tap()
         if tap_counter == 0:
-            print("    Tap Beep!")
-            magtag.peripherals.speaker_disable = False
-            magtag.peripherals.play_tone(4096, 0.125)
-            magtag.peripherals.speaker_disable = True
+            log.info("    Tap Beep!")
+            sound(TAP)
         tap_counter = tap_duration
-        print("    Tap Lights on!")
+        log.info("    Tap Lights on!")
         magtag.peripherals.neopixels.fill((1, 1, 1))
-    if tap_counter > 0:
-        tap_counter -= 1
-        print("  Tap timer:", tap_counter)
-        if tap_counter == 0:
-            print("    Tap Lights off!")
-            magtag.peripherals.neopixels.fill((0, 0, 0))
+        energy.start("neopixel")
+        scheduler.call_later("tap_off", tap_duration, tap_lights_off)
+        policy.tapped()  # Someone is looking, full speed for policy_active seconds
+        update_policy()
 
-    ### Prepare for sleep ###
+def tap_lights_off():
+    global tap_counter
+    tap_counter = 0
+    log.info("    Tap Lights off!")
+    magtag.peripherals.neopixels.fill((0, 0, 0))
+    energy.stop("neopixel")
+
+def sensors_task():
+    sensors.sample(force=True)  # Fills the smoothing ring between frames
+    trace.sensors(sensors.raw_light, sensors.raw_battery)  # Only if it moved
+    energy.battery(sensors.battery, sensors.charging)  # For the runtime trend, every 10 minutes
+    update_policy()
+
+# Pick the policy for the light, battery and taps, see clock_policy.py
+def update_policy():
+    global idle_check
+    if policy_enable != 1:
+        return
+    settings = policy.update(sensors.light_pc, sensors.battery, sensors.charging)  # None if it stays
+    if settings is None:
+        return
+    scheduler.set_period("mqtt", settings["mqtt"])  # The radio wakes less
+    idle_check = idle_slice(settings["udp"], settings["tap"])
+    if light_sleep == 1:
+        scheduler.set_period("udp", settings["udp"])
+    if tap_irq != 1:
+        scheduler.set_period("tap", max(settings["tap"], tap_period))  # Never faster than configured
+    scheduler.set_period("sensors", settings["sensors"])
+    scheduler.set_period("housekeeping", settings["housekeeping"])
+    sensors.period = settings["sensors"]
+    scheduler.wake("display")  # Catch up now if it was a tap in the dark
+
+def housekeeping_task():
     #print("  RAM Used:", convert_bytes(gc.mem_alloc()))
     #print("  RAM Free:", convert_bytes(gc.mem_free()))
-    print("  Light:", magtag.peripherals.light)
-    print("  Batt: ", magtag.peripherals.battery, "v", sep='')
-    #print("Sleep:", mqtt_sub_time, "%.3f" %(supervisor.ticks_ms() / 1_000))
-    #print("Sleep:", mqtt_sub_time, "%.3f" %((supervisor.ticks_ms() / 1_000) - (time.monotonic_ns() / 1_000_000_000)))
-    print("Sleep:", mqtt_sub_time, "%.3f" %(time.monotonic_ns() / 1_000_000_000), "\n")
+    log.debug("  Light: %d", sensors.light)
+    log.debug("  Batt: %sv", sensors.battery)
+    collect()  # Force garbage collection
+
+collect = profiler.wrap("gc", gc.collect)
+
+def stats_task():
+    if not net.connected:
+        return
+    try:
+        mqtt_client.publish(stats_topic, profiler.snapshot("refresh=%d skip=%d mA=%.1f" % (renderer.refreshes, renderer.skipped_refreshes, sum(energy.per_hour().values()))))
+    except (ValueError, RuntimeError, OSError, MQTT.MMQTTException) as e:
+        log.warning("Stats publish failed: %s", e)
+        net.lost(e)
+        scheduler.wake("net")
+
+def telemetry_sample_task():
+    telemetry.sample(clock.utc(), time.monotonic() - boot_start, (sensors.light, sensors.battery, tap_total))
+
+def telemetry_task():
+    telemetry.close()  # Sealed even if it can't go yet, it waits in the backlog
+    if not net.connected:
+        return
+    try:
+        telemetry.publish(mqtt_client, telemetry_topic)
+    except (ValueError, RuntimeError, OSError, MQTT.MMQTTException) as e:
+        log.warning("Telemetry publish failed: %s", e)
+        net.lost(e)
+        scheduler.wake("net")
+
+# Sleep between deadlines
+def nap(seconds):
+    #log.debug("Sleep: %s %.3f", now_fields.time, supervisor.ticks_ms() / 1_000)
     led.value = False  # Turn off LED to signify sleep
-    gc.collect()  # Force garbage collection
     wd.feed()  # Feed watchdog
-    #magtag.enter_light_sleep(sleep_time) # Turns off NeoPixels and Speaker
-    time.sleep(sleep_time)
+    #magtag.enter_light_sleep(seconds) # Turns off NeoPixels and Speaker
+    asleep = "light_sleep" if light_sleep == 1 and not tones.busy else "sleep"
+    energy.start(asleep)
+    if asleep == "light_sleep":  # PWM stops in light sleep
+        time_alarm = alarm.time.TimeAlarm(monotonic_time=time.monotonic() + seconds)
+        if tap_enable == 1 and tap_irq == 1:
+            if taps.woke(alarm.light_sleep_until_alarms(time_alarm, taps.alarm())):
+                scheduler.wake("tap")  # Handle the tap now, not at the next poll
+        else:
+            alarm.light_sleep_until_alarms(time_alarm)
+    else:
+        wait(seconds)
+    energy.stop(asleep)
     ### Awaken ###
     wd.feed()  # Feed watchdog
-    #print("Awake:", mqtt_sub_time, "%.3f" %(supervisor.ticks_ms() / 1_000))
-    #print("Awake:", mqtt_sub_time, "%.3f" %((supervisor.ticks_ms() / 1_000) - (time.monotonic_ns() / 1_000_000_000)))
-    print("Awake:", mqtt_sub_time, "%.3f" %(time.monotonic_ns() / 1_000_000_000))
     led.value = True  # Turn on LED to signify awake
+
+# time.sleep in slices of idle_check, cut short by a tap latched on INT1 or a
+# waiting datagram.  A GPIO read and a non-blocking recv instead of waking
+# the scheduler for tap and UDP tasks several times a second.
+def wait(seconds):
+    end = time.monotonic() + seconds
+    while True:
+        if tap_enable == 1 and tap_irq == 1 and taps.pending:
+            scheduler.wake("tap")
+            return
+        if commands.receive(udp_sock, packet):  # Left for the udp task to answer
+            scheduler.wake("udp")
+            return
+        left = end - time.monotonic()
+        if left <= 0:
+            return
+        time.sleep(min(left, idle_check))
+
+# Longest a tap or a command waits in the idle wait
+def idle_slice(udp, tap):
+    return min(udp, tap) if tap_enable == 1 and tap_irq == 1 else udp
+
+idle_check = idle_slice(udp_poll, tap_poll)
+# The idle wait (or in light sleep the INT1 alarm) wakes the tap task, the
+# poll is only a backstop.  Light sleep can't look at the socket.
+tap_period = 60 if tap_irq == 1 else tap_poll
+udp_period = udp_poll if light_sleep == 1 else 60
+scheduler = Scheduler(idle=nap, max_idle=wd.timeout / 3)
+if tones.busy:
+    scheduler.call_later("tone", 0, tone_task)  # The boot jingle
+scheduler.every("net", net.idle, metered("wifi", net.step), delay=net.idle if net.ready else 0)
+scheduler.every("mqtt", mqtt_poll, profiler.wrap("mqtt", metered("mqtt", mqtt_task)))
+scheduler.every("udp", udp_period, profiler.wrap("udp", udp_task))
+scheduler.every("sixty", 60, sixty_task, delay=60)
+scheduler.every("ntp", ntp_min_poll, profiler.wrap("ntp", metered("ntp", ntp.step)), delay=0 if warm and not woke else ntp.poll)
+if local_time == 1:
+    scheduler.every("display", 60, profiler.wrap("display", update_display))
+if invert_enable == 1:
+    scheduler.every("theme", 3600, theme_task, delay=seconds_to_change(clock.local(), invert_start, invert_stop))
+if tap_enable == 1:
+    scheduler.every("tap", tap_period, profiler.wrap("tap", tap_task))
+scheduler.every("sensors", sensor_period, profiler.wrap("sensors", sensors_task))
+scheduler.every("housekeeping", sleep_time, housekeeping_task)
+if stats_interval > 0:
+    scheduler.every("stats", stats_interval, stats_task, delay=stats_interval)
+if warm_boot == 1:
+    scheduler.every("boot_cache", boot_cache_period, save_boot_cache, delay=60)  # After the first frames are drawn
+if telemetry_enable == 1:
+    scheduler.every("telemetry_sample", telemetry_sample, telemetry_sample_task, delay=telemetry_sample)
+    scheduler.every("telemetry", telemetry_period, telemetry_task, delay=telemetry_period)
+if log_udp or log_mqtt == 1:
+    scheduler.every("log", log_flush, log.flush, delay=log_flush)
+if trace_udp and trace_enable == 1:
+    scheduler.every("trace", trace_flush, trace.flush, delay=trace_flush)
+
+boot_timer.mark("tasks")
+print("Boot %s:" % ("warm" if warm else "cold"), boot_timer.report())
+wd.feed()  # Feed watchdog
+
+# Save the log ring and the input trace to nvm and start again, both are recovered at the next boot
+def crash(e):
+    wd.mode = WatchDogMode.RESET  # If saving hangs the watchdog still resets it
+    wd.feed()
+    log.error("Crash: %r", e)
+    log.dump(nvm, log_nvm_offset)
+    if trace_enable == 1:
+        trace.save(nvm, trace_nvm_offset)  # What led up to it, for tools/sim/replay.py
+    microcontroller.reset()
+
+if log_crash_dump == 1:
+    wd.mode = WatchDogMode.RAISE  # A timeout raises WatchDogTimeout in the loop instead of resetting
+    try:
+        scheduler.run()
+    except Exception as e:  # The watchdog timeout too
+        crash(e)
+scheduler.run()
 # EOF
@@ -0,0 +1,107 @@
+#####################################
+### clock_commands.py on the host ###
+#####################################
+#
+#   pytest tests
+
+import errno
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from clock_commands import CommandError, CommandRegistry  # noqa: E402
+from clock_log import DEBUG, INFO, Logger  # noqa: E402
+
+
+class Socket:
+    def __init__(self, *datagrams):
+        self.inbox = list(datagrams)
+        self.sent = []
+
+    def recvfrom_into(self, buffer):
+        if not self.inbox:
+            raise OSError(errno.EAGAIN, "EAGAIN")
+        data = self.inbox.pop(0)
+        buffer[: len(data)] = data
+        return len(data), ("10.1.0.2", 40000)
+
+    def sendto(self, data, address):
+        self.sent.append(bytes(data))
+
+
+def fail(args):
+    raise CommandError("no")
+
+
+def registry():
+    commands = CommandRegistry()
+    commands.register("echo", lambda args: args, "say it back")
+    commands.register("fail", fail)
+    return commands
+
+
+def test_handle():
+    commands = registry()
+    assert commands.handle(b"7|echo hi;help echo;help nope") == b"7|ok hi;ok say it back;ok unknown"
+    assert commands.handle(b"echo x") == b"|ok x"  # no sequence number
+    assert commands.handle(b"1|fail;nope") == b"1|err no;err unknown nope"
+    assert commands.errors == 2
+
+
+def test_error_keeps_reply_separators_out():
+    commands = registry()
+    commands.register("bad", lambda args: int("1;2|3"))
+    reply = commands.handle(b"4|bad;echo ok")
+    assert reply == b"4|err invalid literal for int() with base 10: '1,2/3';ok ok"
+    assert commands.handle(b"5|x|y") == b"5|err unknown x/y"
+
+
+def test_not_utf8():
+    commands = registry()
+    assert commands.handle(b"\xff\xfe") == b"|err not utf-8"
+    assert commands.errors == 1
+
+
+def test_poll_answers_everything_waiting():
+    commands = registry()
+    sock = Socket(b"1|echo a", b"\xff\xfe", b"2|echo b")
+    seen = []
+    commands.poll(sock, bytearray(64), seen.append)
+    assert sock.sent == [b"1|ok a", b"|err not utf-8", b"2|ok b"]
+    assert [bytes(data) for data in seen] == [b"1|echo a", b"\xff\xfe", b"2|echo b"]
+
+
+def test_receive_leaves_the_datagram_for_poll():
+    commands = registry()
+    sock = Socket(b"3|echo c")
+    buffer = bytearray(64)
+    assert commands.receive(sock, buffer)
+    assert commands.receive(sock, buffer)  # still the same one
+    assert sock.sent == []
+    commands.poll(sock, buffer)
+    assert sock.sent == [b"3|ok c"]
+    assert not commands.receive(sock, buffer)
+
+
+class Sink:
+    def __init__(self, level):
+        self.level = level
+        self.lines = []
+
+    def write(self, now, level, text):
+        self.lines.append(text)
+
+    def flush(self):
+        pass
+
+
+def test_logs_through_the_logger():
+    log = Logger(INFO)
+    sink = log.add(Sink(DEBUG))
+    commands = CommandRegistry(log=log)
+    commands.poll(Socket(b"1|help"), bytearray(64))
+    assert sink.lines == []  # each reply is a debug record
+    log.set_level(DEBUG)
+    commands.poll(Socket(b"2|help"), bytearray(64))
+    assert sink.lines == ["UDP ('10.1.0.2', 40000) b'2|ok exec help'"]
@@ -0,0 +1,98 @@
+#####################################
+### clock_energy.py on the host   ###
+#####################################
+#
+#   pytest tests
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from clock_energy import EnergyMeter  # noqa: E402
+
+MODEL = {
+    "cpu": (20, 0),
+    "sleep": (10, 0),
+    "mqtt": (60, 0),
+    "wifi": (90, 0),
+    "ntp": (70, 1),
+    "eink": (0, 16),
+}
+
+
+class Clock:
+    def __init__(self):
+        self.now = 100.0
+
+    def monotonic(self):
+        return self.now
+
+    def spend(self, seconds):
+        self.now += seconds
+
+
+# Two hours of minutes: a 1 s MQTT wait, a 0.5 s refresh, 0.5 s of other
+# work and 58 s asleep, the battery falling 10 mV an hour
+def two_hours(meter, clock):
+    mqtt = meter.wrap("mqtt", lambda: clock.spend(1.0))
+    eink = meter.wrap("eink", lambda: clock.spend(0.5))
+    for minute in range(120):
+        meter.battery(4.0 - 0.01 * minute / 60)
+        mqtt()
+        eink()
+        clock.spend(0.5)
+        meter.start("sleep")
+        clock.spend(58.0)
+        meter.stop("sleep")
+
+
+def test_charge_per_activity():
+    clock = Clock()
+    meter = EnergyMeter(MODEL, monotonic=clock.monotonic)
+    two_hours(meter, clock)
+    charge = meter.charge()
+    assert charge["mqtt"] == pytest.approx(120 * 60)
+    assert charge["eink"] == pytest.approx(120 * 16)  # per refresh, not per second
+    assert charge["sleep"] == pytest.approx(120 * 58 * 10)
+    assert charge["cpu"] == pytest.approx(120 * 0.5 * 20)
+    assert charge["wifi"] == charge["ntp"] == 0
+    rates = meter.per_hour()
+    assert rates["mqtt"] == pytest.approx(1.0)
+    assert sum(rates.values()) == pytest.approx(79920 / 7200)
+
+
+def test_runtime():
+    clock = Clock()
+    meter = EnergyMeter(MODEL, capacity=420, empty=3.71, monotonic=clock.monotonic)
+    assert meter.runtime(50) == (None, None)
+    two_hours(meter, clock)
+    by_trend, by_model = meter.runtime(50)
+    # last sample 3.9817 V at -0.01 V/h, 3.71 V is empty
+    assert by_trend == pytest.approx((4.0 - 0.01 * 119 / 60 - 3.71) / 0.01, rel=0.01)
+    assert by_model == pytest.approx(210 / (79920 / 7200))
+    assert meter.hours_left(50) == by_trend
+    meter.battery(4.1, charging=True)  # the trend starts again off the charger
+    assert meter.runtime(50)[0] is None
+    assert meter.hours_left(50) == by_model
+
+
+def test_nested_and_background():
+    clock = Clock()
+    meter = EnergyMeter(MODEL, monotonic=clock.monotonic)
+    ntp = meter.wrap("ntp", lambda: clock.spend(2.0))
+
+    def join():
+        clock.spend(3.0)
+        ntp()
+
+    meter.wrap("wifi", join)()
+    meter.start("sleep")
+    clock.spend(10.0)
+    charge = meter.charge()  # sleep still running
+    assert charge["wifi"] == pytest.approx(3 * 90)  # not the 2 s of NTP inside it
+    assert charge["ntp"] == pytest.approx(2 * 70 + 1)
+    assert charge["sleep"] == pytest.approx(10 * 10)
+    assert charge["cpu"] == pytest.approx(0)
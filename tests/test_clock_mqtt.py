@@ -0,0 +1,56 @@
+#####################################
+### clock_mqtt.py on the host     ###
+#####################################
+#
+#   pytest tests
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from clock_mqtt import TopicDispatcher  # noqa: E402
+from clock_time import TimeFields  # noqa: E402
+
+
+def test_staged_until_commit():
+    fields = TimeFields()
+    dispatcher = TopicDispatcher(fields)
+    dispatcher.message(None, "time/time", "12:00")
+    dispatcher.message(None, "time/hour", "12")
+    dispatcher.message(None, "time/other", "x")
+    assert fields.time == "00:00"  # nothing drawn half way
+    assert dispatcher.commit()
+    assert (fields.time, fields.hour) == ("12:00", 12)
+    assert set(dispatcher.last) == {"time", "hour"}
+    assert (dispatcher.received, dispatcher.ignored) == (2, 1)
+    assert not dispatcher.commit()  # nothing staged
+
+
+def test_last_is_only_the_latest_commit():
+    dispatcher = TopicDispatcher(TimeFields())
+    dispatcher.message(None, "time/hour", "7")
+    dispatcher.commit()
+    dispatcher.message(None, "time/time", "07:01")
+    dispatcher.commit()
+    assert dispatcher.last == ("time",)  # a time without its hour, no discipline
+
+
+def test_packed_state():
+    fields = TimeFields()
+    dispatcher = TopicDispatcher(fields)
+    dispatcher.message(None, "time/state", "26101812340")
+    dispatcher.commit()
+    assert (fields.time, fields.hour, fields.date, fields.dowa, fields.moya) == ("12:34", 12, "18.10.26", "Sun", "Oct")
+    assert set(dispatcher.last) >= {"time", "hour"}
+
+
+def test_bad_payload():
+    fields = TimeFields()
+    dispatcher = TopicDispatcher(fields)
+    dispatcher.message(None, "time/hour", "noon")
+    dispatcher.message(None, "time/state", "2610")
+    dispatcher.message(None, "time/state", "26001812340")  # month 00
+    dispatcher.message(None, "time/state", "26131812340")
+    assert dispatcher.errors == 4
+    assert not dispatcher.commit()
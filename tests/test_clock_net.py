@@ -0,0 +1,57 @@
+#####################################
+### clock_net.py on the host      ###
+#####################################
+#
+#   pytest tests
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from clock_net import ConnectionManager  # noqa: E402
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+# Fails joins until up_at, every attempt takes its 10 s timeout
+class Radio:
+    def __init__(self, clock, up_at):
+        self._clock = clock
+        self.up_at = up_at
+        self.ipv4_address = None
+        self.joins = 0
+
+    def connect(self, ssid, password, channel=0, bssid=None, timeout=None):
+        self.joins += 1
+        self._clock.now += timeout
+        if self._clock.now < self.up_at:
+            raise ConnectionError("No network with that ssid")
+        self.ipv4_address = "10.1.0.9"
+
+
+def test_connect_feeds_through_a_long_backoff():
+    clock = Clock()
+    radio = Radio(clock, up_at=1800)
+    net = ConnectionManager(radio, "ssid", "password", max_backoff=300, monotonic=clock.monotonic)
+    feeds = []
+    assert net.connect(feed=lambda: feeds.append(clock.now), sleep=clock.sleep, feed_every=10)
+    assert radio.joins > 5
+    gaps = [b - a for a, b in zip([0.0] + feeds, feeds + [clock.now])]
+    assert max(gaps) <= 10 + 1e-9  # a backoff slice or one join, never more
+
+
+def test_connect_gives_up_after_timeout():
+    clock = Clock()
+    net = ConnectionManager(Radio(clock, up_at=10**9), "ssid", "password", monotonic=clock.monotonic)
+    assert not net.connect(timeout=120, sleep=clock.sleep)
+    assert clock.now < 120 + 10 + 1  # at most one join past the end
@@ -0,0 +1,160 @@
+#####################################
+### clock_ntp.py on the host      ###
+#####################################
+#
+#   pytest tests
+
+import errno
+import math
+import os
+import struct
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from clock_log import Logger  # noqa: E402
+from clock_ntp import SNTPClient, to_ntp  # noqa: E402
+from clock_time import LocalClock  # noqa: E402
+
+RTC = 1_700_000_000  # what the RTC reads at monotonic 0
+
+
+# A server behind a scripted network.  Each request takes the next plan:
+# (out, back) seconds each way, None for a lost packet, or (out, back, t1)
+# for a reply to some other request.  Unplanned requests get 25 ms each way.
+# Delays are kept on the client's 50 ms step so it sees replies as they land.
+class Network:
+    def __init__(self):
+        self.mono = 1000.0
+        self.offset = 0.0  # true time minus what the RTC reads
+        self.plans = []
+        self.inbox = []  # (monotonic at arrival, reply)
+        self.sent = []
+
+    def true(self, mono):
+        return RTC + mono + self.offset
+
+    # the pool, the socket and the server in one
+    AF_INET = 2
+    SOCK_DGRAM = 2
+
+    def socket(self, family, kind):
+        return self
+
+    def setblocking(self, flag):
+        pass
+
+    def close(self):
+        pass
+
+    def sendto(self, packet, address):
+        self.sent.append(address)
+        plan = self.plans.pop(0) if self.plans else (0.025, 0.025)
+        if plan is None:
+            return
+        out, back = plan[:2]
+        reply = bytearray(48)
+        reply[0] = 0b00100100  # version 4, server
+        reply[24:32] = packet[40:48] if len(plan) == 2 else struct.pack("!II", *to_ntp(plan[2]))
+        t2 = self.true(self.mono + out)
+        struct.pack_into("!IIII", reply, 32, *to_ntp(t2), *to_ntp(t2))
+        self.inbox.append((self.mono + out + back, reply))
+        self.inbox.sort(key=lambda arrival: arrival[0])
+
+    def recv_into(self, buffer):
+        if not self.inbox or self.inbox[0][0] > self.mono + 1e-9:
+            raise OSError(errno.EAGAIN, "no data")
+        buffer[:48] = self.inbox.pop(0)[1]
+        return 48
+
+
+def client(network, **kwargs):
+    clock = LocalClock(0, now=lambda: RTC + network.mono)
+    ntp = SNTPClient(network, "10.1.0.1", clock, monotonic=lambda: network.mono, log=Logger(monotonic=lambda: network.mono), **kwargs)
+    return ntp, clock
+
+
+# Steps the client through one whole burst and on to the next poll, which
+# starts on a whole second so the clock's integer reading is exact there
+def burst(ntp, network):
+    sent = ntp.sent + ntp.lost
+    wait = ntp.step()
+    while ntp.sent + ntp.lost == sent or wait < 1:
+        network.mono = math.ceil(network.mono + wait) if wait >= 1 else network.mono + wait
+        wait = ntp.step()
+    return wait
+
+
+def test_first_burst_steps_clock():
+    network = Network()
+    network.offset = 5.0
+    ntp, clock = client(network)
+    burst(ntp, network)
+    assert ntp.synced
+    assert clock.correction == 5
+    assert (ntp.sent, ntp.received, ntp.lost) == (4, 4, 0)
+    assert network.sent == [("10.1.0.1", 123)] * 4
+    assert ntp.poll == 64  # 5 s out, not stable yet
+
+
+def test_lowest_delay_sample_wins():
+    network = Network()
+    network.offset = 5.0
+    network.plans = [(0.3, 0.05), (0.03, 0.02), (0.05, 0.4), (0.2, 0.2)]
+    ntp, clock = client(network)
+    burst(ntp, network)
+    assert ntp.delay == pytest.approx(0.05, abs=1e-3)
+    assert ntp.offset == pytest.approx(5.0 + (0.03 - 0.02) / 2, abs=1e-3)
+    assert clock.correction == 5
+
+
+def test_reply_to_other_request_rejected():
+    network = Network()
+    network.offset = 5.0
+    # the quickest reply carries another request's originate timestamp and a
+    # time ten seconds out, it must not count
+    network.plans = [(0.1, 0.1), (0.001, 0.001, RTC + 10), (0.1, 0.1), (0.1, 0.1)]
+    ntp, clock = client(network)
+    burst(ntp, network)
+    assert (ntp.received, ntp.lost) == (3, 1)
+    assert ntp.delay == pytest.approx(0.2, abs=1e-3)
+    assert clock.correction == 5
+
+
+def test_poll_backoff_and_reset():
+    network = Network()
+    network.offset = 5.0
+    ntp, clock = client(network, min_poll=64, max_poll=256)
+    polls = []
+    for _ in range(4):
+        burst(ntp, network)
+        polls.append(ntp.poll)
+    assert polls == [64, 128, 256, 256]  # the first sync steps, then doubles to max_poll
+    assert clock.correction == 5
+
+    network.offset = 6.5  # drifted past tolerance, slewed rather than stepped
+    burst(ntp, network)
+    assert ntp.poll == 64
+    assert clock.correction == 6 and ntp.slew == 0  # the whole second, the fraction is below RTC resolution
+    burst(ntp, network)
+    assert ntp.poll == 128  # 0.5 s still out, within tolerance, doubles from the minimum
+    assert clock.correction == 6
+
+
+def test_every_packet_lost():
+    network = Network()
+    network.offset = 5.0
+    ntp, clock = client(network, max_poll=1024)
+    for _ in range(3):
+        burst(ntp, network)
+    assert ntp.poll == 256
+    offset = ntp.offset
+    network.plans = [None] * 4
+    wait = burst(ntp, network)
+    assert (ntp.sent, ntp.received, ntp.lost) == (16, 12, 4)
+    assert ntp.poll == 64 and wait == pytest.approx(64, abs=0.1)  # back to the minimum
+    assert ntp.offset == offset and clock.correction == 5  # the clock keeps going
+    burst(ntp, network)
+    assert ntp.received == 16 and ntp.poll == 128
@@ -0,0 +1,87 @@
+#####################################
+### clock_refresh.py on the host  ###
+#####################################
+#
+#   pytest tests
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from clock_display import LabelRenderer  # noqa: E402
+from clock_refresh import RefreshScheduler, merge  # noqa: E402
+
+
+class Panel:
+    def __init__(self):
+        self.frames = []
+
+    def full(self):
+        self.frames.append(None)
+
+    def partial(self, areas):
+        self.frames.append(list(areas))
+
+
+class MagTag:
+    def __init__(self):
+        self.texts = {}
+
+    def set_text(self, text, index=0, auto_refresh=True):
+        self.texts[index] = text
+
+
+def test_merge():
+    areas = merge([], (0, 0, 10, 10))
+    merge(areas, (100, 0, 10, 10))
+    assert areas == [(0, 0, 10, 10), (100, 0, 10, 10)]
+    merge(areas, (5, 5, 100, 2))  # joins both
+    assert areas == [(0, 0, 110, 10)]
+    assert merge(areas, (0, 0, 0, 5)) == [(0, 0, 110, 10)]  # nothing to add
+
+
+def test_partial_then_full():
+    panel = Panel()
+    refresher = RefreshScheduler(296, 128, panel.full, panel.partial, full_every=2)
+    assert refresher.refresh([(0, 0, 10, 10)])
+    assert refresher.refresh([(-5, 120, 10, 20)])  # clipped to the screen
+    assert refresher.refresh([(0, 0, 10, 10)])  # ghosting, a full one
+    assert refresher.refresh([(0, 0, 296, 100)])  # most of the screen
+    assert refresher.refresh()
+    assert panel.frames == [[(0, 0, 10, 10)], [(0, 120, 5, 8)], None, None, None]
+    assert (refresher.partials, refresher.fulls, refresher.cleans) == (2, 3, 1)
+
+
+def test_clean():
+    panel = Panel()
+    refresher = RefreshScheduler(296, 128, panel.full, panel.partial)
+    refresher.clean()  # nothing to clean yet
+    refresher.refresh([(0, 0, 10, 10)])
+    refresher.clean()
+    refresher.refresh([(0, 0, 10, 10)])
+    assert panel.frames == [[(0, 0, 10, 10)], None]
+
+
+def test_nothing_moved():
+    panel = Panel()
+    refresher = RefreshScheduler(296, 128, panel.full, panel.partial)
+    assert not refresher.refresh([])
+    assert not refresher.refresh([(300, 0, 10, 10)])  # off screen
+    assert panel.frames == []
+
+
+def test_renderer_skips_a_frame_the_scheduler_did_not_draw():
+    panel = Panel()
+    refresher = RefreshScheduler(296, 128, panel.full, panel.partial)
+    boxes = {0: (0, 0, 50, 20), 1: (300, 0, 20, 20)}  # label 1 is off screen
+    renderer = LabelRenderer(MagTag(), 2, bounds=lambda index: boxes[index], scheduler=refresher)
+    renderer.set_text(1, "x")
+    assert renderer.dirty
+    assert not renderer.refresh()
+    assert not renderer.dirty and renderer.areas == []
+    assert (renderer.refreshes, renderer.skipped_refreshes) == (0, 1)
+    renderer.set_text(0, "12:34")
+    assert renderer.refresh()
+    assert panel.frames == [[(0, 0, 50, 20)]]
+    assert renderer.refreshes == 1
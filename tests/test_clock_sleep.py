@@ -0,0 +1,98 @@
+#####################################
+### clock_sleep.py on the host    ###
+#####################################
+#
+#   pytest tests
+
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from clock_sleep import DRAW, RESYNC, WAIT, SleepState, seconds_to_boundary  # noqa: E402
+from clock_time import LocalClock  # noqa: E402
+
+
+def test_save_load_round_trip():
+    memory = bytearray(4096)
+    state = SleepState(3)
+    state.minute = 28_333_333
+    state.hour = 7
+    state.tap_counter = 2
+    state.inverted = 1
+    state.wakes = 59
+    state.correction = -3
+    state.last_sync = 1_700_000_000
+    state.drift = 0.25
+    state.texts = ["12:34", "Mon", "Light 80%"]
+    state.save(memory)
+    other = SleepState(3)
+    assert other.load(memory)
+    assert vars(other) == vars(state)
+    other.invalidate(memory)
+    assert not SleepState(3).load(memory)
+
+
+def test_plan():
+    state = SleepState(1)
+    state.minute = 100
+    assert state.plan(100 * 60 + 59, 60) == WAIT
+    assert state.plan(101 * 60, 60) == DRAW
+    state.wakes = 60
+    assert state.plan(101 * 60, 60) == RESYNC
+    assert state.plan(101 * 60, 0) == DRAW  # resync off
+
+
+def test_boundary_never_early():
+    for local in range(0, 600):
+        wake = local + seconds_to_boundary(local)
+        assert wake % 60 == 0 and 0 < wake - local <= 60
+
+
+# The wake path of code.py over many deep sleeps: alarms fire up to a second
+# early or two late, a wake takes a while, and every resync wakes the networked
+# boot takes over.  Every minute must be drawn exactly once.
+def test_5000_wakes_draw_every_minute_once():
+    rng = random.Random(5)
+    memory = bytearray(4096)
+    true = [1_700_000_000.0 + rng.random() * 60]  # RTC seconds
+    clock = LocalClock(3600, now=lambda: true[0])
+    resync = 60
+    drawn = []
+    resyncs = 0
+
+    def draw():
+        clock.minute = clock.local() // 60
+        drawn.append(clock.minute)
+
+    # Networked boot: draws and starts counting warm wakes again
+    state = SleepState(1)
+    draw()
+    for _ in range(5000):
+        # deep_sleep_until_next_minute()
+        local = clock.local()
+        if local // 60 == clock.minute:
+            state.minute = local // 60
+            state.capture_clock(clock)
+            state.save(memory)
+            true[0] += seconds_to_boundary(local) + rng.uniform(-1.0, 2.0)
+        true[0] += rng.uniform(0.05, 0.8)  # boot time before code.py reads the clock
+
+        # The wake
+        state = SleepState(1)
+        assert state.load(memory)
+        state.restore_clock(clock)
+        clock.minute = state.minute
+        action = state.plan(clock.local(), resync)
+        if action == DRAW:
+            draw()
+            state.wakes += 1
+        elif action == RESYNC:
+            resyncs += 1
+            draw()
+            state.wakes = 0
+
+    assert resyncs > 0
+    assert len(drawn) > 4000
+    assert drawn == list(range(drawn[0], drawn[0] + len(drawn)))  # none skipped, none twice
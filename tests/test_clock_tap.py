@@ -0,0 +1,155 @@
+#####################################
+### clock_tap.py on the host      ###
+#####################################
+#
+#   pytest tests
+
+import os
+import sys
+import types
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+class Pin:
+    def __init__(self):
+        self.level = False
+        self.claimed = False
+
+
+class DigitalInOut:
+    def __init__(self, pin):
+        assert not pin.claimed, "pin in use"
+        pin.claimed = True
+        self._pin = pin
+        self.direction = None
+
+    @property
+    def value(self):
+        return self._pin.level
+
+    def deinit(self):
+        self._pin.claimed = False
+
+
+sys.modules.setdefault("digitalio", types.SimpleNamespace(DigitalInOut=DigitalInOut, Direction=types.SimpleNamespace(INPUT="input")))
+
+import clock_tap  # noqa: E402
+from clock_tap import CLICK_SRC, CLICK_THS, CTRL_REG3, TapInterrupt  # noqa: E402
+
+CTRL_REG5 = 0x24
+CLICK_CFG = 0x38
+
+
+# An LIS3DH register map behind the driver's two private accessors, with
+# INT1 latched by a click until CLICK_SRC is read
+class LIS3DH:
+    def __init__(self, pin):
+        self.registers = bytearray(0x40)
+        self.pin = pin
+        self.reads = []
+        self.writes = []
+        # as set_tap(1, 90) leaves them
+        self.registers[CTRL_REG3] = 0x80
+        self.registers[CTRL_REG5] = 0x08
+        self.registers[CLICK_CFG] = 0x15
+        self.registers[CLICK_THS] = 90
+
+    def _read_register_byte(self, register):
+        self.reads.append(register)
+        value = self.registers[register]
+        if register == CLICK_SRC and self.registers[CLICK_THS] & 0x80:
+            self.registers[CLICK_SRC] = 0
+            self.pin.level = False
+        return value
+
+    def _write_register_byte(self, register, value):
+        self.writes.append(register)
+        self.registers[register] = value
+
+    def tap(self):
+        self.registers[CLICK_SRC] = 0x40 | 0x10 | 0x01  # IA, single click, X
+        if self.registers[CTRL_REG3] & 0x80:
+            self.pin.level = True
+
+
+def tap_interrupt():
+    pin = Pin()
+    lis = LIS3DH(pin)
+    return TapInterrupt(lis, pin), lis, pin
+
+
+def test_latch_keeps_set_tap_setup():
+    tap, lis, pin = tap_interrupt()
+    assert lis.registers[CTRL_REG3] == 0x80  # I1_CLICK
+    assert lis.registers[CLICK_THS] == 0x80 | 90  # LIR_Click, threshold kept
+    assert lis.registers[CLICK_CFG] == 0x15  # untouched
+    assert lis.registers[CTRL_REG5] == 0x08
+    assert lis.writes == [CLICK_THS]  # I1_CLICK was already set
+    assert lis.reads[-1] == CLICK_SRC and tap.reads == 1  # and anything left over cleared
+
+    lis.registers[CTRL_REG3] = 0x40  # e.g. another interrupt routed there since
+    lis.writes = []
+    tap.latch()
+    assert lis.registers[CTRL_REG3] == 0x40 | 0x80
+    assert lis.writes == [CTRL_REG3]
+
+
+def test_latch_clears_tap_from_before():
+    pin = Pin()
+    lis = LIS3DH(pin)
+    lis.tap()
+    tap = TapInterrupt(lis, pin)
+    assert not pin.level
+    assert not tap.poll()
+
+
+def test_poll_reads_i2c_only_when_int1_high():
+    tap, lis, pin = tap_interrupt()
+    lis.reads = []
+    for _ in range(10):
+        assert not tap.poll()
+    assert lis.reads == []  # the pin alone answered
+    assert tap.checks == 10
+
+    lis.tap()
+    assert tap.poll()
+    assert lis.reads == [CLICK_SRC]
+    assert not pin.level  # reading CLICK_SRC released INT1
+    assert not tap.poll()
+    assert tap.taps == 1 and tap.reads == 2
+
+
+def test_int1_high_without_click():
+    tap, lis, pin = tap_interrupt()
+    pin.level = True  # a glitch, CLICK_SRC has no IA
+    assert not tap.poll()
+    assert tap.taps == 0 and tap.reads == 2
+
+
+def test_clear_reads_click_src():
+    tap, lis, pin = tap_interrupt()
+    lis.reads = []
+    lis.tap()
+    assert tap.clear()
+    assert lis.reads == [CLICK_SRC]
+    assert not tap.clear()
+
+
+def test_alarm_releases_pin(monkeypatch):
+    class PinAlarm:
+        def __init__(self, pin, value, pull):
+            assert not pin.claimed, "pin in use"
+            self.pin = pin
+
+    fake_alarm = types.SimpleNamespace(pin=types.SimpleNamespace(PinAlarm=PinAlarm))
+    monkeypatch.setattr(clock_tap, "alarm", fake_alarm)
+    tap, lis, pin = tap_interrupt()
+    tap.poll()
+    assert pin.claimed
+    wake = tap.alarm()
+    assert not pin.claimed
+    assert tap.woke(wake) and tap.wakes == 1
+    assert not tap.woke(None) and not tap.woke(object())
+    assert not tap.poll()  # takes the pin back
+    assert pin.claimed
@@ -0,0 +1,126 @@
+######################################
+### clock_telemetry.py on the host ###
+######################################
+#
+#   pytest tests
+
+import os
+import struct
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from clock_telemetry import Telemetry, decode  # noqa: E402
+
+BASE = 1_700_000_000
+
+
+# A broker stand-in: keeps what was published and, while acking, calls
+# on_publish from inside publish() as minimqtt does after the PUBACK
+class Client:
+    def __init__(self, telemetry):
+        self.telemetry = telemetry
+        self.acking = True
+        self.up = True
+        self.published = []
+
+    def publish(self, topic, payload, qos=0, retain=False):
+        if not self.up:
+            raise OSError("broker away")
+        self.published.append((topic, bytes(payload), qos))
+        if self.acking:
+            self.telemetry.confirm()
+
+
+def test_deadbands_and_round_trip():
+    telemetry = Telemetry()
+    telemetry.sample(BASE, 10, (1000, 3.7, 0))
+    telemetry.sample(BASE + 60, 70, (1200, 3.71, 0))  # all inside their deadband
+    telemetry.sample(BASE + 120, 130, (1200, 3.65, 1))  # battery and taps moved
+    telemetry.sample(BASE + 180, 190, (2000, 3.65, 1))  # light moved
+    assert telemetry.samples == 4
+    assert telemetry.suppressed == 3 + 1 + 2
+    assert telemetry.close()
+    assert not telemetry.close()  # nothing since
+    uptime, rows = decode(telemetry.backlog[0])
+    assert uptime == 10
+    assert rows == [
+        (BASE, {"light": 1000, "battery": 3.7, "taps": 0}),
+        (BASE + 120, {"light": 1000, "battery": 3.65, "taps": 1}),
+        (BASE + 180, {"light": 2000, "battery": 3.65, "taps": 1}),
+    ]
+
+
+def test_full_buffer_seals_batch():
+    telemetry = Telemetry(size=64)
+    for i in range(20):
+        telemetry.sample(BASE + i, i, (i * 1000, 3.0, i))
+    telemetry.close()
+    assert telemetry.batches > 1
+    rows = [row for payload in telemetry.backlog for row in decode(payload)[1]]
+    assert [utc for utc, _ in rows] == [BASE + i for i in range(20)]
+    assert [values["taps"] for _, values in rows] == list(range(20))
+    assert all(len(payload) <= 64 for payload in telemetry.backlog)
+
+
+def test_clock_stepped_back_starts_new_batch():
+    telemetry = Telemetry()
+    telemetry.sample(BASE, 0, (1000, 3.7, 0))
+    telemetry.sample(BASE + 60, 60, (2000, 3.7, 0))
+    telemetry.sample(BASE - 3600, 120, (3000, 3.7, 0))  # e.g. NTP pulling a fast RTC back an hour
+    telemetry.close()
+    assert telemetry.batches == 2
+    first, second = (decode(payload) for payload in telemetry.backlog)
+    assert [utc for utc, _ in first[1]] == [BASE, BASE + 60]
+    assert second == (120, [(BASE - 3600, {"light": 3000, "battery": 3.7, "taps": 0})])
+
+
+def test_clock_stepped_far_on_starts_new_batch():
+    telemetry = Telemetry()
+    telemetry.sample(BASE, 0, (1000, 3.7, 0))
+    telemetry.sample(BASE + 0x10000, 60, (1000, 3.7, 0))
+    telemetry.close()
+    assert [decode(payload)[1][0][0] for payload in telemetry.backlog] == [BASE, BASE + 0x10000]
+
+
+def test_publish_confirm_and_backlog():
+    telemetry = Telemetry(backlog=3)
+    client = Client(telemetry)
+    for batch in range(5):
+        telemetry.sample(BASE + batch * 900, batch, (batch * 1000, 3.7, batch))
+        telemetry.close()
+    assert len(telemetry.backlog) == 3 and telemetry.dropped == 2
+
+    # Not acked: the batch stays for the next try
+    client.acking = False
+    assert telemetry.publish(client, "clock/t/telemetry") == 0
+    assert len(client.published) == 1 and len(telemetry.backlog) == 3
+    telemetry.confirm()  # a late PUBACK still counts
+    assert len(telemetry.backlog) == 2 and telemetry.published == 1
+
+    # Broker away: the error is the caller's, nothing is lost
+    client.acking = True
+    client.up = False
+    with pytest.raises(OSError):
+        telemetry.publish(client, "clock/t/telemetry")
+    assert len(telemetry.backlog) == 2 and telemetry.published == 1
+
+    client.up = True
+    assert telemetry.publish(client, "clock/t/telemetry") == 2
+    assert not telemetry.backlog and telemetry.published == 3
+    assert all(qos == 1 for _, _, qos in client.published)
+    assert [decode(payload)[1][0][1]["taps"] for _, payload, _ in client.published] == [2, 3, 4]
+    assert telemetry.bytes == sum(len(payload) for _, payload, _ in client.published[-3:])
+    assert "published 3 backlog 0 dropped 2" in telemetry.stats()
+
+
+def test_decode_rejects_other_version():
+    telemetry = Telemetry()
+    telemetry.sample(BASE, 0, (0, 0, 0))
+    telemetry.close()
+    payload = bytearray(telemetry.backlog[0])
+    struct.pack_into("<B", payload, 0, 2)
+    with pytest.raises(ValueError):
+        decode(payload)
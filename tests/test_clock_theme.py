@@ -0,0 +1,88 @@
+#####################################
+### clock_theme.py on the host    ###
+#####################################
+#
+#   pytest tests
+
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(1, os.path.join(ROOT, "tools", "sim"))
+
+from display import Graphics, Panel, background, displayio_module  # noqa: E402
+
+sys.modules.setdefault("displayio", displayio_module())
+
+from clock_theme import DAY, NIGHT, Theme, is_night_hour, seconds_to_change  # noqa: E402
+
+START = 18
+STOP = 6
+
+
+def test_boundary_hours():
+    assert is_night_hour(5, START, STOP)
+    assert not is_night_hour(6, START, STOP)
+    assert not is_night_hour(17, START, STOP)
+    assert is_night_hour(18, START, STOP)
+    assert is_night_hour(0, START, STOP) and is_night_hour(23, START, STOP)
+    # same hours the other way round, night inside the day
+    assert not is_night_hour(5, STOP, START)
+    assert is_night_hour(6, STOP, START)
+    assert is_night_hour(17, STOP, START)
+    assert not is_night_hour(18, STOP, START)
+
+
+def local(hour, minute=0, second=0, day=19000):
+    return day * 86400 + hour * 3600 + minute * 60 + second
+
+
+def test_seconds_to_change():
+    assert seconds_to_change(local(5, 59, 59), START, STOP) == 1
+    assert seconds_to_change(local(5, 30), START, STOP) == 1800
+    assert seconds_to_change(local(6), START, STOP) == 3600  # just changed, the limit
+    assert seconds_to_change(local(6), START, STOP, limit=86400) == 12 * 3600
+    assert seconds_to_change(local(17, 59, 59), START, STOP) == 1
+    assert seconds_to_change(local(18), START, STOP, limit=86400) == 12 * 3600
+    assert seconds_to_change(local(23, 59), START, STOP, limit=86400) == 6 * 3600 + 60  # over midnight
+
+
+# Wherever the clock lands after waiting for the change, it is on the other side
+def test_waiting_crosses_the_boundary():
+    for hour in (5, 6, 17, 18):
+        for second in (0, 1, 1799, 3599):
+            now = local(hour, second=second)
+            later = now + seconds_to_change(now, START, STOP, limit=86400)
+            assert is_night_hour(later % 86400 // 3600, START, STOP) != is_night_hour(hour, START, STOP)
+
+
+class Renderer:
+    def __init__(self):
+        self.colors = {}
+        self.touched = 0
+
+    def set_color(self, index, color):
+        self.colors[index] = color
+
+    def touch(self):
+        self.touched += 1
+
+
+class MagTag:
+    def __init__(self):
+        self.graphics = Graphics(Panel(None))  # white default background, like the board
+        self.splash = self.graphics.splash
+
+
+def test_theme_background_shows():
+    magtag = MagTag()
+    renderer = Renderer()
+    theme = Theme(magtag, renderer, 2)
+    assert theme.apply(True)
+    assert background(magtag.splash, 296, 128) == NIGHT[1]  # not MagTag's white on top
+    assert renderer.colors == {0: NIGHT[0], 1: NIGHT[0]}
+    assert not theme.apply(True)
+    assert theme.apply(False)
+    assert background(magtag.splash, 296, 128) == DAY[1]
+    assert (theme.changes, theme.skipped, renderer.touched) == (2, 1, 2)
@@ -0,0 +1,96 @@
+#####################################
+### clock_time.py on the host     ###
+#####################################
+#
+#   pytest tests   (not python3 -m pytest, code.py would shadow the stdlib code module)
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from clock_time import DST_AU, DST_EU, DST_US, LocalClock, TimeFields, civil_from_days, days_from_civil  # noqa: E402
+
+
+# UTC seconds of a civil date and time
+def utc(year, month, day, hour=0, minute=0, second=0):
+    return days_from_civil(year, month, day) * 86400 + hour * 3600 + minute * 60 + second
+
+
+def shown(tz_offset, rule, at):
+    fields = TimeFields()
+    LocalClock(tz_offset, rule, now=lambda: at).update(fields)
+    return fields
+
+
+def test_civil_round_trip():
+    for days in range(-800, 80000, 7):
+        assert days_from_civil(*civil_from_days(days)) == days
+    assert civil_from_days(0) == (1970, 1, 1)
+
+
+# (tz_offset, rule, UTC of the change, local time just before, just after)
+TRANSITIONS = [
+    (3600, DST_EU, utc(2024, 3, 31, 1), "01:59", "03:00"),
+    (3600, DST_EU, utc(2024, 10, 27, 1), "02:59", "02:00"),
+    (-5 * 3600, DST_US, utc(2024, 3, 10, 7), "01:59", "03:00"),
+    (-5 * 3600, DST_US, utc(2024, 11, 3, 6), "01:59", "01:00"),
+    (10 * 3600, DST_AU, utc(2024, 10, 5, 16), "01:59", "03:00"),
+    (10 * 3600, DST_AU, utc(2024, 4, 6, 16), "02:59", "02:00"),
+]
+
+
+def test_dst_transitions():
+    for tz_offset, rule, change, before, after in TRANSITIONS:
+        assert shown(tz_offset, rule, change - 60).time == before, (rule, change)
+        assert shown(tz_offset, rule, change).time == after, (rule, change)
+
+
+def test_dst_outside_transitions():
+    assert shown(3600, DST_EU, utc(2024, 7, 1, 12)).time == "14:00"
+    assert shown(3600, DST_EU, utc(2024, 1, 1, 12)).time == "13:00"
+    assert shown(10 * 3600, DST_AU, utc(2024, 1, 1, 0)).time == "11:00"  # southern summer
+    assert shown(10 * 3600, DST_AU, utc(2024, 7, 1, 0)).time == "10:00"
+
+
+def test_year_rollover():
+    before = shown(0, None, utc(2023, 12, 31, 23, 59))
+    assert (before.time, before.date, before.dowa, before.moya) == ("23:59", "31.12.23", "Sun", "Dec")
+    after = shown(0, None, utc(2024, 1, 1))
+    assert (after.time, after.date, after.dowa, after.moya) == ("00:00", "01.01.24", "Mon", "Jan")
+
+
+def test_year_rollover_with_offset():
+    # 14:00 UTC on the 31st is already the new year at UTC+10
+    assert shown(10 * 3600, None, utc(2023, 12, 31, 14)).date == "01.01.24"
+    assert shown(10 * 3600, None, utc(2023, 12, 31, 13, 59)).date == "31.12.23"
+
+
+def test_february():
+    assert shown(0, None, utc(2024, 2, 28, 23, 59) + 60).date == "29.02.24"  # leap year
+    assert shown(0, None, utc(2024, 2, 29, 23, 59) + 60).date == "01.03.24"
+    assert shown(0, None, utc(2023, 2, 28, 23, 59) + 60).date == "01.03.23"
+    assert shown(0, None, utc(2100, 2, 28, 23, 59) + 60).date == "01.03.00"  # not a leap year
+    assert shown(0, None, utc(2000, 2, 28, 23, 59) + 60).date == "29.02.00"  # but 2000 was
+
+
+def test_update_reports_changes():
+    now = [utc(2024, 2, 28, 23, 59, 30)]
+    clock = LocalClock(0, now=lambda: now[0])
+    fields = TimeFields()
+    assert clock.update(fields)
+    now[0] += 10
+    assert not clock.update(fields)  # same minute
+    now[0] += 30
+    assert clock.update(fields)
+    assert (fields.time, fields.date, fields.dowa) == ("00:00", "29.02.24", "Thu")
+
+
+def test_update_after_step_of_whole_days():
+    now = [utc(2024, 3, 1, 12)]
+    clock = LocalClock(0, now=lambda: now[0])
+    fields = TimeFields()
+    clock.update(fields)
+    now[0] += 86400  # e.g. an RTC a day out corrected by NTP
+    assert clock.update(fields)
+    assert fields.date == "02.03.24"
@@ -0,0 +1,104 @@
+#####################################
+### clock_tone.py on the host     ###
+#####################################
+#
+#   pytest tests
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from clock_tone import BOOT, CHIME, ON, ToneSequencer  # noqa: E402
+
+
+class Clock:
+    def __init__(self):
+        self.mono = 100.0
+
+    def monotonic(self):
+        return self.mono
+
+
+# PWMOut keeping (monotonic, attribute, value) of every change, the
+# speaker switch goes in the same log
+class PWM:
+    def __init__(self, clock):
+        self._clock = clock
+        self.log = []
+
+    def __setattr__(self, name, value):
+        if not name.startswith("_") and name != "log":
+            self.log.append((self._clock.mono, name, value))
+        object.__setattr__(self, name, value)
+
+
+def sequencer():
+    clock = Clock()
+    pwm = PWM(clock)
+    tones = ToneSequencer(pwm, lambda on: pwm.log.append((clock.mono, "speaker", on)), monotonic=clock.monotonic)
+    return tones, pwm, clock
+
+
+# Run the tone task as the scheduler would, sleeping only between calls
+def play_out(tones, clock):
+    delay = tones.step()
+    while delay is not None:
+        clock.mono += delay
+        delay = tones.step()
+
+
+def test_chime_sequence():
+    tones, pwm, clock = sequencer()
+    assert tones.play(CHIME) == pytest.approx(0.375)
+    play_out(tones, clock)
+    assert pwm.log == [
+        (100.0, "speaker", True),
+        (100.0, "frequency", 4096),
+        (100.0, "duty_cycle", ON),
+        (100.125, "duty_cycle", 0),  # the rest
+        (100.25, "frequency", 4096),
+        (100.25, "duty_cycle", ON),
+        (100.375, "duty_cycle", 0),
+        (100.375, "speaker", False),
+    ]
+    assert not tones.busy
+    assert (tones.sequences, tones.notes, tones.late) == (1, 3, 0)
+
+
+def test_step_never_blocks():
+    tones, pwm, clock = sequencer()
+    tones.play(CHIME)
+    assert tones.step() == pytest.approx(0.125)  # first note started, back in 125 ms
+    clock.mono += 0.05
+    changes = len(pwm.log)
+    assert tones.step() == pytest.approx(0.075)  # too early: nothing changes, just how long to wait
+    assert len(pwm.log) == changes
+    assert tones.busy
+
+
+def test_play_while_busy_queues_after():
+    tones, pwm, clock = sequencer()
+    tones.play(BOOT)
+    tones.step()
+    clock.mono += 0.1
+    assert tones.play(CHIME) == pytest.approx(0.025 + 0.125 + 0.375)
+    play_out(tones, clock)
+    assert [value for _, name, value in pwm.log if name == "frequency"] == [1046, 1318, 4096, 4096]
+    assert [value for _, name, value in pwm.log if name == "speaker"] == [True, False]
+    assert tones.sequences == 1 and tones.notes == 5
+
+
+def test_late_and_stop():
+    tones, pwm, clock = sequencer()
+    tones.play(CHIME)
+    tones.step()
+    clock.mono += 0.2  # the task ran 75 ms late
+    tones.step()
+    assert tones.late == pytest.approx(0.075)
+    tones.stop()
+    assert pwm.log[-2:] == [(100.2, "duty_cycle", 0), (100.2, "speaker", False)]
+    assert tones.step() is None
+    assert "late 75ms" in tones.stats()
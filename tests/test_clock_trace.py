@@ -0,0 +1,101 @@
+#####################################
+### clock_trace.py on the host    ###
+#####################################
+#
+#   pytest tests
+
+import os
+import struct
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from clock_trace import BOOT, MQTT, TAP, UDP, TraceRecorder, load, recover  # noqa: E402
+
+Y2000 = 946_684_800  # an RTC that lost power
+NOW = 1_700_000_000
+
+
+class Clock:
+    def __init__(self):
+        self.now = 5.0
+
+    def monotonic(self):
+        return self.now
+
+
+class Socket:
+    def __init__(self):
+        self.sent = []
+
+    def sendto(self, data, address):
+        self.sent.append(bytes(data))
+
+
+def test_records_round_trip():
+    clock = Clock()
+    trace = TraceRecorder(NOW, monotonic=clock.monotonic)
+    clock.now += 1.5
+    trace.mqtt("time/hour", "7")
+    clock.now += 0.25
+    trace.udp(b"1|stats")
+    trace.tap()
+    assert load(trace.chunk()) == [
+        (NOW, BOOT, b""),
+        (NOW + 1.5, MQTT, b"time/hour\x007"),
+        (NOW + 1.75, UDP, b"1|stats"),
+        (NOW + 1.75, TAP, b""),
+    ]
+
+
+def test_rebase_after_a_clock_step():
+    clock = Clock()
+    sock = Socket()
+    trace = TraceRecorder(Y2000, monotonic=clock.monotonic)
+    trace.stream(sock, ("10.1.0.1", 5141))
+    clock.now += 10
+    trace.tap()
+    trace.flush()  # this chunk went out with the year 2000
+    clock.now += 20
+    trace.rebase(NOW)  # NTP: it is NOW, 30 s after the trace started
+    clock.now += 5
+    trace.tap()
+    trace.flush()
+    memory = bytearray(4096)
+    trace.save(memory)
+    events = load(b"".join(sock.sent) + recover(memory))
+    assert sorted(set(events)) == [(NOW - 30, BOOT, b""), (NOW - 20, TAP, b""), (NOW + 5, TAP, b"")]
+    assert "rebases 1" in trace.stats()
+
+
+def test_two_traces_keep_their_own_start():
+    first = TraceRecorder(Y2000, monotonic=lambda: 0.0)
+    second = TraceRecorder(NOW, monotonic=lambda: 0.0)
+    data = first.chunk() + second.chunk()
+    first.rebase(NOW - 600)
+    data += first.chunk()
+    assert sorted(set(load(data))) == [(NOW - 600, BOOT, b""), (NOW, BOOT, b"")]
+
+
+def test_no_wrap_after_49_days():
+    clock = Clock()
+    trace = TraceRecorder(NOW, monotonic=clock.monotonic)
+    clock.now += 60 * 86400  # past 2 ** 32 ms
+    trace.tap()
+    assert load(trace.chunk())[-1] == (NOW + 60 * 86400, TAP, b"")
+
+
+def test_ring_keeps_the_newest():
+    clock = Clock()
+    trace = TraceRecorder(NOW, size=64, monotonic=clock.monotonic)
+    for i in range(20):
+        clock.now += 1
+        trace.udp(b"%d" % i)
+    events = load(trace.chunk())
+    assert events[-1] == (NOW + 20, UDP, b"19")
+    assert len(events) < 20 and trace.overwritten == 21 - len(events)
+
+
+def test_loads_the_first_format():
+    data = struct.pack("<4sIH", b"MTT1", NOW, 12) + struct.pack("<IBB", 0, BOOT, 0) + struct.pack("<IBB", 2500, TAP, 0)
+    assert load(data) == [(NOW, BOOT, b""), (NOW + 2.5, TAP, b"")]
@@ -0,0 +1,53 @@
+#####################################
+### font_compiler.py on the host  ###
+#####################################
+#
+#   pytest tests
+
+import glob
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "tools"))
+
+from font_compiler import CHARSET, compile_font, read_mtf, verify_font  # noqa: E402
+
+# The fonts code.py loads, next to it as on CIRCUITPY
+BDF = sorted(glob.glob(os.path.join(ROOT, "*.bdf")))
+
+
+def test_fonts_present():
+    assert len(BDF) == 3
+    for bdf_path in BDF:
+        assert os.path.exists(os.path.splitext(bdf_path)[0] + ".mtf"), bdf_path
+
+
+def test_compile_matches_committed_fonts(tmp_path):
+    for bdf_path in BDF:
+        name = os.path.splitext(os.path.basename(bdf_path))[0]
+        mtf_path = str(tmp_path / (name + ".mtf"))
+        kept, total, missing = compile_font(bdf_path, mtf_path)
+        assert 0 < kept <= total
+        assert verify_font(bdf_path, mtf_path) == []
+        with open(mtf_path, "rb") as f, open(os.path.join(ROOT, name + ".mtf"), "rb") as committed:
+            assert f.read() == committed.read(), "%s.mtf is stale, recompile it" % name
+
+
+def test_only_charset_kept(tmp_path):
+    mtf_path = str(tmp_path / "subset.mtf")
+    compile_font(BDF[0], mtf_path, "0123:")
+    header, glyphs = read_mtf(mtf_path)
+    assert sorted(glyphs) == [ord(c) for c in "0123:"]
+    assert set(glyphs) <= set(ord(c) for c in CHARSET)
+
+
+def test_verify_finds_changed_pixel(tmp_path):
+    mtf_path = str(tmp_path / "changed.mtf")
+    compile_font(BDF[0], mtf_path, "8")
+    with open(mtf_path, "r+b") as f:
+        data = bytearray(f.read())
+        data[-len(read_mtf(mtf_path)[1][0x38][1])] ^= 0x80  # top left pixel of the only glyph
+        f.seek(0)
+        f.write(data)
+    assert verify_font(BDF[0], mtf_path) == ["U+0038 pixel 0,0 differs"]
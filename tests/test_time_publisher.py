@@ -0,0 +1,100 @@
+#####################################
+### time_publisher.py on the host ###
+#####################################
+#
+#   pytest tests
+
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "tools"))
+
+import time_publisher  # noqa: E402
+from time_publisher import FIELDS, Clock, Publisher, check_crontab, read_crontab  # noqa: E402
+
+MIDNIGHT = 1_767_225_600  # 2026-01-01 00:00 UTC, a Thursday
+MINUTE_TOPICS = ["min", "state", "time"]
+HOUR_TOPICS = ["hour", "min", "state", "time"]
+
+
+# paho's publish(), keeping what went out
+class Client:
+    def __init__(self):
+        self.published = []
+
+    def publish(self, topic, payload, qos=0, retain=False):
+        self.published.append((topic, payload, qos, retain))
+
+    def topics(self, prefix):
+        return sorted(topic[len(prefix) + 1 :] for topic, _, _, _ in self.published if topic.startswith(prefix + "/"))
+
+    def payloads(self):
+        return {topic: payload for topic, payload, _, _ in self.published}
+
+
+def test_minute_hour_and_midnight_sets():
+    client = Client()
+    publisher = Publisher(client, [Clock("time=UTC")])
+    publisher.publish(MIDNIGHT + 5 * 60)
+    assert client.topics("time") == MINUTE_TOPICS
+    assert client.payloads() == {"time/time": "00:05", "time/min": "05", "time/state": "26010100054"}
+    assert all(qos == 1 and retain for _, _, qos, retain in client.published)
+
+    client.published = []
+    publisher.publish(MIDNIGHT + 3600)
+    assert client.topics("time") == HOUR_TOPICS
+    assert client.payloads()["time/hour"] == "01"
+
+    client.published = []
+    publisher.publish(MIDNIGHT)
+    assert client.topics("time") == sorted(topic for topic, _, _ in FIELDS)
+    payloads = client.payloads()
+    assert (payloads["time/date"], payloads["time/date2"], payloads["time/dowa"], payloads["time/moya"]) == (
+        "01-01-2026",
+        "01.01.26",
+        "Thu",
+        "Jan",
+    )
+    assert publisher.published == 3 + 4 + len(FIELDS)
+
+
+def test_publish_all_refills_every_topic(monkeypatch):
+    monkeypatch.setattr(time_publisher.time, "time", lambda: MIDNIGHT + 12 * 3600 + 34 * 60 + 56.7)
+    client = Client()
+    Publisher(client, [Clock("time=UTC")]).publish_all()
+    assert client.topics("time") == sorted(topic for topic, _, _ in FIELDS)
+    assert client.payloads()["time/time"] == "12:34"  # from the minute it is in, not a boundary ahead
+
+
+def test_two_clocks():
+    client = Client()
+    clocks = [Clock(spec) for spec in ("time=Australia/Brisbane", "uk/time=Europe/London")]
+    assert [clock.prefix for clock in clocks] == ["time", "uk/time"]
+    Publisher(client, clocks).publish(MIDNIGHT)
+    # 10:00 in Brisbane is only an hour, London has a new day
+    assert client.topics("time") == HOUR_TOPICS
+    assert client.topics("uk/time") == sorted(topic for topic, _, _ in FIELDS)
+    payloads = client.payloads()
+    assert payloads["time/time"] == "10:00" and payloads["uk/time/time"] == "00:00"
+    assert payloads["uk/time/date"] == "01-01-2026"
+    assert "time/date" not in payloads
+
+
+def test_matches_crontab_in_code_py():
+    entries = read_crontab()
+    assert len(entries) == len(FIELDS)
+    assert check_crontab(entries, sample=MIDNIGHT) == []
+    assert check_crontab(entries, sample=MIDNIGHT + 13 * 3600 + 7 * 60) == []
+
+
+def test_check_crontab_reports_differences():
+    entries = read_crontab()
+    entries["time/hour"] = ("minute", "%H")
+    entries["time/extra"] = ("minute", "%S")
+    del entries["time/year"]
+    assert check_crontab(entries, sample=MIDNIGHT) == [
+        "time/extra: in the crontab, not published",
+        "time/hour: every hour, the crontab says every minute",
+        "time/year: published, not in the crontab",
+    ]
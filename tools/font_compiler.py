@@ -0,0 +1,191 @@
+#########################################
+### MagTag Clock font compiler (host) ###
+#########################################
+#
+# Compiles a BDF font down to the glyphs the clock can actually draw and
+# writes them as a compact binary font (.mtf) that clock_font.py loads with
+# seek-based random access.  Run on the host, then copy the .mtf files to
+# the root of CIRCUITPY next to the .bdf files.
+#
+#   python3 tools/font_compiler.py Digital-7-77.bdf Digital-7-38.bdf ThinPixel-7-20.bdf
+#   python3 tools/font_compiler.py --verify Digital-7-77.bdf
+#
+# .mtf layout (little endian):
+#   header  "<4sHhhhhhh"  magic b"MTF1", glyph count, bbox w, h, x, y, ascent, descent
+#   index   "<HIBBbbb"    per glyph, sorted by code point:
+#                         code point, bitmap offset, width, height, dx, dy, shift_x
+#   bitmaps               per glyph, height rows of ceil(width / 8) bytes, MSB first
+
+import argparse
+import os
+import struct
+import sys
+
+MAGIC = b"MTF1"
+HEADER = "<4sHhhhhhh"
+INDEX = "<HIBBbbb"
+
+# Everything the eight labels in code.py can show
+DAYS = "Mon Tue Wed Thu Fri Sat Sun"
+MONTHS = "Jan Feb Mar Apr May Jun Jul Aug Sep Oct Nov Dec"
+CHARSET = "0123456789 :.%-vx" + "Light" + "Chg" + DAYS + MONTHS  # x for the "xxx" placeholders in clock_time.py
+
+
+# Parse a BDF file into (font properties, {code point: glyph})
+def parse_bdf(path):
+    props = {"bbox": (0, 0, 0, 0), "ascent": 0, "descent": 0}
+    glyphs = {}
+    glyph = None
+    rows = None
+    with open(path, "r", encoding="latin-1") as f:
+        for line in f:
+            words = line.split()
+            if not words:
+                continue
+            key = words[0]
+            if rows is not None:
+                if key == "ENDCHAR":
+                    glyph["rows"] = rows
+                    if glyph["code_point"] >= 0:
+                        glyphs[glyph["code_point"]] = glyph
+                    glyph = rows = None
+                else:
+                    rows.append(int(key, 16) if key else 0)
+                    glyph.setdefault("row_bits", len(key) * 4)
+            elif key == "FONTBOUNDINGBOX":
+                props["bbox"] = tuple(int(w) for w in words[1:5])
+            elif key == "FONT_ASCENT":
+                props["ascent"] = int(words[1])
+            elif key == "FONT_DESCENT":
+                props["descent"] = int(words[1])
+            elif key == "STARTCHAR":
+                glyph = {"code_point": -1, "shift_x": 0}
+            elif glyph is not None and key == "ENCODING":
+                glyph["code_point"] = int(words[1])
+            elif glyph is not None and key == "DWIDTH":
+                glyph["shift_x"] = int(words[1])
+            elif glyph is not None and key == "BBX":
+                glyph["width"], glyph["height"], glyph["dx"], glyph["dy"] = (
+                    int(w) for w in words[1:5]
+                )
+            elif glyph is not None and key == "BITMAP":
+                rows = []
+    return props, glyphs
+
+
+# Pixel value at x, y of a parsed BDF glyph
+def bdf_pixel(glyph, x, y):
+    return (glyph["rows"][y] >> (glyph["row_bits"] - 1 - x)) & 1
+
+
+# Pack a parsed BDF glyph to height rows of ceil(width / 8) bytes
+def pack_glyph(glyph):
+    width, height = glyph["width"], glyph["height"]
+    stride = (width + 7) // 8
+    data = bytearray(stride * height)
+    for y in range(height):
+        for x in range(width):
+            if bdf_pixel(glyph, x, y):
+                data[y * stride + x // 8] |= 0x80 >> (x % 8)
+    return bytes(data)
+
+
+def compile_font(bdf_path, mtf_path, charset=CHARSET):
+    props, glyphs = parse_bdf(bdf_path)
+    code_points = sorted(set(ord(c) for c in charset) & set(glyphs))
+    offset = struct.calcsize(HEADER) + struct.calcsize(INDEX) * len(code_points)
+    index = bytearray()
+    bitmaps = bytearray()
+    for code_point in code_points:
+        glyph = glyphs[code_point]
+        index += struct.pack(
+            INDEX,
+            code_point,
+            offset + len(bitmaps),
+            glyph["width"],
+            glyph["height"],
+            glyph["dx"],
+            glyph["dy"],
+            glyph["shift_x"],
+        )
+        bitmaps += pack_glyph(glyph)
+    header = struct.pack(
+        HEADER, MAGIC, len(code_points), *props["bbox"], props["ascent"], props["descent"]
+    )
+    with open(mtf_path, "wb") as f:
+        f.write(header + index + bitmaps)
+    missing = "".join(sorted(set(c for c in charset if ord(c) not in glyphs)))
+    return len(code_points), len(glyphs), missing
+
+
+# Read a compiled font back into {code point: (metrics, packed bitmap)}
+def read_mtf(mtf_path):
+    with open(mtf_path, "rb") as f:
+        data = f.read()
+    header = struct.unpack_from(HEADER, data)
+    if header[0] != MAGIC:
+        raise ValueError("%s is not a compiled font" % mtf_path)
+    count = header[1]
+    glyphs = {}
+    for i in range(count):
+        entry = struct.unpack_from(INDEX, data, struct.calcsize(HEADER) + i * struct.calcsize(INDEX))
+        code_point, offset, width, height = entry[:4]
+        size = (width + 7) // 8 * height
+        glyphs[code_point] = (entry[2:], data[offset : offset + size])
+    return header, glyphs
+
+
+# Check every compiled glyph against the BDF source, bit for bit
+def verify_font(bdf_path, mtf_path):
+    props, source = parse_bdf(bdf_path)
+    header, compiled = read_mtf(mtf_path)
+    errors = []
+    if header[2:6] != props["bbox"] or header[6:8] != (props["ascent"], props["descent"]):
+        errors.append("header mismatch")
+    for code_point, (metrics, bitmap) in compiled.items():
+        glyph = source.get(code_point)
+        if glyph is None:
+            errors.append("U+%04X not in source" % code_point)
+            continue
+        if metrics != (glyph["width"], glyph["height"], glyph["dx"], glyph["dy"], glyph["shift_x"]):
+            errors.append("U+%04X metrics differ" % code_point)
+            continue
+        stride = (glyph["width"] + 7) // 8
+        for y in range(glyph["height"]):
+            for x in range(glyph["width"]):
+                bit = (bitmap[y * stride + x // 8] >> (7 - x % 8)) & 1
+                if bit != bdf_pixel(glyph, x, y):
+                    errors.append("U+%04X pixel %d,%d differs" % (code_point, x, y))
+                    break
+    return errors
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compile BDF fonts to glyph-subset .mtf fonts")
+    parser.add_argument("fonts", nargs="+", help="BDF files to compile")
+    parser.add_argument("--chars", default=CHARSET, help="characters to keep")
+    parser.add_argument("--verify", action="store_true", help="only check existing .mtf files")
+    args = parser.parse_args(argv)
+
+    failed = False
+    for bdf_path in args.fonts:
+        mtf_path = os.path.splitext(bdf_path)[0] + ".mtf"
+        if not args.verify:
+            kept, total, missing = compile_font(bdf_path, mtf_path, args.chars)
+            print(
+                "%s: %d of %d glyphs, %d bytes -> %s"
+                % (bdf_path, kept, total, os.path.getsize(mtf_path), mtf_path)
+            )
+            if missing.strip():
+                print("  not in font: %r" % missing)
+        errors = verify_font(bdf_path, mtf_path)
+        for error in errors:
+            print("  %s: %s" % (mtf_path, error))
+        failed = failed or bool(errors)
+        if args.verify and not errors:
+            print("%s: OK" % mtf_path)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,327 @@
+#!/usr/bin/env python3
+###############################
+### Simulated day benchmark ###
+###############################
+#
+# Runs code.py against the host simulator and reports what it cost: loop
+# wakes, task runs, e-ink refreshes, label builds, heap, network round
+# trips, ADC and I2C traffic, resets and a rough energy estimate.  Run it
+# before and after a change and compare the numbers, or let --compare run
+# the baseline and report the energy saved.
+#
+#   python3 tools/sim/bench.py                      # one simulated day
+#   python3 tools/sim/bench.py --hours 2 --verbose  # show code.py's output
+#   python3 tools/sim/bench.py --set deep_sleep=1 --set sleep_time=300
+#   python3 tools/sim/bench.py --scenario all --json
+#   python3 tools/sim/bench.py --scenario policy --compare policy_enable=0
+#   python3 tools/sim/bench.py --inputs day.csv --compare policy_enable=0  # a recorded day
+
+import argparse
+import ast
+import json
+import os
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(1, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+from runner import Simulation, discharge  # noqa: E402
+from clock_telemetry import decode  # noqa: E402
+
+# Rough MagTag power model for energy(): mW in each state, plus mJ for each
+# counted event on top.  Only good for comparing two runs.
+POWER_MW = {
+    "awake": 280,  # CPU running, radio listening (MQTT waits, connects)
+    "sleep": 75,  # time.sleep, WiFi associated in modem sleep
+    "light_sleep": 4,
+    "deep_sleep": 1,
+}
+EVENT_MJ = {
+    "loop_wakes": 0.5,
+    "eink_refreshes": 40,
+    "eink_partials": 8,
+    "mqtt_packets": 2,
+    "ntp_requests": 2,
+    "udp_out": 2,
+    "wifi_connects": 400,
+    "wifi_scans": 600,
+    "adc_reads": 0.05,
+    "i2c_transactions": 0.02,
+}
+SPEAKER_MW = 70
+
+
+# Scripted inputs on top of the default day
+def scenario_taps(sim):
+    for hour in (1, 7, 12, 19):
+        sim.tap_at(hour * 3600 + 17)
+
+
+def scenario_commands(sim):
+    sim.command_at(600, "1|stats")
+    sim.command_at(900, "2|bright 0.2;invert on")
+    sim.command_at(1200, "3|invert auto;refresh")
+    sim.command_at(1500, "4|help")
+    sim.command_at(1800, b"\xff\xfe")  # Not UTF-8, must get an error reply and not reset the board
+
+
+def scenario_outage(sim):
+    sim.broker_outage(3600, 300)
+    sim.wifi_outage(7200, 900)
+    sim.broker_restart(10800)
+
+
+# The access point is down when the clock boots and back 15 minutes later,
+# the boot backs off for minutes without starving the watchdog
+def scenario_boot_outage(sim):
+    sim.wifi_outage(0, 900)
+
+
+def scenario_resets(sim):
+    for hour in (2, 9, 15, 22):
+        sim.reset_at(hour * 3600 + 25)
+
+
+# Two hangs long enough for the watchdog
+def scenario_crash(sim):
+    for hour in (4, 16):
+        sim.hang_at(hour * 3600 + 33, 45)
+
+
+# The battery runs low in the afternoon and the room goes dark at night,
+# someone looks at it once in the day and once in the dark
+def scenario_policy(sim):
+    sim.battery = discharge(sim.start_utc, 0.2, sim.random, volts=3.9)
+    for hour in (3, 20):
+        sim.tap_at(hour * 3600 + 17)
+
+
+SCENARIOS = {
+    "day": None,
+    "taps": scenario_taps,
+    "commands": scenario_commands,
+    "outage": scenario_outage,
+    "boot_outage": scenario_boot_outage,
+    "resets": scenario_resets,
+    "policy": scenario_policy,
+    "crash": scenario_crash,
+}
+
+
+def run(name, args, prefs):
+    sim = Simulation(
+        start_utc=args.start,
+        duration=args.hours * 3600,
+        prefs=prefs,
+        rtc_drift=args.drift,
+        ntp_loss=args.ntp_loss,
+        seed=args.seed,
+        verbose=args.verbose,
+    )
+    if SCENARIOS[name]:
+        SCENARIOS[name](sim)
+    if args.inputs:
+        sim.inputs_from(args.inputs)
+    if args.trace_heap:
+        tracemalloc.start()
+    sim.run()
+    peak = 0
+    if args.trace_heap:
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return report(name, sim, peak)
+
+
+def report(name, sim, heap_peak):
+    network = sim.network
+    frames = sim.panel.frames
+    minutes = set(int(frame[0] - sim.clock.true_offset + sim.tz_offset) // 60 for frame in frames)
+    policy = sim.namespace.get("policy") if sim.namespace else None
+    meter = sim.namespace.get("energy") if sim.namespace else None
+    result = {
+        "scenario": name,
+        "simulated_s": round(sim.clock.mono - 1.0, 1),
+        "wall_s": round(sim.wall_time, 2),
+        "boots": sim.boots,
+        "resets": sim.resets,
+        "errors": sorted(set(error for _, error in sim.errors)),
+        "first_error_s": sim.errors[0][0] if sim.errors else None,
+        "boot_s": first_and_max([total for _, total in sim.boot_times]),
+        "first_paint_s": first_and_max([paint for paint, _ in sim.boot_times]),
+        "loop_wakes": sim.loop_wakes,
+        "time_sleeps": sim.clock.sleeps,
+        "task_runs": sim.task_runs,
+        "eink_refreshes": sim.panel.refreshes,
+        "eink_partials": sim.panel.partials,
+        "partial_area_px": sim.panel.partial_pixels // sim.panel.partials if sim.panel.partials else 0,
+        "max_ghosting": sim.panel.max_ghosting,
+        "minutes_drawn": len(minutes),
+        "unreadable_frames": sum(1 for frame in frames if unreadable(frame)),
+        "label_builds": sim.label_builds,
+        "heap_peak_bytes": heap_peak,
+        "mqtt_packets": network.broker.packets,
+        "ntp_requests": network.counts["ntp_request"],
+        "udp_in": network.counts["udp_in"],
+        "udp_out": network.counts["udp_out"],
+        "udp_err_replies": sum(1 for _, data in network.udp_replies if b"|err" in data or b";err" in data),
+        "wifi_connects": network.counts["wifi_connect"],
+        "wifi_scans": network.counts["wifi_scan"],
+        "round_trips": network.round_trips(),
+        "adc_reads": sim.adc_reads,
+        "i2c_transactions": sim.hardware.accelerometer.transactions,
+        "tap_latency_s": tap_latency(sim),
+        "tone_block_s": round(sum(value[1] for _, kind, value in sim.events if kind == "tone"), 3),
+        "speaker_on_s": round(speaker_on(sim), 3),
+        "pwm_changes": len(sim.hardware.pwm_log),
+        "led_changes": sim.hardware.led_changes,
+        "watchdog_feeds": sim.hardware.watchdog.feeds,
+        "gc_collections": sim.gc_collections,
+        "print_lines": sim.print_lines,
+        "rtc_error_s": round(sim.clock.rtc_utc() - sim.clock.true_utc(), 2),
+        "policy": policy.stats() if hasattr(policy, "stats") else None,
+        "energy_meter": meter.report(sim.namespace["sensors"].batt_pc) if hasattr(meter, "report") else None,
+        "telemetry": telemetry(sim),
+    }
+    result["energy_j"] = energy(sim, result)
+    return result
+
+
+# A frame with text in the colour of the background behind it
+def unreadable(frame):
+    _, texts, colors, background, _ = frame
+    return background is None or any(text and color == background for text, color in zip(texts, colors))
+
+
+# Batches the broker got on a telemetry topic, decoded
+def telemetry(sim):
+    payloads = [message for _, topic, message in sim.network.published if topic.endswith("/telemetry")]
+    rows = [row for payload in payloads for row in decode(payload)[1]]
+    device = sim.namespace.get("telemetry") if sim.namespace else None
+    return {
+        "batches": len(payloads),
+        "records": len(rows),
+        "bytes": sum(len(payload) for payload in payloads),
+        "last": rows[-1][1] if rows else None,
+        "device": device.stats() if hasattr(device, "stats") else None,
+    }
+
+
+# Estimated joules from time in each power state and the event counts
+def energy(sim, result):
+    clock = sim.clock
+    simulated = clock.mono - 1.0
+    slept = min(clock.slept, simulated)
+    awake = max(0.0, simulated - slept - clock.light_slept - clock.deep_slept)
+    mj = (
+        awake * POWER_MW["awake"]
+        + slept * POWER_MW["sleep"]
+        + clock.light_slept * POWER_MW["light_sleep"]
+        + clock.deep_slept * POWER_MW["deep_sleep"]
+        + result["speaker_on_s"] * SPEAKER_MW
+    )
+    mj += sum(result[key] * cost for key, cost in EVENT_MJ.items())
+    return {"total": round(mj / 1000, 1), "awake_s": round(awake), "mah": round(mj / 1000 / 3.7 / 3.6, 1)}
+
+
+# What the run saved against the same run with the --compare preferences
+def saved(result, baseline):
+    base = baseline["energy_j"]["total"]
+    total = result["energy_j"]["total"]
+    return {
+        "baseline_j": base,
+        "saved_j": round(base - total, 1),
+        "saved_pc": round(100 * (base - total) / base, 1) if base else None,
+        "baseline_refreshes": baseline["eink_refreshes"],
+        "baseline_wakes": baseline["loop_wakes"],
+    }
+
+
+# Seconds from each tap to the neopixels coming on, None if they never did
+def tap_latency(sim):
+    lit = [t for t, kind, value in sim.events if kind == "neopixels" and any(value)]
+    latency = []
+    for tap in sim.hardware.accelerometer.taps:
+        after = [t for t in lit if t >= tap]
+        latency.append(round(after[0] - tap, 2) if after else None)
+    return latency
+
+
+# Seconds the speaker amplifier was enabled
+def speaker_on(sim):
+    total = 0.0
+    since = None
+    for t, kind, on in sim.events:
+        if kind != "speaker":
+            continue
+        if on and since is None:
+            since = t
+        elif not on and since is not None:
+            total += t - since
+            since = None
+    if since is not None:
+        total += sim.clock.mono - since
+    return total
+
+
+# The first (cold) boot against the slowest of the boots after it
+def first_and_max(values):
+    later = [value for value in values[1:] if value is not None]
+    return {
+        "first": None if not values or values[0] is None else round(values[0], 2),
+        "later_max": round(max(later), 2) if later else None,
+    }
+
+
+def print_report(result):
+    print("### %s ###" % result["scenario"])
+    for key, value in result.items():
+        if key == "scenario":
+            continue
+        if isinstance(value, dict):
+            value = " ".join("%s=%s" % item for item in value.items())
+        print("  %-18s %s" % (key, value))
+
+
+def parse_set(text):
+    name, _, value = text.partition("=")
+    try:
+        value = ast.literal_eval(value)
+    except (ValueError, SyntaxError):
+        pass  # plain string
+    return name.strip(), value
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run code.py for a simulated day and report its costs")
+    parser.add_argument("--scenario", default="day", choices=sorted(SCENARIOS) + ["all"])
+    parser.add_argument("--hours", type=float, default=24)
+    parser.add_argument("--start", type=int, default=1_700_000_000, help="UTC start time")
+    parser.add_argument("--drift", type=float, default=0.0, help="RTC drift in seconds per day")
+    parser.add_argument("--ntp-loss", type=float, default=0.0, help="fraction of NTP packets lost")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--set", action="append", default=[], metavar="NAME=VALUE", help="override a preference in code.py")
+    parser.add_argument("--compare", action="append", default=[], metavar="NAME=VALUE", help="also run with these overrides and report the energy saved against it")
+    parser.add_argument("--inputs", help="CSV of seconds,light,battery recorded from a unit, instead of the synthetic day")
+    parser.add_argument("--trace-heap", action="store_true", help="track allocations with tracemalloc (slower)")
+    parser.add_argument("--json", action="store_true")
+    parser.add_argument("--verbose", action="store_true", help="echo code.py's print output")
+    args = parser.parse_args()
+    prefs = dict(parse_set(text) for text in args.set)
+
+    names = sorted(SCENARIOS) if args.scenario == "all" else [args.scenario]
+    results = [run(name, args, prefs) for name in names]
+    if args.compare:
+        baseline = dict(prefs, **dict(parse_set(text) for text in args.compare))
+        for result in results:
+            result["energy_saved"] = saved(result, run(result["scenario"], args, baseline))
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        for result in results:
+            print_report(result)
+    return 1 if any(result["resets"]["error"] for result in results) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
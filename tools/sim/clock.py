@@ -0,0 +1,133 @@
+#########################
+### Virtual clock     ###
+#########################
+#
+# Simulated time for the host simulator.  Nothing in the clock code waits
+# for real: time.sleep(), blocking tones and MQTT waits advance this clock
+# and run any scripted events (taps, messages, NTP replies) that fall due.
+
+import calendar
+import heapq
+import time as _time
+
+
+class SimulationDone(BaseException):
+    pass
+
+
+class WatchdogReset(BaseException):
+    pass
+
+
+class BoardReset(BaseException):
+    pass
+
+
+# microcontroller.reset()
+class SoftReset(BaseException):
+    pass
+
+
+# watchdog.WatchDogTimeout, raised into code.py in WatchDogMode.RAISE
+class WatchDogTimeout(Exception):
+    pass
+
+
+class DeepSleep(BaseException):
+    def __init__(self, alarms):
+        super().__init__()
+        self.alarms = alarms
+
+
+class VirtualClock:
+    def __init__(self, start_utc, duration, rtc_utc=946684800):
+        self.mono = 1.0  # time.monotonic(), keeps running across boots
+        self.true_offset = start_utc - self.mono  # real UTC = mono + true_offset
+        self.rtc_offset = rtc_utc - self.mono  # board RTC, 2000-01-01 until set
+        self.end = self.mono + duration
+        self._events = []
+        self._seq = 0
+        self.watchdog = None  # set by the microcontroller stand-in
+        self.sleeps = 0
+        self.slept = 0.0  # seconds in time.sleep()
+        self.light_slept = 0.0  # seconds in light sleep
+        self.deep_slept = 0.0  # seconds in deep sleep
+
+    def true_utc(self):
+        return self.mono + self.true_offset
+
+    def rtc_utc(self):
+        return self.mono + self.rtc_offset
+
+    def set_rtc(self, utc):
+        self.rtc_offset = utc - self.mono
+
+    # Run fn at monotonic time t
+    def at(self, t, fn):
+        self._seq += 1
+        heapq.heappush(self._events, (t, self._seq, fn))
+
+    def after(self, delay, fn):
+        self.at(self.mono + delay, fn)
+
+    # Run fn at a real UTC time
+    def at_utc(self, utc, fn):
+        self.at(utc - self.true_offset, fn)
+
+    # Run the events up to seconds from now.  With until, stop early after
+    # the first event that makes until() true (a pin alarm), returns True then.
+    def advance(self, seconds, until=None):
+        target = self.mono + max(0.0, seconds)
+        while self._events and self._events[0][0] <= target:
+            # move first, an event must not be lost to a reset on the way
+            self._move(max(self._events[0][0], self.mono))
+            fn = heapq.heappop(self._events)[2]
+            fn()
+            if until is not None and until():
+                return True
+        self._move(target)
+        return False
+
+    def _move(self, t):
+        if self.watchdog is not None:
+            self.watchdog.check(t)
+        if t > self.end:
+            self.mono = self.end
+            raise SimulationDone()
+        self.mono = t
+
+    # Fast forward over a deep sleep to the monotonic wake time, or until()
+    def deep_sleep(self, wake, until=None):
+        start = self.mono
+        try:
+            return self.advance(wake - self.mono, until)
+        finally:
+            self.deep_slept += self.mono - start
+
+
+# time module for the simulated board
+class TimeModule:
+    def __init__(self, clock):
+        self._clock = clock
+        self.struct_time = _time.struct_time
+
+    def monotonic(self):
+        return self._clock.mono
+
+    def monotonic_ns(self):
+        return int(self._clock.mono * 1_000_000_000)
+
+    def time(self):
+        return int(self._clock.rtc_utc())
+
+    def sleep(self, seconds):
+        self._clock.sleeps += 1
+        self._clock.slept += seconds
+        self._clock.advance(seconds)
+
+    # CircuitPython has no timezones, localtime is UTC
+    def localtime(self, seconds=None):
+        return _time.gmtime(self.time() if seconds is None else seconds)
+
+    def mktime(self, struct):
+        return calendar.timegm(struct)
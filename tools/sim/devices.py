@@ -0,0 +1,325 @@
+###############################
+### Board stand-ins         ###
+###############################
+#
+# board, digitalio, pwmio, microcontroller, watchdog, alarm, rtc, neopixel
+# and adafruit_lis3dh for the host simulator.  Hardware that keeps its state
+# over a reset on the real board (RTC, sleep memory, nvm, pins wired to
+# the accelerometer) lives in Hardware and survives simulated reboots.
+
+import calendar
+import time
+import types
+
+from clock import DeepSleep, SoftReset, WatchDogTimeout, WatchdogReset
+
+
+class Pin:
+    def __init__(self, name):
+        self.name = name
+        self.level = False  # driven by the simulated hardware
+        self.claimed = False  # in use by a DigitalInOut, like the real pins
+
+    def claim(self):
+        if self.claimed:
+            raise ValueError("%r in use" % self)
+        self.claimed = True
+
+    def __repr__(self):
+        return "board." + self.name
+
+
+class Watchdog:
+    def __init__(self, clock):
+        self._clock = clock
+        self.timeout = None
+        self.mode = None
+        self.last_feed = clock.mono
+        self.feeds = 0
+
+    def feed(self):
+        self.feeds += 1
+        self.last_feed = self._clock.mono
+
+    def check(self, t):
+        if self.mode is not None and self.timeout and t - self.last_feed > self.timeout:
+            self._clock.mono = self.last_feed + self.timeout
+            mode, self.mode = self.mode, None
+            if mode == "raise":
+                raise WatchDogTimeout("watchdog timeout")
+            raise WatchdogReset()
+
+
+# Accelerometer with a register map, taps are scripted by the simulation
+class LIS3DH:
+    CTRL_REG3 = 0x22
+    CTRL_REG5 = 0x24
+    CLICK_CFG = 0x38
+    CLICK_SRC = 0x39
+    CLICK_THS = 0x3A
+
+    def __init__(self, clock, int1):
+        self._clock = clock
+        self.registers = bytearray(0x40)
+        self.int1 = int1  # Pin the INT1 output is wired to
+        self.transactions = 0  # I2C reads and writes
+        self.taps = []  # monotonic time of each tap
+
+    def write(self, register, value):
+        self.transactions += 1
+        self.registers[register] = value & 0xFF
+
+    def read(self, register):
+        self.transactions += 1
+        value = self.registers[register]
+        if register == self.CLICK_SRC and self.registers[self.CLICK_THS] & 0x80:
+            # latched (LIR_Click): reading CLICK_SRC clears the latch and INT1
+            self.registers[self.CLICK_SRC] = 0
+            self.int1.level = False
+        return value
+
+    # A single tap on the board
+    def tap(self):
+        self.taps.append(self._clock.mono)
+        if not self.registers[self.CLICK_CFG]:
+            return
+        self.registers[self.CLICK_SRC] = 0x40 | 0x10 | 0x01  # IA, single click, X
+        if self.registers[self.CTRL_REG3] & 0x80:  # I1_CLICK
+            self.int1.level = True
+
+
+# One class for every boot, so isinstance(alarm.wake_alarm, PinAlarm) works after a wake
+class PinAlarm:
+    def __init__(self, pin, value=True, edge=False, pull=False):
+        if pin.claimed:
+            raise ValueError("%r in use" % pin)
+        self.pin = pin
+        self.value = value
+        self.edge = edge
+        self.pull = pull
+
+
+# The first PinAlarm whose pin is at its level, or None
+def pin_alarm(alarms):
+    for alarm in alarms:
+        if hasattr(alarm, "pin") and alarm.pin.level == alarm.value:
+            return alarm
+    return None
+
+
+class Hardware:
+    def __init__(self, clock):
+        self.clock = clock
+        self.watchdog = Watchdog(clock)
+        clock.watchdog = self.watchdog
+        self.pins = {}
+        for name in ("D13", "SPEAKER", "SPEAKER_ENABLE", "ACCELEROMETER_INTERRUPT", "NEOPIXEL", "LIGHT", "BATTERY"):
+            self.pins[name] = Pin(name)
+        self.accelerometer = LIS3DH(clock, self.pins["ACCELEROMETER_INTERRUPT"])
+        self.sleep_memory = bytearray(8192)
+        self.nvm = bytearray(8192)
+        self.wake_alarm = None
+        self.led_changes = 0
+        self.pwm_log = []  # (monotonic, pin name, frequency, duty cycle) per change
+
+    # Fresh modules for a boot, hardware state carries over
+    def modules(self):
+        for pin in self.pins.values():
+            pin.claimed = False
+        return {
+            "board": self._board(),
+            "digitalio": self._digitalio(),
+            "pwmio": self._pwmio(),
+            "microcontroller": self._microcontroller(),
+            "watchdog": self._watchdog(),
+            "alarm": self._alarm(),
+            "rtc": self._rtc(),
+            "neopixel": types.SimpleNamespace(NeoPixel=object),
+            "adafruit_lis3dh": self._lis3dh(),
+        }
+
+    def _board(self):
+        board = types.ModuleType("board")
+        for name, pin in self.pins.items():
+            setattr(board, name, pin)
+        board.I2C = lambda: "i2c"
+        return board
+
+    def _digitalio(self):
+        hardware = self
+
+        class DigitalInOut:
+            def __init__(self, pin):
+                pin.claim()
+                self._pin = pin
+                self.direction = Direction.INPUT
+                self.pull = None
+
+            @property
+            def value(self):
+                return self._pin.level
+
+            @value.setter
+            def value(self, value):
+                if self._pin.level != bool(value):
+                    hardware.led_changes += self._pin.name == "D13"
+                self._pin.level = bool(value)
+
+            def deinit(self):
+                self._pin.claimed = False
+
+        class Direction:
+            INPUT = "input"
+            OUTPUT = "output"
+
+        class Pull:
+            UP = "up"
+            DOWN = "down"
+
+        return types.SimpleNamespace(DigitalInOut=DigitalInOut, Direction=Direction, Pull=Pull)
+
+    def _pwmio(self):
+        hardware = self
+        clock = self.clock
+
+        class PWMOut:
+            def __init__(self, pin, *, duty_cycle=0, frequency=500, variable_frequency=False):
+                pin.claim()
+                self._pin = pin
+                self._duty_cycle = duty_cycle
+                self._frequency = frequency
+                self._variable = variable_frequency
+
+            def _log(self):
+                hardware.pwm_log.append((clock.mono, self._pin.name, self._frequency, self._duty_cycle))
+
+            @property
+            def duty_cycle(self):
+                return self._duty_cycle
+
+            @duty_cycle.setter
+            def duty_cycle(self, value):
+                if not 0 <= value <= 0xFFFF:
+                    raise ValueError("duty_cycle must be 0-65535")
+                if value != self._duty_cycle:
+                    self._duty_cycle = value
+                    self._log()
+
+            @property
+            def frequency(self):
+                return self._frequency
+
+            @frequency.setter
+            def frequency(self, value):
+                if not self._variable:
+                    raise AttributeError("frequency is fixed, use variable_frequency=True")
+                if value != self._frequency:
+                    self._frequency = int(value)
+                    self._log()
+
+            def deinit(self):
+                self._pin.claimed = False
+
+        return types.SimpleNamespace(PWMOut=PWMOut)
+
+    def _microcontroller(self):
+        self.watchdog.mode = None
+        self.watchdog.timeout = None
+        def reset():
+            raise SoftReset()
+
+        return types.SimpleNamespace(watchdog=self.watchdog, nvm=self.nvm, reset=reset)
+
+    def _watchdog(self):
+        return types.SimpleNamespace(WatchDogMode=types.SimpleNamespace(RAISE="raise", RESET="reset"), WatchDogTimeout=WatchDogTimeout)
+
+    def _alarm(self):
+        clock = self.clock
+
+        class TimeAlarm:
+            def __init__(self, monotonic_time=None, epoch_time=None):
+                if monotonic_time is None:
+                    monotonic_time = clock.mono + epoch_time - clock.rtc_utc()
+                self.monotonic_time = monotonic_time
+
+        def exit_and_deep_sleep_until_alarms(*alarms):
+            raise DeepSleep(alarms)
+
+        def light_sleep_until_alarms(*alarms):
+            fired = pin_alarm(alarms)
+            if fired is not None:  # level already there, no sleep at all
+                return fired
+            wake = min(a.monotonic_time for a in alarms if isinstance(a, TimeAlarm))
+            start = clock.mono
+            try:
+                if clock.advance(wake - clock.mono, lambda: pin_alarm(alarms) is not None):
+                    return pin_alarm(alarms)
+            finally:
+                clock.light_slept += clock.mono - start
+            return [a for a in alarms if isinstance(a, TimeAlarm)][0]
+
+        return types.SimpleNamespace(
+            time=types.SimpleNamespace(TimeAlarm=TimeAlarm),
+            pin=types.SimpleNamespace(PinAlarm=PinAlarm),
+            sleep_memory=self.sleep_memory,
+            wake_alarm=self.wake_alarm,
+            exit_and_deep_sleep_until_alarms=exit_and_deep_sleep_until_alarms,
+            light_sleep_until_alarms=light_sleep_until_alarms,
+        )
+
+    def _rtc(self):
+        clock = self.clock
+
+        class RTC:
+            @property
+            def datetime(self):
+                return time.gmtime(int(clock.rtc_utc()))
+
+            @datetime.setter
+            def datetime(self, value):
+                clock.set_rtc(calendar.timegm(value))
+
+        return types.SimpleNamespace(RTC=RTC)
+
+    def _lis3dh(self):
+        chip = self.accelerometer
+
+        class LIS3DH_I2C:
+            def __init__(self, i2c, address=0x18, int1=None):
+                self._chip = chip
+
+            def _write_register_byte(self, register, value):
+                chip.write(register, value)
+
+            def _read_register_byte(self, register):
+                return chip.read(register)
+
+            # same register writes as the Adafruit driver
+            def set_tap(self, tap, threshold, *, time_limit=10, time_latency=20, time_window=255, click_cfg=None):
+                if tap < 0 or tap > 2:
+                    raise ValueError("Tap must be 0 (disabled), 1 (single tap), or 2 (double tap)!")
+                if threshold > 127 or threshold < 0:
+                    raise ValueError("Threshold out of range (0-127)")
+                if tap == 0 and click_cfg is None:
+                    chip.write(LIS3DH.CTRL_REG3, chip.read(LIS3DH.CTRL_REG3) & ~0x80)
+                    chip.write(LIS3DH.CLICK_CFG, 0)
+                    return
+                chip.write(LIS3DH.CTRL_REG3, 0x80)  # I1_CLICK
+                chip.write(LIS3DH.CTRL_REG5, 0x08)  # latch interrupt on INT1
+                if click_cfg is None:
+                    click_cfg = 0x15 if tap == 1 else 0x2A
+                chip.write(LIS3DH.CLICK_CFG, click_cfg)
+                chip.write(LIS3DH.CLICK_THS, 0x80 | threshold)
+                chip.write(0x3B, time_limit)
+                chip.write(0x3C, time_latency)
+                chip.write(0x3D, time_window)
+
+            @property
+            def tapped(self):
+                return chip.read(LIS3DH.CLICK_SRC) & 0x40 > 0
+
+            @property
+            def acceleration(self):
+                return (0.0, 0.0, 9.8)
+
+        return types.SimpleNamespace(LIS3DH_I2C=LIS3DH_I2C)
@@ -0,0 +1,359 @@
+###############################
+### Display stand-ins       ###
+###############################
+#
+# displayio, fontio, terminalio and adafruit_magtag.magtag.MagTag for the
+# host simulator.  The e-ink Panel survives reboots like the real one does
+# and records every refresh with the labels it showed.  Its display also
+# has refresh_areas(), the fast partial update a driver could offer, so
+# clock_refresh.py can be tried here: partial updates are counted with the
+# size of their areas and how many have piled up since the last full one.
+
+import collections
+import types
+
+
+class Bitmap:
+    def __init__(self, width, height, value_count):
+        self.width = width
+        self.height = height
+        self.value_count = value_count
+        self._data = bytearray(width * height)
+
+    def __setitem__(self, xy, value):
+        x, y = xy
+        self._data[y * self.width + x] = value
+
+    def __getitem__(self, xy):
+        x, y = xy
+        return self._data[y * self.width + x]
+
+    def fill(self, value):
+        for i in range(len(self._data)):
+            self._data[i] = value
+
+
+class Palette:
+    def __init__(self, count):
+        self._colors = [0] * count
+        self.transparent = set()
+
+    def __len__(self):
+        return len(self._colors)
+
+    def __setitem__(self, index, color):
+        self._colors[index] = color
+
+    def __getitem__(self, index):
+        return self._colors[index]
+
+    def make_transparent(self, index):
+        self.transparent.add(index)
+
+    def make_opaque(self, index):
+        self.transparent.discard(index)
+
+
+class TileGrid:
+    def __init__(self, bitmap, *, pixel_shader, width=1, height=1, tile_width=None, tile_height=None, default_tile=0, x=0, y=0):
+        self.bitmap = bitmap
+        self.pixel_shader = pixel_shader
+        self.width = width
+        self.height = height
+        self.tile_width = tile_width or bitmap.width
+        self.tile_height = tile_height or bitmap.height
+        self.x = x
+        self.y = y
+        self.hidden = False
+        self._tiles = [default_tile] * (width * height)
+        self.writes = 0
+
+    def __setitem__(self, index, tile):
+        if isinstance(index, tuple):
+            index = index[1] * self.width + index[0]
+        self.writes += 1
+        self._tiles[index] = tile
+
+    def __getitem__(self, index):
+        if isinstance(index, tuple):
+            index = index[1] * self.width + index[0]
+        return self._tiles[index]
+
+
+class Group(list):
+    def __init__(self, *, scale=1, x=0, y=0):
+        super().__init__()
+        self.scale = scale
+        self.x = x
+        self.y = y
+        self.hidden = False
+
+
+def displayio_module():
+    return types.SimpleNamespace(Bitmap=Bitmap, Palette=Palette, TileGrid=TileGrid, Group=Group)
+
+
+Glyph = collections.namedtuple("Glyph", "bitmap tile_index width height dx dy shift_x shift_y")
+
+
+# The e-ink panel, keeps its image over resets
+class Panel:
+    width = 296
+    height = 128
+
+    def __init__(self, clock):
+        self._clock = clock
+        self.refreshes = 0
+        self.frames = []  # (monotonic, texts, colours, background, areas or None) per refresh
+        self.shown = None
+        self.busy_until = 0.0
+        self.refresh_time = 2.0  # seconds a full refresh keeps the panel busy
+        self.partial_time = 0.4
+        self.partials = 0
+        self.partial_pixels = 0  # summed area of the partial updates
+        self.ghosting = 0  # partial updates since the last full refresh
+        self.max_ghosting = 0
+
+    @property
+    def time_to_refresh(self):
+        return max(0.0, self.busy_until - self._clock.mono)
+
+    def refresh(self, magtag, areas=None):
+        if self.time_to_refresh > 0:
+            raise RuntimeError("Refresh too soon")
+        texts = tuple(t["label"].text if t["label"] else "" for t in magtag._text)
+        # anything else on the screen that shows text, e.g. a tile based display
+        drawables = [item for item in magtag.splash if isinstance(item, Group) and hasattr(item, "text")]
+        texts += tuple(item.text for item in drawables)
+        colors = tuple(t["color"] for t in magtag._text) + tuple(item.color for item in drawables)
+        self.shown = (texts, colors, background(magtag.splash, self.width, self.height))
+        self.frames.append((self._clock.mono,) + self.shown + (areas,))
+        if areas is None:
+            self.refreshes += 1
+            self.ghosting = 0
+            self.busy_until = self._clock.mono + self.refresh_time
+        else:
+            self.partials += 1
+            self.partial_pixels += sum(area[2] * area[3] for area in areas)
+            self.ghosting += 1
+            self.max_ghosting = max(self.max_ghosting, self.ghosting)
+            self.busy_until = self._clock.mono + self.partial_time
+
+
+# Colour of the topmost opaque full screen tile grid, what shows behind the
+# text, or None.  Later items in a group are drawn over earlier ones.
+def background(group, width, height):
+    found = None
+    for item in group:
+        if getattr(item, "hidden", False):
+            continue
+        if isinstance(item, Group):
+            found = background(item, width, height) or found
+        elif (
+            isinstance(item, TileGrid)
+            and item.width * item.tile_width >= width
+            and item.height * item.tile_height >= height
+            and 0 not in item.pixel_shader.transparent
+        ):
+            found = item.pixel_shader[0]
+    return found
+
+
+class Label:
+    def __init__(self, font, text="", color=0):
+        self.font = font
+        self.text = text
+        self.color = color
+        self.x = 0
+        self.y = 0
+
+    # (x, y, width, height) from the label's x and y, like a bitmap_label's
+    @property
+    def bounding_box(self):
+        if hasattr(self.font, "get_glyph"):
+            width = sum(glyph.shift_x for glyph in (self.font.get_glyph(ord(char)) for char in self.text) if glyph)
+            height = self.font.get_bounding_box()[1]
+        else:
+            width = 8 * len(self.text)  # BDF fonts are not loaded here
+            height = 16
+        return (0, 0, width, height)
+
+    # Place it like MagTag's text_position and text_anchor_point
+    def anchor(self, position, anchor_point):
+        _, _, width, height = self.bounding_box
+        self.x = position[0] - int(anchor_point[0] * width)
+        self.y = position[1] - int(anchor_point[1] * height)
+
+
+class Display:
+    def __init__(self, panel):
+        self._panel = panel
+        self.width = panel.width
+        self.height = panel.height
+        self.root_group = None
+        self.magtag = None
+
+    @property
+    def time_to_refresh(self):
+        return self._panel.time_to_refresh
+
+    def show(self, group):
+        self.root_group = group
+
+    def refresh(self):
+        self._panel.refresh(self.magtag)
+
+    # The fast partial update a driver could offer, see clock_refresh.py
+    def refresh_areas(self, areas):
+        while True:
+            try:
+                self._panel.refresh(self.magtag, tuple(areas))
+                return
+            except RuntimeError:
+                self._panel._clock.advance(0.1)
+
+
+# Like adafruit_portalbase's GraphicsBase: splash[0] is a group holding the
+# background, an opaque full screen colour from MagTag(default_bg=0xFFFFFF)
+class Graphics:
+    def __init__(self, panel, default_bg=0xFFFFFF):
+        self.display = Display(panel)
+        self.splash = Group()
+        self._bg_group = Group()
+        self.splash.append(self._bg_group)
+        self.display.show(self.splash)
+        self.set_background(default_bg)
+
+    def set_background(self, file_or_color, position=None):
+        while self._bg_group:
+            self._bg_group.pop()
+        if file_or_color is None:
+            return
+        if isinstance(file_or_color, str):
+            file_or_color = 0xFFFFFF  # bitmap files are not loaded here, count it as white
+        palette = Palette(1)
+        palette[0] = file_or_color
+        bitmap = Bitmap(self.display.width, self.display.height, 1)
+        self._bg_group.append(TileGrid(bitmap, pixel_shader=palette))
+
+
+class NeoPixels:
+    def __init__(self, sim):
+        self._sim = sim
+        self.brightness = 1
+        self.color = (0, 0, 0)
+
+    def fill(self, color):
+        if color != self.color:
+            self._sim.record("neopixels", color)
+        self.color = color
+
+    def __setitem__(self, index, color):
+        self.fill(color)
+
+
+class Peripherals:
+    def __init__(self, sim):
+        self._sim = sim
+        self.neopixels = NeoPixels(sim)
+        self.neopixel_disable = False
+        self._speaker_disable = True
+
+    @property
+    def speaker_disable(self):
+        return self._speaker_disable
+
+    @speaker_disable.setter
+    def speaker_disable(self, value):
+        if value != self._speaker_disable:
+            self._sim.record("speaker", not value)
+        self._speaker_disable = value
+
+    @property
+    def light(self):
+        self._sim.adc_reads += 1
+        return int(self._sim.light(self._sim.clock.true_utc()))
+
+    @property
+    def battery(self):
+        self._sim.adc_reads += 1
+        return float(self._sim.battery(self._sim.clock.true_utc()))
+
+    def play_tone(self, frequency, duration):
+        self._sim.record("tone", (frequency, duration))
+        self._sim.clock.advance(duration)
+
+
+def magtag_module(sim):
+    class MagTag:
+        def __init__(self, *args, default_bg=0xFFFFFF, **kwargs):
+            self.graphics = Graphics(sim.panel, default_bg)
+            self.graphics.display.magtag = self
+            self.splash = self.graphics.splash
+            self.peripherals = Peripherals(sim)
+            self._fonts = {}
+            self._text = []
+
+        def _load_font(self, font):
+            if font not in self._fonts:
+                self._fonts[font] = "bdf:" + str(font)  # glyphs are not rendered from BDF here
+            return font
+
+        def add_text(self, text_font=None, text_color=0x000000, text_position=(0, 0), text_anchor_point=(0, 0.5), text_scale=1, is_data=True, **kwargs):
+            self._text.append(
+                {
+                    "label": None,
+                    "font": self._load_font(text_font),
+                    "color": text_color,
+                    "position": text_position,
+                    "anchor_point": text_anchor_point,
+                    "scale": text_scale,
+                }
+            )
+            return len(self._text) - 1
+
+        def set_text(self, val, index=0, auto_refresh=True):
+            entry = self._text[index]
+            sim.label_builds += 1
+            font = self._fonts[entry["font"]]
+            if hasattr(font, "get_glyph"):  # a Label looks up every glyph it lays out
+                for char in val:
+                    font.get_glyph(ord(char))
+            if val:
+                if entry["label"] is None:
+                    entry["label"] = Label(self._fonts[entry["font"]], text=val, color=entry["color"])
+                    self.splash.append(entry["label"])
+                else:
+                    entry["label"].text = val
+                entry["label"].color = entry["color"]
+                entry["label"].anchor(entry["position"], entry["anchor_point"])
+            elif entry["label"] is not None:
+                self.splash.remove(entry["label"])
+                entry["label"] = None
+            if auto_refresh:
+                self.refresh()
+
+        def set_text_color(self, color, index=0):
+            sim.label_builds += 1
+            self._text[index]["color"] = color
+            if self._text[index]["label"] is not None:
+                self._text[index]["label"].color = color
+
+        def refresh(self):
+            while True:
+                try:
+                    self.graphics.display.refresh()
+                    return
+                except RuntimeError:
+                    sim.clock.advance(1)
+
+        def exit_and_deep_sleep(self, sleep_time):
+            alarm = sim.modules["alarm"]
+            alarm.exit_and_deep_sleep_until_alarms(alarm.time.TimeAlarm(monotonic_time=sim.clock.mono + sleep_time))
+
+        def enter_light_sleep(self, sleep_time):
+            sim.clock.advance(sleep_time)
+
+    module = types.ModuleType("adafruit_magtag.magtag")
+    module.MagTag = MagTag
+    return module
@@ -0,0 +1,355 @@
+###############################
+### Network stand-ins       ###
+###############################
+#
+# wifi, socketpool and adafruit_minimqtt for the host simulator, plus the
+# other end of the wire: an MQTT broker stub fed by the messages of
+# tools/time_publisher.py, an NTP server and a UDP peer for the command port.  Every
+# packet is counted so the benchmark can report network round trips.
+
+import errno
+import os
+import random
+import struct
+import sys
+import time
+import types
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from time_publisher import messages  # noqa: E402
+
+NTP_EPOCH = 2_208_988_800
+
+
+def topic_matches(pattern, topic):
+    pattern = pattern.split("/")
+    topic = topic.split("/")
+    for i, part in enumerate(pattern):
+        if part == "#":
+            return True
+        if i >= len(topic) or (part != "+" and part != topic[i]):
+            return False
+    return len(pattern) == len(topic)
+
+
+class Broker:
+    def __init__(self, sim):
+        self._sim = sim
+        self.retained = {}
+        self.clients = []
+        self.sessions = {}  # client id -> subscriptions kept for clean_session=False
+        self.up = True  # False drops every connection
+        self.packets = 0  # MQTT packets either way, PUBACKs included
+
+    def publish(self, topic, message, retain=False):
+        if retain:
+            self.retained[topic] = message
+        for client in self.clients:
+            client.deliver(topic, message)
+
+    def subscribe(self, client, topic, qos):
+        if (topic, qos) not in client.subscriptions:
+            client.subscriptions.append((topic, qos))
+        for retained_topic, message in self.retained.items():
+            if topic_matches(topic, retained_topic):
+                client.deliver(retained_topic, message)
+
+    def drop_all(self):
+        for client in self.clients[:]:
+            client.dropped()
+
+    # A restart without persistence
+    def forget_sessions(self):
+        self.drop_all()
+        self.sessions = {}
+
+
+# tools/time_publisher.py, run once a minute against the broker.  The first
+# run (and any after the broker lost its retained messages) sends every field.
+def cron_publish(broker, local):
+    full = "time/date" not in broker.retained or "time/hour" not in broker.retained
+    for topic, payload in messages(time.gmtime(local), "time", full):
+        broker.publish(topic, payload, retain=True)
+
+
+class Network:
+    def __init__(self, sim, ntp_loss=0.0, ntp_delay=(0.005, 0.05), seed=1):
+        self.sim = sim
+        self.broker = Broker(sim)
+        self.ntp_loss = ntp_loss
+        self.ntp_delay = ntp_delay
+        self.random = random.Random(seed)
+        self.bound = {}  # (ip, port) -> socket for datagrams to the board
+        self.udp_replies = []
+        self.published = []  # (monotonic, topic, message) the board published
+        self.datagrams = []  # (monotonic, address, data) the board sent, besides NTP
+        self.counts = {"wifi_connect": 0, "wifi_scan": 0, "ntp_request": 0, "ntp_reply": 0, "udp_in": 0, "udp_out": 0}
+        self.radio_on = False
+        self.ap_up = True  # False: the access point is gone, joins fail and the link drops
+
+    def ap_down(self):
+        self.ap_up = False
+        self.radio_on = False
+        self.broker.drop_all()
+
+    def ap_back(self):
+        self.ap_up = True
+
+    def round_trips(self):
+        return self.broker.packets + self.counts["ntp_request"] + self.counts["udp_in"] + self.counts["wifi_connect"]
+
+    # Datagram from the board
+    def send(self, sock, data, address):
+        clock = self.sim.clock
+        if address[1] == 123:
+            self.counts["ntp_request"] += 1
+            if self.random.random() < self.ntp_loss:
+                return
+            request = bytes(data)
+            delay = self.random.uniform(*self.ntp_delay)
+
+            def reply():
+                received = clock.true_utc()
+                packet = bytearray(48)
+                packet[0] = 0x24  # version 4, server
+                packet[1] = 2
+                packet[24:32] = request[40:48]
+                for offset, seconds in ((32, received), (40, received)):
+                    whole = int(seconds)
+                    struct.pack_into("!II", packet, offset, whole + NTP_EPOCH, int((seconds - whole) * 4294967296))
+                clock.after(delay / 2, lambda: sock.inbox.append((bytes(packet), address)))
+                self.counts["ntp_reply"] += 1
+
+            clock.after(delay / 2, reply)
+        else:
+            self.counts["udp_out"] += 1
+            self.udp_replies.append((clock.mono, bytes(data)))
+            self.datagrams.append((clock.mono, tuple(address), bytes(data)))
+
+    # Datagram to the board's command port
+    def send_command(self, data, port=808):
+        for (ip, bound_port), sock in self.bound.items():
+            if bound_port == port:
+                self.counts["udp_in"] += 1
+                sock.inbox.append((data, ("10.1.0.2", 40000)))
+
+    # A boot starts with the radio off
+    def modules(self):
+        self.radio_on = False
+        return {
+            "wifi": self._wifi(),
+            "socketpool": self._socketpool(),
+            "ssl": types.SimpleNamespace(create_default_context=lambda: None),
+            "adafruit_minimqtt": types.ModuleType("adafruit_minimqtt"),
+            "adafruit_minimqtt.adafruit_minimqtt": self._minimqtt(),
+        }
+
+    def _wifi(self):
+        network = self
+        clock = self.sim.clock
+
+        class ScanResult:
+            def __init__(self, ssid, rssi, channel, bssid):
+                self.ssid = ssid
+                self.rssi = rssi
+                self.channel = channel
+                self.bssid = bssid
+
+        class Radio:
+            mac_address = b"\xde\xad\xbe\xef\xca\xfe"
+            ipv4_gateway = "10.1.0.1"
+            enabled = True
+            ap_info = types.SimpleNamespace(ssid="Super WIFI", channel=6, bssid=b"\x00\x11\x22\x33\x44\x55", rssi=-50)
+
+            def start_scanning_networks(self, *, start_channel=1, stop_channel=11):
+                network.counts["wifi_scan"] += 1
+                clock.advance(1.2)  # a full scan
+                return [ScanResult(b"Super WIFI", -50, 6, b"\x00\x11\x22\x33\x44\x55")]
+
+            def stop_scanning_networks(self):
+                pass
+
+            def connect(self, ssid, password=None, *, channel=0, bssid=None, timeout=None):
+                network.counts["wifi_connect"] += 1
+                if not network.ap_up:
+                    clock.advance(timeout or 8)
+                    raise ConnectionError("No network with that ssid")
+                network.radio_on = True
+                clock.advance(0.3 if channel else 1.5)
+
+            @property
+            def connected(self):
+                return network.radio_on
+
+            @property
+            def ipv4_address(self):
+                return "10.1.0.50" if network.radio_on else None
+
+        radio = Radio()
+        return types.SimpleNamespace(radio=radio, reset=lambda: None)
+
+    def _socketpool(self):
+        network = self
+
+        class Socket:
+            def __init__(self, family, kind):
+                self.inbox = []
+                self.blocking = True
+                self.timeout = None
+
+            def setblocking(self, flag):
+                self.blocking = flag
+
+            def settimeout(self, value):
+                self.timeout = value
+
+            def bind(self, address):
+                network.bound[address] = self
+
+            def sendto(self, data, address):
+                network.send(self, data, address)
+                return len(data)
+
+            def recvfrom_into(self, buffer):
+                if not self.inbox:
+                    raise OSError(errno.EAGAIN, "EAGAIN")
+                data, address = self.inbox.pop(0)
+                buffer[: len(data)] = data
+                return len(data), address
+
+            def recv_into(self, buffer):
+                return self.recvfrom_into(buffer)[0]
+
+            def close(self):
+                for address, sock in list(network.bound.items()):
+                    if sock is self:
+                        del network.bound[address]
+
+            def __enter__(self):
+                return self
+
+            def __exit__(self, *args):
+                self.close()
+
+        class SocketPool:
+            AF_INET = 2
+            SOCK_DGRAM = 2
+            SOCK_STREAM = 1
+
+            def __init__(self, radio):
+                pass
+
+            def socket(self, family=2, kind=1):
+                return Socket(family, kind)
+
+        return types.SimpleNamespace(SocketPool=SocketPool)
+
+    def _minimqtt(self):
+        network = self
+        broker = self.broker
+        clock = self.sim.clock
+
+        class MMQTTException(Exception):
+            pass
+
+        class MQTT:
+            def __init__(self, broker=None, port=1883, username=None, password=None, client_id=None, socket_pool=None, ssl_context=None, keep_alive=60, is_ssl=False, **kwargs):
+                self.broker = broker
+                self.port = port
+                self.client_id = client_id or "cpy%d" % id(self)
+                self.keep_alive = keep_alive
+                self.subscriptions = []
+                self.queue = []
+                self._connected = False
+                self._last_packet = clock.mono
+                self.on_connect = self.on_disconnect = self.on_subscribe = None
+                self.on_unsubscribe = self.on_publish = self.on_message = None
+                self.clean_session = kwargs.get("clean_session", True)
+
+            def _packet(self, count=1):
+                broker.packets += count
+                self._last_packet = clock.mono
+
+            def connect(self, clean_session=True, host=None, port=None, keep_alive=None):
+                clock.advance(0.05)
+                if not broker.up or not network.radio_on:
+                    raise OSError(errno.ECONNREFUSED if network.radio_on else errno.EHOSTUNREACH, "connect failed")
+                self._packet(2)  # CONNECT, CONNACK
+                self._connected = True
+                broker.clients.append(self)
+                # a persistent session keeps its subscriptions, nothing is resent
+                if clean_session or self.client_id not in broker.sessions:
+                    broker.sessions[self.client_id] = []
+                self.subscriptions = broker.sessions[self.client_id]
+                if self.on_connect:
+                    self.on_connect(self, None, 0, 0)
+                return 0
+
+            def reconnect(self, resub_topics=True):
+                topics = list(self.subscriptions)
+                self.connect()
+                if resub_topics:
+                    self.subscriptions = []
+                    for topic, qos in topics:
+                        self.subscribe(topic, qos)
+
+            def disconnect(self):
+                self.is_connected()
+                self._packet()
+                self.dropped()
+
+            def dropped(self):
+                self._connected = False
+                if self in broker.clients:
+                    broker.clients.remove(self)
+                if self.on_disconnect:
+                    self.on_disconnect(self, None, 0)
+
+            def is_connected(self):
+                if not self._connected:
+                    raise MMQTTException("MiniMQTT is not connected")
+                return True
+
+            def subscribe(self, topic, qos=0):
+                self.is_connected()
+                self._packet(2)  # SUBSCRIBE, SUBACK
+                broker.subscribe(self, topic, qos)
+                if self.on_subscribe:
+                    self.on_subscribe(self, None, topic, qos)
+
+            def publish(self, topic, msg, retain=False, qos=0):
+                self.is_connected()
+                self._packet(2 if qos else 1)
+                message = msg if isinstance(msg, str) else bytes(msg)  # Binary payloads stay bytes
+                network.published.append((clock.mono, topic, message))
+                broker.publish(topic, message, retain)
+                if self.on_publish:
+                    self.on_publish(self, None, topic, 0)
+
+            def deliver(self, topic, message):
+                qos = max((q for t, q in self.subscriptions if topic_matches(t, topic)), default=None)
+                if qos is not None:
+                    self.queue.append((topic, message, qos))
+
+            def loop(self, timeout=1):
+                self.is_connected()
+                if not broker.up or not network.radio_on:
+                    self.dropped()
+                    raise OSError(errno.ECONNRESET, "connection lost")
+                if clock.mono - self._last_packet >= self.keep_alive:
+                    self._packet(2)  # PINGREQ, PINGRESP
+                if not self.queue:
+                    clock.advance(timeout)
+                    return None
+                # one PUBLISH per call, like minimqtt 5.1.6
+                topic, message, qos = self.queue.pop(0)
+                self._packet(2 if qos else 1)  # PUBLISH and PUBACK
+                if self.on_message:
+                    self.on_message(self, topic, message)
+                return [topic]
+
+        module = types.ModuleType("adafruit_minimqtt.adafruit_minimqtt")
+        module.MQTT = MQTT
+        module.MMQTTException = MMQTTException
+        return module
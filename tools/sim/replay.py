@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+###############################
+### Trace replay            ###
+###############################
+#
+# Feeds an input trace recorded by a clock (clock_trace.py) back into
+# code.py on the host simulator and writes what came out: every e-ink
+# refresh with the texts and background drawn (and the areas of a partial
+# one), every note of the chimes and beeps, resets and errors.  Simulated
+# time and a fixed seed make the output the same on every run, so two
+# versions of the code can be compared line by line on the traffic a unit
+# really saw.
+#
+#   python3 tools/sim/replay.py --listen 5141 field.trace   # capture trace_udp until Ctrl-C
+#   python3 tools/sim/replay.py field.trace > v1.log        # replay as fast as possible
+#   python3 tools/sim/replay.py field.trace --expect v1.log # exit 1 if this version differs
+#   python3 tools/sim/replay.py field.trace --speed 1       # at real speed, e.g. with --verbose
+#
+# A trace saved to nvm after a crash is sent to trace_udp at the next boot,
+# so it lands in the same capture (records seen twice are replayed once).
+# Chunks streamed before NTP set the clock are timed from the UTC the
+# trace got once it was set (clock_trace.load()).
+# Where the trace shows the unit booting again, the replay resets the
+# board there too, whatever the reason was.  The minute cron of the simulator is off:
+# MQTT time comes from the trace only.  Light and battery readings are
+# linear between the recorded ones, the synthetic day before the first.
+
+import argparse
+import difflib
+import os
+import socket
+import struct
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(1, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+from bench import parse_set  # noqa: E402
+from clock import BoardReset  # noqa: E402
+from runner import Simulation, interpolated  # noqa: E402
+from clock_trace import BOOT, MQTT, NAMES, SENSORS, TAP, UDP, load  # noqa: E402
+
+
+# Append every datagram on port to path until interrupted
+def capture(port, path):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(("0.0.0.0", port))
+    count = 0
+    print("Capturing trace datagrams on port %d to %s, Ctrl-C to stop" % (port, path), file=sys.stderr)
+    with open(path, "ab") as f:
+        try:
+            while True:
+                data, address = sock.recvfrom(4096)
+                f.write(data)
+                f.flush()
+                count += 1
+                print("%s %d bytes (%d)" % (address[0], len(data), count), file=sys.stderr)
+        except KeyboardInterrupt:
+            pass
+    return count
+
+
+# Put the trace's events on the simulator's clock, start_utc at mono 1.0
+def schedule(sim, events, start_utc):
+    clock = sim.clock
+    rows = []
+    counts = {}
+    booted = False
+    for utc, kind, payload in events:
+        at = clock.mono + utc - start_utc
+        counts[NAMES.get(kind, kind)] = counts.get(NAMES.get(kind, kind), 0) + 1
+        if kind == MQTT:
+            topic, _, message = payload.partition(b"\x00")
+            clock.at(at, lambda t=topic.decode("utf-8"), m=message.decode("utf-8"): sim.network.broker.publish(t, m))
+        elif kind == UDP:
+            clock.at(at, lambda data=payload: sim.network.send_command(data))
+        elif kind == TAP:
+            clock.at(at, sim.hardware.accelerometer.tap)
+        elif kind == SENSORS:
+            light, millivolts = struct.unpack("<HH", payload)
+            rows.append((utc - start_utc, light, millivolts / 1000))
+        elif kind == BOOT:
+            clock.at(at, reboot if booted else lambda: sim.record("trace_boot", None))
+            booted = True
+    if rows:
+        sim.light, sim.battery = interpolated(rows, start_utc)
+    return counts
+
+
+def reboot():
+    raise BoardReset()
+
+
+# Hold the simulated clock back to speed times the wall clock
+def pace(sim, speed, step=0.1):
+    clock = sim.clock
+    begin = (time.perf_counter(), clock.mono)
+
+    def wait():
+        ahead = (clock.mono - begin[1]) / speed - (time.perf_counter() - begin[0])
+        if ahead > 0:
+            time.sleep(ahead)
+        clock.after(step, wait)
+
+    clock.after(step, wait)
+
+
+# What the board did, one line each, seconds from the start of the replay
+def output(sim):
+    lines = []
+    for frame in sim.panel.frames:
+        area = "" if frame[4] is None else " partial " + " ".join("%d,%d %dx%d" % box for box in frame[4])
+        lines.append((frame[0], "frame bg=%s%s %s" % (frame[3], area, " | ".join(str(text) for text in frame[1]))))
+    playing = False
+    for t, pin, frequency, duty_cycle in sim.hardware.pwm_log:
+        if duty_cycle:
+            lines.append((t, "tone %s %dHz" % (pin, frequency)))
+        elif playing:
+            lines.append((t, "tone %s off" % pin))
+        playing = bool(duty_cycle)
+    for t, kind, value in sim.events:
+        if kind == "tone":  # simpleio, blocking
+            lines.append((t, "tone %dHz %.3fs" % value))
+        elif kind in ("reset", "error", "trace_boot"):
+            lines.append((t, "%s %s" % (kind, value if value is not None else "")))
+    lines.sort(key=lambda line: line[0])
+    return ["%10.3f %s" % (t - 1.0, text.rstrip()) for t, text in lines]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay an input trace from a clock through code.py on the simulator")
+    parser.add_argument("trace", help="capture file, chunks as the clock sent them")
+    parser.add_argument("--listen", type=int, metavar="PORT", help="capture datagrams from trace_udp into the file instead")
+    parser.add_argument("--lead", type=float, default=30, help="seconds the board runs before the first event")
+    parser.add_argument("--tail", type=float, default=120, help="seconds it runs after the last one")
+    parser.add_argument("--speed", type=float, default=0, help="1 = real time, 0 = as fast as possible")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--set", action="append", default=[], metavar="NAME=VALUE", help="override a preference in code.py")
+    parser.add_argument("--out", help="write the output here instead of stdout")
+    parser.add_argument("--expect", help="output of an earlier replay, exit 1 and show the difference if this one differs")
+    parser.add_argument("--verbose", action="store_true", help="echo code.py's print output")
+    args = parser.parse_args()
+    if args.listen:
+        capture(args.listen, args.trace)
+        return 0
+
+    with open(args.trace, "rb") as f:
+        events = sorted(dict.fromkeys(load(f.read())), key=lambda event: event[0])  # In the order recorded, once each
+    if not events:
+        print("No events in %s" % args.trace, file=sys.stderr)
+        return 1
+    start_utc = int(events[0][0] - args.lead)
+    prefs = {"trace_udp": None}  # The replay must not stream a trace of its own
+    prefs.update(parse_set(text) for text in args.set)
+    sim = Simulation(
+        start_utc=start_utc,
+        duration=events[-1][0] - start_utc + args.tail,
+        prefs=prefs,
+        seed=args.seed,
+        verbose=args.verbose,
+        cron=False,
+    )
+    counts = schedule(sim, events, start_utc)
+    if args.speed > 0:
+        pace(sim, args.speed)
+    sim.run()
+    lines = output(sim)
+    print(
+        "Replayed %s over %.0fs in %.2fs: %d refreshes, %d tones, resets %s"
+        % (
+            " ".join("%s=%d" % item for item in sorted(counts.items())),
+            sim.clock.mono - 1.0,
+            sim.wall_time,
+            sim.panel.refreshes,
+            sum(1 for line in lines if line.split()[1] == "tone" and not line.endswith("off")),
+            " ".join("%s=%d" % item for item in sim.resets.items() if item[1]) or "none",
+        ),
+        file=sys.stderr,
+    )
+    if args.out:
+        with open(args.out, "w") as f:
+            f.write("\n".join(lines) + "\n")
+    elif not args.expect:
+        print("\n".join(lines))
+    if args.expect:
+        with open(args.expect) as f:
+            expected = f.read().splitlines()
+        diff = list(difflib.unified_diff(expected, lines, args.expect, "replay", lineterm=""))
+        if diff:
+            print("\n".join(diff[:200]))
+            return 1
+        print("Same as %s (%d lines)" % (args.expect, len(lines)), file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,390 @@
+###############################
+### Simulation runner       ###
+###############################
+#
+# Boots code.py on the host against the stand-ins in this package.  The
+# board's modules are served by a private __import__, so code.py and the
+# clock_*.py modules run unmodified with the simulated time, hardware and
+# network, while the host's own modules are left alone.  Deep sleep, the
+# watchdog and the end of the run unwind out of code.py as exceptions and
+# the runner boots it again the way the board would.
+
+import bisect
+import builtins
+import gc as _gc
+import math
+import os
+import random
+import time as _time
+import traceback
+import tracemalloc
+import types
+
+from clock import BoardReset, DeepSleep, SimulationDone, SoftReset, TimeModule, VirtualClock, WatchdogReset
+from devices import Hardware, pin_alarm
+from display import Glyph, Panel, displayio_module, magtag_module
+from network import Network, cron_publish
+
+HEAP = 2_000_000  # bytes, roughly what the MagTag's PSRAM leaves free
+ROOT = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+
+SECRETS = {
+    "ssid": "Super WIFI",
+    "password": "WIFIPASSWORD",
+    "aio_username": "Woodsy",
+    "aio_key": "aio_ffffffffffffff",
+    "timezone": "Australia/Brisbane",
+    "mac_addy": "de:ad:be:ef:ca:fe",
+    "mqtt_broker": "10.1.0.1",
+    "mqtt_port": 1883,
+    "mqtt_user": "mqttusername",
+    "mqtt_pass": "mqttpassword",
+}
+
+
+# Light sensor over a day: dark at night, a smooth daylight curve, some noise
+def daylight(tz_offset, rng):
+    def light(utc):
+        hour = (utc + tz_offset) % 86400 / 3600
+        sun = max(0.0, math.sin((hour - 6) / 12 * math.pi))
+        return 556 + sun * 40000 + rng.uniform(0, 300)
+
+    return light
+
+
+# Battery draining linearly from full (or from volts), with ADC noise
+def discharge(start_utc, volts_per_day, rng, volts=4.175):
+    def battery(utc):
+        return volts - (utc - start_utc) / 86400 * volts_per_day + rng.uniform(-0.01, 0.01)
+
+    return battery
+
+
+# Light and battery played back from a recording: a CSV of seconds from the
+# start, raw light and volts (header and comment lines are skipped).
+def recorded(path, start_utc):
+    rows = []
+    with open(path) as f:
+        for line in f:
+            try:
+                rows.append(tuple(float(field) for field in line.split(",")[:3]))
+            except ValueError:
+                continue
+    if not rows:
+        raise ValueError("no seconds,light,battery rows in %s" % path)
+    return interpolated(rows, start_utc)
+
+
+# (seconds from the start, light, volts) rows as light and battery inputs.
+# Linear between rows, held before the first and after the last.
+def interpolated(rows, start_utc):
+    rows = sorted(rows)
+    times = [row[0] for row in rows]
+
+    def column(index):
+        def value(utc):
+            i = bisect.bisect_right(times, utc - start_utc)
+            if i == 0:
+                return rows[0][index]
+            if i == len(rows):
+                return rows[-1][index]
+            before, after = rows[i - 1], rows[i]
+            share = (utc - start_utc - before[0]) / (after[0] - before[0])
+            return before[index] + (after[index] - before[index]) * share
+
+        return value
+
+    return column(1), column(2)
+
+
+class Simulation:
+    def __init__(
+        self,
+        start_utc=1_700_000_000,
+        duration=86400,
+        prefs=None,
+        rtc_utc=None,
+        rtc_drift=0.0,
+        ntp_loss=0.0,
+        seed=1,
+        verbose=False,
+        code_path=None,
+        cron=True,
+    ):
+        self.random = random.Random(seed)
+        self.board_random = random.Random(seed + 1)  # the board's random module, e.g. reconnect jitter
+        self.start_utc = start_utc
+        self.clock = VirtualClock(start_utc, duration, rtc_utc if rtc_utc is not None else start_utc)
+        self.hardware = Hardware(self.clock)
+        self.panel = Panel(self.clock)
+        self.network = Network(self, ntp_loss=ntp_loss, seed=seed)
+        self.prefs = dict(prefs or {})  # code.py globals to override, e.g. {"deep_sleep": 1}
+        self.tz_offset = self.prefs.get("tz_offset", 3600 * 10)
+        self.light = daylight(self.tz_offset, self.random)
+        self.battery = discharge(start_utc, 0.2, self.random)
+        self.rtc_drift = rtc_drift  # seconds per day the board RTC gains
+        self.verbose = verbose
+        self.code_path = code_path or os.path.join(ROOT, "code.py")
+        self.events = []  # (monotonic, kind, value) recorded from stand-ins
+        self.adc_reads = 0
+        self.label_builds = 0
+        self.print_lines = 0
+        self.gc_collections = 0
+        self.loop_wakes = 0  # scheduler wakes, summed over boots
+        self.task_runs = {}
+        self.boots = 0
+        self.resets = {"watchdog": 0, "deep_sleep": 0, "error": 0, "button": 0, "software": 0}
+        self.boot_times = []  # (seconds to the first paint or None, boot total) per boot
+        self.errors = []
+        self.modules = {}
+        self.namespace = None  # code.py globals from the last boot
+        if cron:  # Off when a replay brings its own MQTT traffic
+            self._schedule_cron(start_utc)
+        if rtc_drift:
+            self._schedule_drift()
+
+    def record(self, kind, value):
+        self.events.append((self.clock.mono, kind, value))
+
+    #################
+    ### Scripting ###
+    #################
+    # Replace the synthetic light and battery with a recording, see recorded()
+    def inputs_from(self, path):
+        self.light, self.battery = recorded(path, self.start_utc)
+
+    def tap_at(self, seconds):
+        self.clock.at(self.clock.mono + seconds, self.hardware.accelerometer.tap)
+
+    # text, or bytes to send as they are
+    def command_at(self, seconds, text):
+        data = text if isinstance(text, bytes) else text.encode()
+        self.clock.at(self.clock.mono + seconds, lambda: self.network.send_command(data))
+
+    def broker_outage(self, start, length):
+        broker = self.network.broker
+
+        def down():
+            broker.up = False
+            broker.drop_all()
+
+        def up():
+            broker.up = True
+
+        self.clock.at(self.clock.mono + start, down)
+        self.clock.at(self.clock.mono + start + length, up)
+
+    def wifi_outage(self, start, length):
+        self.clock.at(self.clock.mono + start, self.network.ap_down)
+        self.clock.at(self.clock.mono + start + length, self.network.ap_back)
+
+    def broker_restart(self, at):
+        self.clock.at(self.clock.mono + at, self.network.broker.forget_sessions)
+
+    # The reset button, or anything else that restarts the board with power on
+    def reset_at(self, seconds):
+        def reset():
+            raise BoardReset()
+
+        self.clock.at(self.clock.mono + seconds, reset)
+
+    # A call that blocks for length seconds without feeding the watchdog,
+    # like a socket stuck in a C function
+    def hang_at(self, seconds, length):
+        def hang():
+            self.record("hang", length)
+            self.clock._move(self.clock.mono + length)
+
+        self.clock.at(self.clock.mono + seconds, hang)
+
+    def _schedule_cron(self, start_utc):
+        broker = self.network.broker
+        clock = self.clock
+
+        def tick():
+            utc = clock.true_utc()
+            cron_publish(broker, int(utc) + self.tz_offset)
+            clock.at_utc((int(utc) // 60 + 1) * 60 + 0.5, tick)
+
+        cron_publish(broker, int(start_utc) + self.tz_offset)
+        clock.at_utc((int(start_utc) // 60 + 1) * 60 + 0.5, tick)
+
+    def _schedule_drift(self):
+        clock = self.clock
+        step = 86400 / abs(self.rtc_drift)  # one second of drift every step seconds
+
+        def drift():
+            clock.rtc_offset += 1 if self.rtc_drift > 0 else -1
+            clock.after(step, drift)
+
+        clock.after(step, drift)
+
+    ###############
+    ### Imports ###
+    ###############
+    def _boot_modules(self):
+        modules = {}
+        modules.update(self.hardware.modules())
+        modules.update(self.network.modules())
+        modules["time"] = TimeModule(self.clock)
+        modules["displayio"] = displayio_module()
+        modules["fontio"] = types.SimpleNamespace(Glyph=Glyph, BuiltinFont=object)
+        modules["terminalio"] = types.SimpleNamespace(FONT="terminalio")
+        modules["adafruit_magtag"] = types.ModuleType("adafruit_magtag")
+        modules["adafruit_magtag.magtag"] = magtag_module(self)
+        modules["secrets"] = types.SimpleNamespace(secrets=dict(SECRETS))
+        modules["gc"] = self._gc_module()
+        modules["random"] = self.board_random  # seeded, so runs repeat
+        self.modules = modules
+        return modules
+
+    # CircuitPython's heap figures do not exist on the host, report the
+    # tracemalloc ones against a 2 MB heap when the benchmark traces
+    def _gc_module(self):
+        sim = self
+
+        # counted only, a host collection costs more than the rest of the run
+        def collect():
+            sim.gc_collections += 1
+
+        def mem_alloc():
+            if tracemalloc.is_tracing():
+                return tracemalloc.get_traced_memory()[0]
+            return 0
+
+        def mem_free():
+            return max(0, HEAP - mem_alloc())
+
+        return types.SimpleNamespace(collect=collect, mem_free=mem_free, mem_alloc=mem_alloc, enable=_gc.enable, disable=_gc.disable)
+
+    def _builtins(self, modules):
+        sim = self
+        board_builtins = dict(vars(builtins))
+
+        def board_import(name, globals=None, locals=None, fromlist=(), level=0):
+            if name in modules:
+                module = modules[name]
+                if not fromlist and "." in name:
+                    return modules[name.split(".")[0]]
+                return module
+            if name.startswith("clock_") and os.path.exists(os.path.join(ROOT, name + ".py")):
+                modules[name] = sim._load(name, board_builtins)
+                return modules[name]
+            return builtins.__import__(name, globals, locals, fromlist, level)
+
+        def board_print(*args, **kwargs):
+            sim.print_lines += 1
+            if sim.verbose:
+                print("[%10.3f]" % sim.clock.mono, *args, **kwargs)
+
+        def board_open(path, *args, **kwargs):
+            if isinstance(path, str) and path.startswith("/"):
+                path = os.path.join(ROOT, path[1:])
+            return open(path, *args, **kwargs)
+
+        # modules with a dotted name are reached as attributes of the parent
+        for name, module in modules.items():
+            if "." in name:
+                parent, child = name.rsplit(".", 1)
+                setattr(modules[parent], child, module)
+
+        board_builtins["__import__"] = board_import
+        board_builtins["print"] = board_print
+        board_builtins["open"] = board_open
+        return board_builtins
+
+    def _load(self, name, board_builtins):
+        path = os.path.join(ROOT, name + ".py")
+        module = types.ModuleType(name)
+        module.__file__ = path
+        module.__builtins__ = board_builtins
+        with open(path) as f:
+            exec(compile(f.read(), path, "exec"), module.__dict__)
+        return module
+
+    ###############
+    ### Running ###
+    ###############
+    def boot(self):
+        self.boots += 1
+        modules = self._boot_modules()
+        board_builtins = self._builtins(modules)
+        with open(self.code_path) as f:
+            source = self._with_prefs(f.read())
+        self.namespace = {"__name__": "__main__", "__file__": self.code_path, "__builtins__": board_builtins}
+        try:
+            exec(compile(source, self.code_path, "exec"), self.namespace)
+        finally:
+            self._harvest()
+
+    # Scheduler counters and boot timings from the boot that just ended
+    def _harvest(self):
+        timer = self.namespace.get("boot_timer")
+        if timer is not None and timer.phases:
+            self.boot_times.append((timer.first_paint, timer._last - timer.start))
+        scheduler = self.namespace.get("scheduler")
+        if scheduler is None or not hasattr(scheduler, "tasks"):
+            return
+        self.loop_wakes += scheduler.wakes
+        for task in scheduler.tasks:
+            self.task_runs[task.name] = self.task_runs.get(task.name, 0) + task.runs
+
+    # Override preference assignments at the top level of code.py
+    def _with_prefs(self, source):
+        lines = source.split("\n")
+        for i, line in enumerate(lines):
+            name = line.split("=", 1)[0].strip()
+            if name in self.prefs and not line.startswith((" ", "\t", "#")) and "=" in line:
+                lines[i] = "%s = %r" % (name, self.prefs[name])
+        return "\n".join(lines)
+
+    def run(self):
+        wall = _time.perf_counter()
+        try:
+            while True:
+                try:
+                    self.boot()
+                    self.record("exit", "code.py returned")
+                    self._halt()
+                except DeepSleep as sleep:
+                    self.resets["deep_sleep"] += 1
+                    self.hardware.watchdog.mode = None  # stopped while asleep
+                    timers = sorted((a for a in sleep.alarms if hasattr(a, "monotonic_time")), key=lambda a: a.monotonic_time)
+                    wake = timers[0].monotonic_time if timers else self.clock.end
+                    try:
+                        # a pin alarm whose level is already there wakes it straight away
+                        if pin_alarm(sleep.alarms) is None:
+                            self.clock.deep_sleep(wake, lambda: pin_alarm(sleep.alarms) is not None)
+                        self.hardware.wake_alarm = pin_alarm(sleep.alarms) or (timers[0] if timers else None)
+                    except BoardReset:
+                        self._reset("button")  # the button wakes it too
+                except WatchdogReset:
+                    self._reset("watchdog")
+                except BoardReset:
+                    self._reset("button")
+                except SoftReset:
+                    self._reset("software")
+                except Exception as e:
+                    self.resets["error"] += 1
+                    self.errors.append((round(self.clock.mono, 3), repr(e)))
+                    self.record("error", repr(e))
+                    if self.verbose:
+                        traceback.print_exc()
+                    self._halt()
+        except SimulationDone:
+            pass
+        self.wall_time = _time.perf_counter() - wall
+        return self
+
+    # code.py stopped, the board sits in the REPL until the watchdog bites
+    def _halt(self):
+        try:
+            self.clock.advance(self.clock.end - self.clock.mono + 1)
+        except WatchdogReset:
+            self._reset("watchdog")
+
+    def _reset(self, reason):
+        self.resets[reason] += 1
+        self.record("reset", reason)
+        self.hardware.wake_alarm = None
+        self.hardware.sleep_memory[:] = bytes(len(self.hardware.sleep_memory))
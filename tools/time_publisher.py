@@ -0,0 +1,226 @@
+#!/usr/bin/env python3
+##########################################
+### MagTag Clock time publisher (host) ###
+##########################################
+#
+# Replaces the crontab of mosquitto_pub lines in code.py: one process, one
+# persistent MQTT connection, and every field of a minute formatted from
+# the same timestamp so time/time and time/date can never disagree across
+# midnight.  Messages go out retained on the minute boundary with the same
+# topics, formats and schedule as the crontab, and the whole set again
+# after every (re)connect so a broker without persistence is refilled.
+#
+# Needs paho-mqtt (pip install paho-mqtt) except for --dry-run.
+#
+#   python3 tools/time_publisher.py --broker 10.1.0.1 -u mqtt -P mqtt
+#   python3 tools/time_publisher.py --clock time=Australia/Brisbane --clock uk/time=Europe/London
+#   python3 tools/time_publisher.py --dry-run          # check against the crontab, show this minute
+#   python3 tools/time_publisher.py --dry-run --at 1767225600
+
+import argparse
+import os
+import re
+import sys
+import time
+from datetime import datetime
+
+try:
+    from zoneinfo import ZoneInfo
+except ImportError:  # Python < 3.9, local time only
+    ZoneInfo = None
+
+MINUTE = "minute"
+HOUR = "hour"  # minute 0
+DAY = "day"  # 00:00
+
+# (topic under the clock's prefix, date format, schedule), as in the crontab
+FIELDS = (
+    ("time", "%H:%M", MINUTE),
+    ("min", "%M", MINUTE),
+    ("hour", "%H", HOUR),
+    ("date", "%d-%m-%Y", DAY),
+    ("date2", "%d.%m.%y", DAY),
+    ("dow", "%A", DAY),
+    ("dowa", "%a", DAY),
+    ("moy", "%B", DAY),
+    ("moya", "%b", DAY),
+    ("day", "%d", DAY),
+    ("month", "%m", DAY),
+    ("year", "%Y", DAY),
+    ("year2", "%y", DAY),
+    ("state", "%y%m%d%H%M%w", MINUTE),  # mqtt_packed = 1
+)
+
+CODE_PY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "code.py")
+CRON_LINE = re.compile(r'^(\S+)\s+(\S+)\s+\S+\s+\S+\s+\S+\s+\S+\s+.*mosquitto_pub.*-t\s+(\S+)\s+-m\s+"\$\(date \+(.+?)\)"')
+
+
+def due(schedule, t):
+    if schedule == MINUTE:
+        return True
+    if schedule == HOUR:
+        return t.tm_min == 0
+    return t.tm_hour == 0 and t.tm_min == 0
+
+
+# (topic, payload) for one clock at struct_time t, full = every field
+def messages(t, prefix="time", full=False):
+    return [(prefix + "/" + topic, time.strftime(fmt, t)) for topic, fmt, schedule in FIELDS if full or due(schedule, t)]
+
+
+# A clock is "prefix=timezone", "prefix" alone uses the host's local time
+class Clock:
+    def __init__(self, spec):
+        self.prefix, _, zone = spec.partition("=")
+        self.zone = None
+        if zone and zone != "local":
+            if ZoneInfo is None:
+                raise SystemExit("time zones need Python 3.9 or later (zoneinfo)")
+            self.zone = ZoneInfo(zone)
+
+    def local(self, timestamp):
+        if self.zone is None:
+            return time.localtime(timestamp)
+        return datetime.fromtimestamp(timestamp, self.zone).timetuple()
+
+    def messages(self, timestamp, full=False):
+        return messages(self.local(timestamp), self.prefix, full)
+
+
+# {topic: (schedule, format)} from the crontab in code.py's MQTT section
+def read_crontab(path=CODE_PY):
+    entries = {}
+    with open(path) as f:
+        for line in f:
+            match = CRON_LINE.match(line)
+            if match is None or line.startswith("#"):
+                continue
+            minute, hour, topic, fmt = match.groups()
+            schedule = MINUTE if minute == "*" else HOUR if hour == "*" else DAY
+            entries[topic] = (schedule, fmt.replace("\\%", "%").replace("\\:", ":"))
+    return entries
+
+
+# Differences between FIELDS and the crontab, as text lines
+def check_crontab(entries, prefix="time", sample=None):
+    sample = time.localtime(sample)
+    problems = []
+    ours = {prefix + "/" + topic: (schedule, fmt) for topic, fmt, schedule in FIELDS}
+    for topic, (schedule, fmt) in sorted(entries.items()):
+        if topic not in ours:
+            problems.append("%s: in the crontab, not published" % topic)
+            continue
+        if ours[topic][0] != schedule:
+            problems.append("%s: every %s, the crontab says every %s" % (topic, ours[topic][0], schedule))
+        expected = time.strftime(fmt, sample)
+        payload = time.strftime(ours[topic][1], sample)
+        if payload != expected:
+            problems.append("%s: %r, the crontab gives %r" % (topic, payload, expected))
+    for topic in sorted(set(ours) - set(entries)):
+        problems.append("%s: published, not in the crontab" % topic)
+    return problems
+
+
+class Publisher:
+    # client is anything with paho's publish(topic, payload, qos, retain)
+    def __init__(self, client, clocks, qos=1):
+        self.client = client
+        self.clocks = clocks
+        self.qos = qos
+        self.published = 0
+        self.minutes = 0
+
+    def publish(self, timestamp, full=False):
+        for clock in self.clocks:
+            for topic, payload in clock.messages(timestamp, full):
+                self.client.publish(topic, payload, qos=self.qos, retain=True)
+                self.published += 1
+
+    # Refill the broker's retained messages, called on every connect
+    def publish_all(self):
+        self.publish(int(time.time() // 60) * 60, full=True)
+
+    # Publish on each minute boundary, formatted from the boundary itself
+    def run(self, sleep=time.sleep):
+        while True:
+            boundary = (int(time.time() // 60) + 1) * 60
+            while time.time() < boundary:
+                sleep(boundary - time.time())
+            self.publish(boundary)
+            self.minutes += 1
+
+
+# A paho-mqtt client that publishes everything again on every connect
+def connect(args, publisher):
+    try:
+        import paho.mqtt.client as mqtt
+    except ImportError:
+        raise SystemExit("needs paho-mqtt: pip install paho-mqtt (or use --dry-run)")
+
+    try:  # paho-mqtt 2.x
+        client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, client_id=args.client_id)
+    except AttributeError:
+        client = mqtt.Client(client_id=args.client_id)
+    if args.username:
+        client.username_pw_set(args.username, args.password)
+
+    def on_connect(client, userdata, flags, *rest):
+        print("Connected to %s:%d" % (args.broker, args.port))
+        publisher.publish_all()
+
+    client.on_connect = on_connect
+    client.reconnect_delay_set(min_delay=1, max_delay=60)
+    publisher.client = client
+    client.connect_async(args.broker, args.port, keepalive=60)
+    client.loop_start()  # network thread, reconnects by itself
+    return client
+
+
+class Printer:
+    def publish(self, topic, payload, qos=0, retain=False):
+        print("  %-12s %s" % (topic, payload))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Publish the MagTag Clock's time topics from one MQTT connection")
+    parser.add_argument("--broker", default="localhost")
+    parser.add_argument("--port", type=int, default=1883)
+    parser.add_argument("-u", "--username")
+    parser.add_argument("-P", "--password")
+    parser.add_argument("--client-id", default="magtag-time-publisher")
+    parser.add_argument("--clock", action="append", metavar="PREFIX[=ZONE]", help="topic prefix and time zone, repeat for more (default time=local)")
+    parser.add_argument("--dry-run", action="store_true", help="check against the crontab in code.py and print instead of publishing")
+    parser.add_argument("--at", type=int, help="with --dry-run, a Unix time to show instead of this minute")
+    parser.add_argument("--crontab", default=CODE_PY, help="file with the crontab to check against")
+    args = parser.parse_args(argv)
+    clocks = [Clock(spec) for spec in args.clock or ["time"]]
+
+    if args.dry_run:
+        entries = read_crontab(args.crontab)
+        problems = check_crontab(entries, sample=args.at)
+        for problem in problems:
+            print("MISMATCH", problem)
+        if not problems:
+            print("%d topics match the crontab in %s" % (len(entries), args.crontab))
+        timestamp = int((time.time() if args.at is None else args.at) // 60) * 60
+        publisher = Publisher(Printer(), clocks)
+        for clock in clocks:
+            print("%s at %s:" % (clock.prefix, time.strftime("%Y-%m-%d %H:%M", clock.local(timestamp))))
+            publisher.clocks = [clock]
+            publisher.publish(timestamp)
+        return 1 if problems else 0
+
+    publisher = Publisher(None, clocks)
+    client = connect(args, publisher)
+    try:
+        publisher.run()
+    except KeyboardInterrupt:
+        pass
+    client.loop_stop()
+    client.disconnect()
+    print("Published %d messages over %d minutes" % (publisher.published, publisher.minutes))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())